@@ -17,21 +17,25 @@ CHARACTER_SCALING = 1/4
 USE_VOYAGE = True
 TESLA_LENGTH = 4.694
 TESLA_LENGTH_PX = 368
+TESLA_WIDTH = 2.09  # Include side mirrors
+TESLA_MAX_ACCEL = 4.79
 VOYAGE_VAN_LENGTH = 5.17652
 VOYAGE_VAN_LENGTH_PX = 405
+VOYAGE_VAN_WIDTH = 2.300675555555556
+VOYAGE_VAN_MAX_ACCEL = 3.625  # 0-60 in 7.4s
 PX_PER_M = VOYAGE_VAN_LENGTH_PX / VOYAGE_VAN_LENGTH * CHARACTER_SCALING
 SCREEN_WIDTH_METERS = SCREEN_WIDTH / PX_PER_M
 
 DIR = os.path.dirname(os.path.realpath(__file__))
 
 if USE_VOYAGE:
-    MAX_METERS_PER_SEC_SQ = 3.625  # 0-60 in 7.4s
-    VEHICLE_WIDTH = 2.300675555555556
+    MAX_METERS_PER_SEC_SQ = VOYAGE_VAN_MAX_ACCEL
+    VEHICLE_WIDTH = VOYAGE_VAN_WIDTH
     VEHICLE_LENGTH = VOYAGE_VAN_LENGTH
     VEHICLE_PNG = join(DIR, 'images/voyage-van-up.png')
 else:
-    MAX_METERS_PER_SEC_SQ = 4.79
-    VEHICLE_WIDTH = 2.09  # Include side mirrors
+    MAX_METERS_PER_SEC_SQ = TESLA_MAX_ACCEL
+    VEHICLE_WIDTH = TESLA_WIDTH
     VEHICLE_LENGTH = TESLA_LENGTH  # Include side mirrors
     VEHICLE_PNG = join(DIR, 'images/tesla-up.png')
 
@@ -56,8 +60,13 @@ MIN_STEER = -STEERING_RANGE/2
 MAX_STEER = STEERING_RANGE/2
 RIGHT_HAND_TRAFFIC = True
 FPS = 60
-PARTIAL_PHYSICS_STEP = 'partial_physics_step'
-COMPLETE_PHYSICS_STEP = 'complete_physics_step'
+
+# Agents below these for SLEEP_AFTER_STEPS observations skip physics until
+# their controls change or they collide, see Agent.should_sleep
+SLEEP_SPEED = 1e-3  # m/s
+SLEEP_ANGLE_CHANGE = 1e-5  # radians per substep
+SLEEP_CONTROL_DELTA = 1e-3
+SLEEP_AFTER_STEPS = 3
 
 COMFORTABLE_STEERING_ACTIONS = {
     0: 'IDLE',  # Zero steer, zero accel
@@ -4,19 +4,18 @@ import random
 import sys
 from collections import deque
 import time
-import json
 from typing import List, Tuple
 from math import pi, cos, sin
-from scipy import spatial
 
 import numpy as np
 from box import Box
+from numba import njit
 
-from deepdrive_zero.constants import G_ACCEL, \
-    VEHICLE_WIDTH, VEHICLE_LENGTH, MAX_STEER_CHANGE_PER_SECOND, \
-    MAX_ACCEL_CHANGE_PER_SECOND, MAX_BRAKE_CHANGE_PER_SECOND, STEERING_RANGE, \
-    MAX_METERS_PER_SEC_SQ, MAX_BRAKE_G, PARTIAL_PHYSICS_STEP, MAX_STEER, \
-    MIN_STEER, RIGHT_HAND_TRAFFIC, MAP_WIDTH_PX, SCREEN_MARGIN, MAP_HEIGHT_PX
+from deepdrive_zero.constants import CACHE_NUMBA, G_ACCEL, \
+    MAX_STEER_CHANGE_PER_SECOND, \
+    MAX_ACCEL_CHANGE_PER_SECOND, MAX_BRAKE_CHANGE_PER_SECOND, \
+    RIGHT_HAND_TRAFFIC, MAP_WIDTH_PX, SCREEN_MARGIN, MAP_HEIGHT_PX, \
+    SLEEP_SPEED, SLEEP_ANGLE_CHANGE, SLEEP_CONTROL_DELTA, SLEEP_AFTER_STEPS
 from deepdrive_zero.discrete.comfortable_actions import COMFORTABLE_ACTIONS, \
     COMFORTABLE_ACTIONS_IDLE, COMFORTABLE_ACTIONS_DECAY_STEERING, \
     COMFORTABLE_ACTIONS_SMALL_STEER_LEFT, COMFORTABLE_ACTIONS_SMALL_STEER_RIGHT, \
@@ -37,23 +36,46 @@ from deepdrive_zero.discrete.comfortable_steering_actions import \
 from deepdrive_zero.experience_buffer import ExperienceBuffer
 from deepdrive_zero.logs import log
 from deepdrive_zero.map_gen import get_intersection
+from deepdrive_zero.observation_schema import ObservationSchema
 from deepdrive_zero.physics.bike_model import bike_with_friction_step, \
-    get_vehicle_model, get_angle_for_accel
-from deepdrive_zero.physics.collision_detection import get_rect, \
+    VP_WIDTH, VP_LENGTH, VP_MAX_ACCEL, VP_MAX_BRAKE, \
+    VP_STEERING_RANGE
+from deepdrive_zero.physics.collision_detection import \
     get_lines_from_rect_points
-from deepdrive_zero.physics.interpolation_state import PhysicsInterpolationState
+from deepdrive_zero.physics.integrators import INTEGRATORS
+from deepdrive_zero.physics.pose_frame import get_pose_frame, POSE_FRONT, \
+    POSE_BACK, POSE_HEADING, POSE_RECT
+from deepdrive_zero.physics.arc_length import get_angles_ahead
 from deepdrive_zero.physics.lane_distance import get_lane_distance
-from deepdrive_zero.physics.physics_step import physics_step
-from deepdrive_zero.utils import get_angles_ahead, get_angle, flatten_points, \
+from deepdrive_zero.physics.neighbors import NEIGHBOR_ORDERS
+from deepdrive_zero.physics.pairwise_geometry import NUM_PAIRWISE_FEATURES
+from deepdrive_zero.physics.physics_step import physics_step, \
+    TRAJECTORY_FIELDS, NUM_COMFORT_METRICS, COMFORT_GFORCE_MAX, \
+    COMFORT_GFORCE_MEAN, COMFORT_JERK_MAX, COMFORT_JERK_MEAN
+from deepdrive_zero.physics.steering_table import get_steering_table, \
+    get_steer_for_lateral_gforce
+from deepdrive_zero.reward import compute_rewards, get_reward_params, \
+    NUM_REWARD_INPUTS, NUM_REWARD_TERMS, REWARD_IN_PROGRESS, REWARD_IN_YIELD, \
+    REWARD_IN_WON, REWARD_IN_COLLIDED, REWARD_IN_GFORCE, REWARD_IN_JERK, \
+    REWARD_IN_LEFT_LANE_DISTANCE, REWARD_IN_RIGHT_LANE_DISTANCE
+from deepdrive_zero.scenario_bank import NUM_MAP_PARAMS
+from deepdrive_zero.sensors.lidar import LIDAR_HIT_NONE
+from deepdrive_zero.sensors.polar_occupancy import NUM_OCCUPANCY_CHANNELS, \
+    OCCUPANCY_DISTANCE
+from deepdrive_zero.sensors.raster import NUM_RASTER_CHANNELS
+from deepdrive_zero.utils import get_angle, \
     np_rand, is_number
 
+# Which substep g-force and jerk comfort penalties and thresholds use, i.e.
+# the last substep of an observation, or the mean or max across all of them
+COMFORT_METRICS = ('last', 'mean', 'max')
+
 
 class Agent:
     def __init__(self,
                  env,
                  agent_index,
-                 vehicle_width=VEHICLE_WIDTH,
-                 vehicle_length=VEHICLE_LENGTH,
+                 route_index=None,
                  disable_gforce_penalty=False,
                  match_angle_only=False,
                  static_map=False,
@@ -68,6 +90,7 @@ class Agent:
                  speed_reward_coeff=None,
                  win_coefficient=None,
                  gforce_threshold=None,
+                 gforce_penalty_threshold=None,
                  jerk_threshold=None,
                  constrain_controls=None,
                  ignore_brake=None,
@@ -80,13 +103,40 @@ class Agent:
                  physics_steps_per_observation=None,
                  end_on_lane_violation=None,
                  discrete_actions=None,
-                 lane_margin=None,):
+                 lane_margin=None,
+                 integrator=None,
+                 integrator_steps=None,
+                 dtype=None,
+                 record_trajectory=None,
+                 comfort_metric=None,
+                 sleep_stationary=None,
+                 lod_physics_steps=None,
+                 max_observed_agents=None,
+                 observed_agent_order=None,
+                 polar_occupancy=None,
+                 polar_sectors=None,
+                 polar_range_bins=None,
+                 polar_max_range=None,
+                 lidar=None,
+                 lidar_beams=None,
+                 lidar_fov=None,
+                 lidar_max_range=None,
+                 raster=None,
+                 raster_size=None,
+                 raster_m_per_px=None,
+                 history_length=None,
+                 history_seconds=None,
+                 history_fields=None,):
 
         self.env = env
 
         # Agent config ---------------------------------------------------------
         self.dt = env.target_dt
         self.agent_index = agent_index
+
+        # Index into env.all_agents, used for per-route env data like
+        # conflict zones
+        self.route_index = agent_index if route_index is None else route_index
         self.match_angle_only = match_angle_only
         self.static_map = static_map
         self.add_rotational_friction = add_rotational_friction
@@ -102,6 +152,8 @@ class Agent:
         self.speed_reward_coeff = speed_reward_coeff
         self.win_coefficient = win_coefficient
         self.gforce_threshold = gforce_threshold
+        self.gforce_penalty_threshold = (0.05 if gforce_penalty_threshold is None
+                                         else gforce_penalty_threshold)
         self.jerk_threshold = jerk_threshold
         self.constrain_controls = constrain_controls
         self.ignore_brake = ignore_brake
@@ -115,6 +167,64 @@ class Agent:
         self.end_on_lane_violation = end_on_lane_violation
         self.discrete_actions = discrete_actions
         self.lane_margin = lane_margin
+        self.integrator = INTEGRATORS[integrator or 'euler']
+        self.integrator_steps = integrator_steps or 1
+
+        # Storage type for physics state, rectangles and observations
+        self.dtype = np.dtype(dtype or np.float64)
+
+        # Keep every substep pose of the last step in self.trajectory for
+        # rendering, recording, and collision checks
+        self.record_trajectory: bool = bool(
+            record_trajectory or env.update_intermediate_physics)
+
+        self.comfort_metric: str = comfort_metric or 'last'
+        if self.comfort_metric not in COMFORT_METRICS:
+            raise ValueError(f'Unknown comfort metric {comfort_metric}, '
+                             f'expected one of {COMFORT_METRICS}')
+
+        # Skip physics while stopped with unchanged controls
+        self.sleep_stationary: bool = bool(sleep_stationary)
+
+        # Substeps per observation while low_detail_physics is set by the env
+        # for vehicles far from all learning agents, see Env.update_physics_lod
+        self.lod_physics_steps: int = min(lod_physics_steps or 1,
+                                          physics_steps_per_observation or 1)
+        self.low_detail_physics: bool = False
+
+        # Observe a fixed number of the most relevant other vehicles,
+        # including dummy agents, rather than every other learning agent
+        self.max_observed_agents: int = max_observed_agents
+        self.observed_agent_order: str = observed_agent_order or 'distance'
+        if self.observed_agent_order not in NEIGHBOR_ORDERS:
+            raise ValueError(f'Unknown observed agent order '
+                             f'{observed_agent_order}, expected one of '
+                             f'{NEIGHBOR_ORDERS}')
+
+        # Sense other vehicles and static obstacles with a fixed-size polar
+        # grid instead of per-agent inputs, see polar_occupancy.py
+        self.polar_occupancy: bool = bool(polar_occupancy)
+        self.polar_sectors: int = polar_sectors or 16
+        self.polar_range_bins: int = polar_range_bins or 4
+        self.polar_max_range: float = polar_max_range or 40
+
+        # Range sensor against lanes, obstacles and vehicles, see lidar.py
+        self.lidar: bool = bool(lidar)
+        self.lidar_beams: int = lidar_beams or 32
+        self.lidar_fov: float = lidar_fov or 2 * pi
+        self.lidar_max_range: float = lidar_max_range or 50
+
+        # Top-down uint8 image for CNN policies, see raster.py
+        self.raster: bool = bool(raster)
+        self.raster_size: int = raster_size or 64
+        self.raster_m_per_px: float = raster_m_per_px or 0.5
+
+        # Stack the last history_length captures of the observation, or of
+        # just history_fields, taken history_seconds apart
+        self.history_length: int = history_length or 0
+        self.history_seconds: float = history_seconds or 0.25
+        self.history_fields: list = history_fields
+        self.history_indices: np.array = None
 
         # Map type
         self.is_one_waypoint_map: bool = env.is_one_waypoint_map
@@ -136,9 +246,8 @@ class Agent:
         # Map
         # These are duplicated per agent now as map is very small and most
         # map data is specific to agent
-        self.map = None
-        self.map_kd_tree = None
-        self.map_flat = None
+        self.map = None  # Read-only views into env.map_store
+        self.scenario_id: int = None  # Set when maps come from a scenario bank
         self.intersection = None
 
         # Static obstacle
@@ -147,9 +256,16 @@ class Agent:
         self.static_obstacle_tuple: tuple = ()
 
         # All units in meters and radians unless otherwise specified
-        self.vehicle_width: float = vehicle_width
-        self.vehicle_model:List[float] = get_vehicle_model(vehicle_width)  # TODO: Use length instead. Need to retrain models to fix.
-        self.vehicle_length: float = vehicle_length
+        # Row of env.vehicle_params, see vehicles.py
+        self.vehicle_model: np.array = env.vehicle_params[self.route_index]
+        self.vehicle_width: float = float(self.vehicle_model[VP_WIDTH])
+        self.vehicle_length: float = float(self.vehicle_model[VP_LENGTH])
+        self.max_accel: float = float(self.vehicle_model[VP_MAX_ACCEL])
+        self.max_brake: float = float(self.vehicle_model[VP_MAX_BRAKE])
+        self.steering_range: float = float(
+            self.vehicle_model[VP_STEERING_RANGE])
+        self.max_steer: float = self.steering_range / 2
+        self.min_steer: float = -self.steering_range / 2
         if 'STRAIGHT_TEST' in os.environ:
             self.num_actions = 1  # Accel
         else:
@@ -160,6 +276,11 @@ class Agent:
         self.aps = self.fps / self.physics_steps_per_observation
         
         self.disable_gforce_penalty = disable_gforce_penalty
+
+        # Compiled from the coefficients above, see reward.py
+        self.reward_params: np.array = self.get_reward_params()
+        self.reward_inputs: np.array = np.zeros((1, NUM_REWARD_INPUTS))
+        self.reward_terms: np.array = np.zeros(NUM_REWARD_TERMS)
         self.observation_space = env.observation_space
         if self.constrain_controls:
             self.max_steer_change_per_tick = MAX_STEER_CHANGE_PER_SECOND / self.fps
@@ -169,9 +290,9 @@ class Agent:
             self.max_accel_change = self.max_accel_change_per_tick * self.physics_steps_per_observation
             self.max_brake_change = self.max_brake_change_per_tick * self.physics_steps_per_observation
         else:
-            self.max_steer_change_per_tick = STEERING_RANGE / 2
-            self.max_accel_change_per_tick = MAX_METERS_PER_SEC_SQ
-            self.max_brake_change_per_tick = MAX_BRAKE_G * G_ACCEL
+            self.max_steer_change_per_tick = self.steering_range / 2
+            self.max_accel_change_per_tick = self.max_accel
+            self.max_brake_change_per_tick = self.max_brake
             self.max_steer_change = self.max_steer_change_per_tick
             self.max_accel_change = self.max_accel_change_per_tick
             self.max_brake_change = self.max_brake_change_per_tick
@@ -184,8 +305,10 @@ class Agent:
         elif discrete_actions is not None:
             raise NotImplementedError(f'Discrete actions: {discrete_actions} not handled')
 
-        self.update_intermediate_physics = (self.env.should_render or
-                                            self.env.being_played)
+        # Steering angle per (speed, lateral g) for comfortable turns, built
+        # on first use
+        self.steering_table: np.array = None
+
         # End agent config -----------------------------------------------------
 
         # Agent state ----------------------------------------------------------
@@ -208,6 +331,14 @@ class Agent:
         self.prev_y = None
         self.prev_angle = 0
 
+        # Pose derived geometry, see set_pose_frame
+        self.pose_frame: np.array = None
+        self.front_x: float = None  # Front middle
+        self.front_y: float = None
+        self.back_x: float = None  # Back middle
+        self.back_y: float = None
+        self.front_pos: np.array = None
+        self.heading: np.array = None  # Center to front middle
         self.ego_rect: np.array = np.array(
             [0, 0] * 4)  # 4 points of ego corners
         self.ego_rect_tuple: tuple = ()  # 4 points of ego corners as tuple
@@ -217,7 +348,7 @@ class Agent:
         self.prev_desired_accel = 0
         self.prev_desired_steer = 0
         self.prev_desired_brake = 0
-        self.other_agent_inputs: list = None
+        self.other_agent_inputs: np.array = None
         self.static_obst_angle_info: list = None
         self.static_obst_pixels: np.array = None
         self.angle_change: float = 0
@@ -240,7 +371,7 @@ class Agent:
         self.distance_to_end: float = 0
         self.prev_distance_along_route: float = None
         self.furthest_distance: float = 0
-        self.velocity: np.array = np.array((0, 0), dtype=np.float64)
+        self.velocity: np.array = np.array((0, 0), dtype=self.dtype)
         self.angular_velocity: float = 0
         self.gforce: float = 0  # TODO: Use accel_magnitude internally instead so we're in SI units
         self.accel_magnitude: float = 0
@@ -248,12 +379,12 @@ class Agent:
         self.max_gforce: float = 0
         self.max_jerk: float = 0
         self.state_buffer: deque = deque(maxlen=math.ceil(2*self.aps))
-        self.jerk: np.array = np.array((0, 0), dtype=np.float64)  # m/s^3 instantaneous, i.e. frame to frame
+        self.jerk: np.array = np.array((0, 0), dtype=self.dtype)  # m/s^3 instantaneous, i.e. frame to frame
         self.jerk_magnitude: float = 0
         self.closest_map_index: int = 0
         self.next_map_index: int = 1
         self.closest_waypoint_distance: float = 0
-        self.waypoint_distances: np.array = np.array((0, 0), dtype=np.float64)
+        self.waypoint_distances: np.array = np.array((0, 0), dtype=self.dtype)
         self.trip_pct: float = 0
         self.avg_trip_pct: float = 0
         self._trip_pct_total: float = 0
@@ -262,7 +393,7 @@ class Agent:
         self.episode_gforces: List[float] = []
         self.episode_jerks: List[float] = []
         self.static_obst_angle_info: list = None
-        self.acceleration = np.array((0, 0), dtype=np.float64)
+        self.acceleration = np.array((0, 0), dtype=self.dtype)
         self.approaching_intersection = False
         self.max_accel_historical = -np.inf
         # Important: this should only be true after the agent has reached
@@ -272,21 +403,26 @@ class Agent:
         # in theory the agent should learn to detect a left is coming
         # without an extra input explicitly stating that with RL.
         self.will_turn_across_opposing_lanes = False
-        # TODO: Haven't used this in a while, needs to be updated
-        # Take last n (10 from 0.5 seconds) state, action, reward values and append them
-        # to the observation. Should change frame rate?
+        # Observation history, see history_length
         self.experience_buffer = None
         self.should_add_previous_states = '--disable-prev-states' not in sys.argv
-        self.rolling_velocity = np.array((0, 0), dtype=np.float64)
-        self.rolling_accel = np.array((0, 0), dtype=np.float64)
-        self.rolling_jerk = np.array((0, 0), dtype=np.float64)
+        self.rolling_velocity = np.array((0, 0), dtype=self.dtype)
+        self.rolling_accel = np.array((0, 0), dtype=self.dtype)
+        self.rolling_jerk = np.array((0, 0), dtype=self.dtype)
         self.rolling_velocity_magnitude = 0
         self.rolling_accel_magnitude = 0
         self.rolling_jerk_magnitude = 0
         self.last_step_output = None
-        self.physics_interpolation_state = PhysicsInterpolationState(
-            total_steps=self.physics_steps_per_observation)
-        self.step_input = None
+        self.trajectory: np.array = np.zeros(
+            (self.physics_steps_per_observation, len(TRAJECTORY_FIELDS)))
+        self.num_trajectory_steps: int = 0  # Rows of trajectory from last step
+
+        # G-force and jerk across the substeps of the last step, indexed by
+        # physics_step.COMFORT_*
+        self.comfort: np.array = np.zeros(NUM_COMFORT_METRICS)
+
+        self.asleep: bool = False
+        self.quiet_steps: int = 0  # Consecutive steps we could have slept
         # End of agent state -------------------------------------------------
 
         self.reset()
@@ -310,7 +446,7 @@ class Agent:
                 self.start_x,
                 self.start_y,
                 self.start_angle,
-                self.ego_rect,
+                self.pose_frame,
                 self.ego_rect_tuple,
                 self.ego_lines,
                 self.collided_with,
@@ -387,7 +523,7 @@ class Agent:
          self.start_x,
          self.start_y,
          self.start_angle,
-         self.ego_rect,
+         pose_frame,
          self.ego_rect_tuple,
          self.ego_lines,
          self.collided_with,
@@ -451,6 +587,7 @@ class Agent:
          self.rolling_velocity_magnitude,
          self.rolling_accel_magnitude,
          self.rolling_jerk_magnitude,) = s
+        self.set_pose_attributes(pose_frame)
 
     def setup_step(self, action):
         info = Box(default_box=True)
@@ -460,7 +597,7 @@ class Agent:
         elif 'FLOOR_IT' in os.environ:
             steer = 0
             brake = 0
-            accel = MAX_METERS_PER_SEC_SQ
+            accel = self.max_accel
         elif 'TURN_ONE_G' in os.environ:
             _, accel, brake = action
             # steer_sign = 1 - (2 * (self.total_steps % 2))
@@ -480,11 +617,11 @@ class Agent:
         self.prev_desired_brake = brake
 
         if '--simple-steer' in sys.argv and self.angles_ahead:
-            accel = MAX_METERS_PER_SEC_SQ * 0.7
+            accel = self.max_accel * 0.7
             if self.angles_ahead:
                 steer = -0.1 * self.angles_ahead[0]
         elif self.match_angle_only:
-            accel = MAX_METERS_PER_SEC_SQ * 0.7
+            accel = self.max_accel * 0.7
             brake = 0
 
         if self.ignore_brake:
@@ -501,8 +638,8 @@ class Agent:
 
         return steer, accel, brake, info
 
-    def possibly_partial_step(self):
-        action, steer, accel, brake, info = self.step_input
+    def step(self, action):
+        steer, accel, brake, info = self.setup_step(action)
         now = time.time()
         if self.last_step_time is None:
             # init
@@ -512,21 +649,7 @@ class Agent:
             observation = self.get_blank_observation()
         else:
             collided = bool(self.collided_with)
-            if self.update_intermediate_physics:
-                # Get intermediate physics updates between actions
-                interpolation_steps = 1
-                start_interpolation_index = self.physics_interpolation_state.i
-                self.step_physics(steer, accel, brake, info,
-                                  interpolation_steps,
-                                  start_interpolation_index)
-                if not self.physics_interpolation_state.ready():
-                    return PARTIAL_PHYSICS_STEP
-            else:
-                interpolation_steps = self.physics_steps_per_observation
-                start_interpolation_index = 0
-                self.step_physics(steer, accel, brake, info,
-                                  interpolation_steps,
-                                  start_interpolation_index)
+            self.step_physics(steer, accel, brake, info)
 
             obs_data = self.get_observation(steer, accel, brake, info)
 
@@ -549,11 +672,6 @@ class Agent:
 
         return self.finish_step(action, observation, reward, done, info)
 
-    def step(self, action):
-        steer, accel, brake, info = self.setup_step(action)
-        self.step_input = action, steer, accel, brake, info
-        return self.possibly_partial_step()
-
     def finish_step(self, action, observation, reward, done, info):
         self.last_step_time = time.time()
         self.episode_reward += reward
@@ -594,43 +712,10 @@ class Agent:
         self.last_step_output = ret
         return ret
 
-    # TODO: Set these properties only when x,y, or angle change
-    @property
-    def front_x(self):
-        """Front middle x position of ego"""
-        theta = pi / 2 + self.angle
-        return self.x + cos(theta) * self.vehicle_length / 2
-
-    @property
-    def front_y(self):
-        """Front middle y position of ego"""
-        theta = pi / 2 + self.angle
-        return self.y + sin(theta) * self.vehicle_length / 2
-
-    @property
-    def back_x(self):
-        """Back middle x position of ego"""
-        theta = pi / 2 + self.angle
-        return self.x - cos(theta) * self.vehicle_length / 2
-
-    @property
-    def back_y(self):
-        """Back middle y position of ego"""
-        theta = pi / 2 + self.angle
-        return self.y - sin(theta) * self.vehicle_length / 2
-
-    @property
-    def front_pos(self):
-        return np.array((self.front_x, self.front_y))
-
     @property
     def ego_pos(self):
         return np.array((self.x, self.y))
 
-    @property
-    def heading(self):
-        return np.array([self.front_x, self.front_y]) - self.ego_pos
-
     # TODO: Numba this
     def denormalize_actions(self, steer, accel, brake):
 
@@ -647,23 +732,23 @@ class Agent:
             accel += self.prev_throttle
             brake += self.prev_brake
 
-            steer = min(steer, MAX_STEER)
-            steer = max(steer, MIN_STEER)
+            steer = min(steer, self.max_steer)
+            steer = max(steer, self.min_steer)
 
-            accel = min(accel, MAX_METERS_PER_SEC_SQ)
-            accel = max(accel, -MAX_METERS_PER_SEC_SQ)  # TODO: Lower max reverse accel and speed
+            accel = min(accel, self.max_accel)
+            accel = max(accel, -self.max_accel)  # TODO: Lower max reverse accel and speed
 
-            brake = min(brake, MAX_METERS_PER_SEC_SQ)
+            brake = min(brake, self.max_accel)
             brake = max(brake, 0)
 
         elif self.expect_normalized_actions:
             steer, accel, brake = self.check_action_bounds(accel, brake, steer)
-            steer = steer * STEERING_RANGE
+            steer = steer * self.steering_range
             if self.forbid_deceleration:
-                accel = MAX_METERS_PER_SEC_SQ * ((1 + accel) / 2)  # Positive only
+                accel = self.max_accel * ((1 + accel) / 2)  # Positive only
             else:
-                accel *= MAX_METERS_PER_SEC_SQ
-            brake = MAX_METERS_PER_SEC_SQ * ((1 + brake) / 2)  # Positive only
+                accel *= self.max_accel
+            brake = self.max_accel * ((1 + brake) / 2)  # Positive only
             brake = max(brake, 0)
         return steer, accel, brake
 
@@ -702,6 +787,74 @@ class Agent:
             is_blank=True,)
         return ret
 
+    def get_observation_schema(self) -> ObservationSchema:
+        """Layout of populate_observation's inputs, in the same order"""
+        ret = ObservationSchema()
+        ret.add('angles_ahead', max(2, self.num_angles_ahead), 'rad')
+        if self.is_intersection_map:
+            ret.add('waypoint_distance', 1, 'm')
+            ret.add('waypoint_distance_2', 1, 'm')
+            if self.polar_occupancy:
+                num_others = 0
+            elif self.max_observed_agents is None:
+                num_others = self.env.num_agents - 1
+            else:
+                num_others = self.max_observed_agents
+            for i in range(num_others):
+                prefix = f'other_agent_{i}_'
+                ret.add(prefix + 'relative_velocity', 2, 'm/s')
+                ret.add(prefix + 'velocity', 2, 'm/s')
+                ret.add(prefix + 'acceleration', 2, 'm/s^2')
+                # Angle and distance from our front to each of their corners
+                ret.add(prefix + 'corners', 8, 'rad, m')
+                if self.max_observed_agents is not None:
+                    # Zero for padding when fewer agents are around
+                    ret.add(prefix + 'valid', 1, 'bool')
+            ret.add('velocity', 2, 'm/s')
+            ret.add('acceleration', 2, 'm/s^2')
+        if self.env.add_static_obstacle:
+            ret.add('static_obstacle_distances', 2, 'm')
+            ret.add('static_obstacle_angles', 2, 'rad')
+        if self.polar_occupancy:
+            size = self.polar_sectors * self.polar_range_bins
+            ret.add('polar_occupancy_distance', size, 'm')
+            ret.add('polar_occupancy_closing_speed', size, 'm/s')
+        if self.lidar:
+            ret.add('lidar_distance', self.lidar_beams, 'm')
+            ret.add('lidar_hit_type', self.lidar_beams, 'LIDAR_HIT_*')
+        if self.raster:
+            # Channels then rows then columns
+            ret.add('raster', NUM_RASTER_CHANNELS * self.raster_size ** 2,
+                    'RASTER_ON where present')
+        ret.add('prev_steer', 1, 'rad')
+        ret.add('prev_throttle', 1, 'm/s^2')
+        ret.add('prev_brake', 1, 'm/s^2')
+        ret.add('speed', 1, 'm/s')
+        ret.add('left_lane_distance', 1, 'm')
+        ret.add('right_lane_distance', 1, 'm')
+        if self.incent_yield_to_oncoming_traffic:
+            ret.add('will_turn_across_opposing_lanes', 1, 'bool')
+        if self.history_length:
+            # Newest first, each capture laid out as history_indices
+            ret.add('history',
+                    self.history_length * len(self.get_history_indices(ret)))
+        return ret
+
+    def get_history_indices(self, schema=None) -> np.array:
+        """
+        :param schema: Observation schema without history, built if not given
+        :return: Indices of the observation inputs kept in history
+        """
+        if self.history_indices is None:
+            if schema is None:
+                schema = self.get_observation_schema()
+            names = self.history_fields or [f.name for f in schema
+                                            if f.name != 'history']
+            self.history_indices = np.concatenate(
+                [np.arange(schema.size)[schema.slice(name)]
+                 for name in names])
+        return self.history_indices
+
     def populate_observation(self, closest_map_point, lane_deviation,
                              angles_ahead, steer, brake, accel, harmful_gs,
                              jarring_gs, uncomfortable_gs,
@@ -710,12 +863,14 @@ class Agent:
         if is_blank:
             self.set_distance()
 
+        # Arrays concatenated once at the end, so sensor grids are never
+        # Python lists
         inputs = []
 
         if len(angles_ahead) == 1:
-            inputs += [angles_ahead[0], angles_ahead[0]]
+            inputs.append([angles_ahead[0], angles_ahead[0]])
         else:
-            inputs += angles_ahead
+            inputs.append(angles_ahead)
 
         if self.is_intersection_map:
             # TODO: Move get_intersection_observation here
@@ -724,16 +879,26 @@ class Agent:
             # frequently, but this just leads to zero gradients on those weights and zero
             # learning rates via Adam - see play/mlp.py - so we should be able
             # to pass zero for inputs a all or a lot of the time with no problems.
-            inputs.append(self.waypoint_distances[0])
-            inputs.append(np.sum(self.waypoint_distances[:2]))
-            inputs += self.get_other_agent_inputs(is_blank)
-            inputs += list(self.velocity)
-            inputs += list(self.acceleration)
+            inputs.append([self.waypoint_distances[0],
+                           np.sum(self.waypoint_distances[:2])])
+            if not self.polar_occupancy:
+                inputs.append(self.get_other_agent_inputs(is_blank))
+            inputs.append(self.velocity)
+            inputs.append(self.acceleration)
             # if self.agent_index == 0:
             #     log.debug(inputsa)
 
         if self.env.add_static_obstacle:
-            inputs += self.get_static_obstacle_inputs(is_blank)
+            inputs.append(self.get_static_obstacle_inputs(is_blank))
+
+        if self.polar_occupancy:
+            inputs.append(self.get_polar_occupancy_inputs(is_blank))
+
+        if self.lidar:
+            inputs.append(self.get_lidar_inputs(is_blank))
+
+        if self.raster:
+            inputs.append(self.get_raster_inputs(is_blank))
 
         # if self.agent_index == 0:
         #     log.debug(
@@ -750,12 +915,12 @@ class Agent:
         #         # f'agents {other_agent_inputs}\n'
         #     )
 
-        # TODO: These model inputs should be recorded somehow so we can
-        #   use the trained models later on without needing this code.
+        # Inputs are described by get_observation_schema, so update it
+        #   along with any change here.
 
         # TODO: Normalize these and ensure they don't exceed reasonable
         #   physical bounds
-        inputs += [
+        inputs.append([
             # Previous outputs (TODO: Remove for recurrent models like r2d1 / lstm / gtrxl? Deepmind R2D2 does input prev action to LSTM.)
             # self.prev_desired_steer,
             # self.prev_desired_accel,
@@ -772,11 +937,16 @@ class Agent:
             # self.distance_to_end,
             left_lane_distance,
             right_lane_distance,
-        ]
+        ])
 
         if self.incent_yield_to_oncoming_traffic:
-            inputs.append(float(self.will_turn_across_opposing_lanes))
+            inputs.append([float(self.will_turn_across_opposing_lanes)])
 
+        inputs = np.concatenate(inputs).astype(self.dtype, copy=False)
+
+        if self.history_length:
+            return np.concatenate(
+                (inputs, self.get_history_inputs(inputs, is_blank)))
 
         # if is_blank:
         #     common_inputs = np.array(common_inputs) * 0
@@ -785,7 +955,7 @@ class Agent:
 
         # return np.array([angles_ahead[0], self.prev_steer])
 
-        return np.array(inputs)
+        return inputs
 
         # if self.is_one_waypoint_map:
         #     if self.match_angle_only:
@@ -811,20 +981,7 @@ class Agent:
         #     observation = np.array(observation.values())
         #     observation = np.concatenate((observation, angles_ahead),
         #                                  axis=None)
-        #
-        #     if self.should_add_previous_states:
-        #         if self.experience_buffer.size() == 0:
-        #             self.experience_buffer.setup(shape=(len(observation),))
-        #         if is_blank:
-        #             past_values = np.concatenate(np.array(
-        #                 self.experience_buffer.blank_buffer), axis=0)
-        #         else:
-        #             self.experience_buffer.maybe_add(
-        #                 observation, self.env.total_episode_time)
-        #             past_values = np.concatenate(np.array(
-        #                 self.experience_buffer.buffer), axis=0)
-        #         observation = np.concatenate((observation, past_values),
-        #                                      axis=None)
+
         #     if math.nan in observation:
         #         raise RuntimeError(f'Found NaN in observation')
         #     if np.nan in observation:
@@ -839,35 +996,99 @@ class Agent:
         #  use attention as the number of agents can be variable in length and
         #  may exceed the amount of input we want to pass to the net.
         #  Also could do max-pool like OpenAI V
-        ret = []
-        v = self.velocity
-        ang = self.get_angle_to_point
-        dst = np.linalg.norm
-        f = self.front_pos
-
-        # TODO: These should be sorted by time to collision TTC where
-        #   TTC is approximated by assuming vehicles immediately change
-        #   direction towards each other at current velocity.
-
-        for i in range(self.env.num_agents):
-            if i == self.agent_index:
-                continue
-            if is_blank:
-                agent = self
-            else:
-                agent = self.env.all_agents[i]
-            ret += list(agent.velocity - v)  # ego relative velocity
-            ret += list(agent.velocity)
-            ret += list(agent.acceleration)
-            for p in agent.ego_rect:
-                ret.append(ang(p))
-                ret.append(dst(p - f))
 
+        if self.max_observed_agents is not None:
+            return self.get_observed_agent_inputs(is_blank)
+
+        others = [i for i in range(self.env.num_agents)
+                  if i != self.agent_index]
         if is_blank:
-            ret = list(np.array(ret) * 0)
+            ret = np.zeros(len(others) * NUM_PAIRWISE_FEATURES)
+        else:
+            ret = self.env.get_ego_geometry(self.route_index, others).ravel()
+        self.other_agent_inputs = ret
+        return ret
+
+    def get_observed_agent_inputs(self, is_blank=False):
+        """
+        Other agent inputs for the max_observed_agents most relevant other
+        vehicles per observed_agent_order, each followed by a validity flag
+        """
+        ret = np.zeros((self.max_observed_agents, NUM_PAIRWISE_FEATURES + 1))
+        if not is_blank:
+            observed = self.env.get_observed_agents(
+                self.route_index, self.max_observed_agents,
+                self.observed_agent_order)
+            observed = observed[observed >= 0]
+            num_observed = len(observed)
+            if num_observed:
+                ret[:num_observed, :-1] = self.env.get_ego_geometry(
+                    self.route_index, observed)
+                ret[:num_observed, -1] = 1
+        ret = ret.ravel()
         self.other_agent_inputs = ret
         return ret
 
+    def get_polar_occupancy_inputs(self, is_blank=False):
+        """
+        Distance and closing speed grids, each polar_sectors x
+        polar_range_bins, see polar_occupancy.py. Blank observations see
+        nothing, i.e. polar_max_range everywhere.
+        """
+        if is_blank:
+            ret = np.zeros((NUM_OCCUPANCY_CHANNELS, self.polar_sectors,
+                            self.polar_range_bins))
+            ret[OCCUPANCY_DISTANCE] = self.polar_max_range
+        else:
+            ret = self.env.get_polar_occupancy(
+                [self.route_index], self.polar_sectors, self.polar_range_bins,
+                self.polar_max_range)[0]
+        return ret.ravel()
+
+    def get_lidar_inputs(self, is_blank=False):
+        """
+        Distance and hit type per beam, see lidar.py. Blank observations hit
+        nothing.
+        """
+        if is_blank:
+            distances = np.full(self.lidar_beams, float(self.lidar_max_range))
+            hit_types = np.full(self.lidar_beams, LIDAR_HIT_NONE)
+        else:
+            distances, hit_types = self.env.cast_lidar(
+                [self.route_index], self.lidar_beams, self.lidar_fov,
+                self.lidar_max_range)
+            distances, hit_types = distances[0], hit_types[0]
+        return np.concatenate((distances, hit_types))
+
+    def get_history_inputs(self, inputs, is_blank=False):
+        """
+        Last history_length captures of inputs[history_indices], newest
+        first. Captures before the first are zeros, as are blank
+        observations.
+        """
+        indices = self.get_history_indices()
+        if self.experience_buffer.data is None:
+            self.experience_buffer.setup((len(indices),))
+        if is_blank:
+            return np.zeros(self.history_length * len(indices),
+                            dtype=self.dtype)
+        self.experience_buffer.maybe_add(inputs[indices],
+                                         self.total_episode_time)
+        return self.experience_buffer.get().ravel()
+
+    def get_raster_inputs(self, is_blank=False):
+        """
+        NUM_RASTER_CHANNELS x raster_size x raster_size image, see raster.py.
+        Blank observations are empty.
+        """
+        if is_blank:
+            ret = np.zeros(NUM_RASTER_CHANNELS * self.raster_size ** 2,
+                           dtype=np.uint8)
+        else:
+            ret = self.env.get_rasters([self.route_index], self.raster_size,
+                                       self.raster_m_per_px)[0]
+        return ret.ravel()
+
     def get_static_obstacle_inputs(self, is_blank=False):
         if not is_blank:
             start_static_obs = self.static_obstacle_points[0]
@@ -909,12 +1130,12 @@ class Agent:
         self.distance_traveled = 0
         self.prev_distance_along_route = None
         self.furthest_distance = 0
-        self.velocity = np.array((0, 0), dtype=np.float64)
+        self.velocity = np.array((0, 0), dtype=self.dtype)
         self.angular_velocity = 0
-        self.acceleration = np.array((0, 0), dtype=np.float64)
+        self.acceleration = np.array((0, 0), dtype=self.dtype)
         self.gforce = 0
         self.accel_magnitude = 0
-        self.jerk = 0
+        self.jerk = np.array((0, 0), dtype=self.dtype)
         self.jerk_magnitude = 0
         self.gforce_levels = self.blank_gforce_levels()
         self.max_gforce = 0
@@ -927,6 +1148,10 @@ class Agent:
         self.episode_gforces = []
         self.episode_jerks = []
         self.collided_with = []
+        self.num_trajectory_steps = 0
+        self.comfort[:] = 0
+        self.asleep = False
+        self.quiet_steps = 0
         self.done = False
         self.prev_throttle = 0
         self.prev_steer = 0
@@ -939,12 +1164,16 @@ class Agent:
         self.set_calculated_props()
 
         if self.experience_buffer is None:
-            self.experience_buffer = ExperienceBuffer()
+            self.experience_buffer = ExperienceBuffer(
+                step_seconds=self.history_seconds,
+                seconds_to_keep=(self.history_seconds *
+                                 (self.history_length or 1)),
+                dtype=self.dtype)
         self.experience_buffer.reset()
         self.state_buffer.clear()
-        self.rolling_velocity = np.array((0, 0), dtype=np.float64)
-        self.rolling_accel = np.array((0, 0), dtype=np.float64)
-        self.rolling_jerk = np.array((0, 0), dtype=np.float64)
+        self.rolling_velocity = np.array((0, 0), dtype=self.dtype)
+        self.rolling_accel = np.array((0, 0), dtype=self.dtype)
+        self.rolling_jerk = np.array((0, 0), dtype=self.dtype)
         self.rolling_velocity_magnitude = 0
         self.rolling_accel_magnitude = 0
         self.rolling_jerk_magnitude = 0
@@ -953,8 +1182,7 @@ class Agent:
         return obz
 
     def set_calculated_props(self):
-        self.ego_rect, self.ego_rect_tuple = get_rect(
-            self.x, self.y, self.angle, self.vehicle_width, self.vehicle_length)
+        self.set_pose_frame()
 
         self.ego_lines = get_lines_from_rect_points(self.ego_rect_tuple)
 
@@ -975,6 +1203,7 @@ class Agent:
         info.stats.done_only.backwards = 0
         info.stats.done_only.won = 0
 
+        gforce, _ = self.get_comfort_levels()
         if 'DISABLE_GAME_OVER' in os.environ:
             return done, won, lost
         elif collided:
@@ -982,7 +1211,7 @@ class Agent:
             info.stats.done_only.collided = 1
             done = True
             lost = True
-        elif self.gforce_threshold and self.gforce > self.gforce_threshold:
+        elif self.gforce_threshold and gforce > self.gforce_threshold:
             # Only end on g-force once we've learned to complete part of the trip.
             log.warning(f'Harmful g-forces, game over agent {self.agent_index}')
             info.done_only.harmful_gs = 1
@@ -1046,157 +1275,72 @@ class Agent:
         return done, won, lost
 
 
+    def get_reward_params(self) -> np.array:
+        """
+        Reward spec from our env config coefficients. Rebuild reward_params
+        with this after changing them.
+        """
+        return get_reward_params(
+            progress_coeff=self.speed_reward_coeff,
+            win_coeff=self.win_coefficient if self.incent_win else 0,
+            gforce_coeff=(0 if self.disable_gforce_penalty
+                          else self.gforce_penalty_coeff),
+            gforce_threshold=self.gforce_penalty_threshold,
+            collision_coeff=self.collision_penalty_coeff,
+            jerk_coeff=self.jerk_penalty_coeff,
+            lane_coeff=self.lane_penalty_coeff,
+            lane_margin=self.lane_margin)
+
     def get_reward(self, won: bool, lost: bool,
                    collided: bool, info: Box, steer: float,
                    accel: float, left_lane_distance: float,
                    right_lane_distance: float) -> Tuple[float, Box]:
-
+        """
+        Reward per reward.py, with its per term breakdown left in
+        reward_terms and info.stats.reward_terms, ordered as REWARD_TERMS
+        """
         angle_diff = abs(self.angles_ahead[0])
-
-        if 'STRAIGHT_TEST' in os.environ:
-            angle_reward = 0
-        else:
-            angle_reward = 4 * pi - angle_diff
-
         angle_accuracy = 1 - angle_diff / (2 * pi)
-        if self.agent_index == 0:
-            # log.debug(f'angle accuracy {angle_accuracy}')
-            pass
 
-        speed_reward = self.get_progress_reward()
-        if (self.incent_yield_to_oncoming_traffic and
-                self.will_turn_across_opposing_lanes and
-                self.upcoming_opposing_lane_agents()):
-            # Even if other agent is turning across as well, and so won't
-            # intersect (i.e. both agents turning left in right hand traffic)
-            # we should be cautious while making the left.
-            # Once the other agent has passed, we get distance
-            # reward for the turn which should incent being less cautious
-            # when no other agent is approaching.
-            speed_reward = -abs(speed_reward)
-            # log.info('TURNING ACROSS')
-
-        # TODO: Idea penalize residuals of a quadratic regression fit to history
-        #  of actions. Currently penalizing jerk instead which may or may not
-        #  be better (but it is simpler).
-        if 'ACTION_PENALTY' in os.environ:
-            action_penalty = float(os.environ['ACTION_PENALTY'])
-            steer_penalty = abs(self.prev_steer - steer) * action_penalty
-            accel_penalty = abs(self.prev_throttle - accel) * action_penalty
-        else:
-            steer_penalty = 0
-            accel_penalty = 0
-
-
-        gforce_penalty = 0
-        if not self.disable_gforce_penalty and self.gforce > 0.05:
-            # Note that it's useful to give a low or no g-force penalty
-            # at first, then to scale it up once waypoints are being reached.
-            gforce_penalty = self.gforce_penalty_coeff * self.gforce
-
-        jerk_magnitude = np.linalg.norm(self.jerk)
+        gforce, jerk_magnitude = self.get_comfort_levels()
         info.stats.jerk = jerk_magnitude
-        jerk_penalty = self.jerk_penalty_coeff * jerk_magnitude
         self.jerk_magnitude = jerk_magnitude
 
-        # lane_penalty = 0
-        # if left_lane_distance < 0.7:
-        #     lane_penalty += (left_lane_distance + 1)**2
-        # if right_lane_distance < 0.7:
-        #     # yes both can happen if you're orthogonal to the lane
-        #     lane_penalty += (right_lane_distance + 1)**2
-        # lane_penalty *= self.lane_penalty_coeff
-
-        # """
-        # lane_penalty = 0
-        # if left_lane_distance < 0.7:
-        #     lane_penalty += (left_lane_distance + 1)**2
-        # if right_lane_distance < 0.7:
-        #     # yes both can happen if you're orthogonal to the lane
-        #     lane_penalty += (right_lane_distance + 1)**2
-        # lane_penalty *= self.lane_penalty_coeff
-        # """
-        lane_penalty = 0
-        lane_margin = self.lane_margin  # Consider increasing outside intersection
-        left_lane_margin_dist = left_lane_distance - lane_margin
-        if left_lane_margin_dist < 0:
-            lane_penalty += abs(left_lane_margin_dist)
-        right_lane_margin_dist = right_lane_distance - lane_margin
-        if right_lane_margin_dist < 0:
-            # yes both can happen if you're orthogonal to the lane
-            lane_penalty += abs(right_lane_margin_dist)
-        lane_penalty *= self.lane_penalty_coeff
-
-        # if self.agent_index == 0:
-        #     log.debug(f'lane penalty {lane_penalty} {lane_penalty2}')
-
-        # if self.agent_index == 1:
-        #     log.info(f'left distance {left_lane_distance} '
-        #              f'right distance {right_lane_distance} '
-        #              f'agent {self.agent_index}')
+        inputs = self.reward_inputs[0]
+        inputs[REWARD_IN_PROGRESS] = (self.distance_along_route -
+                                      self.prev_distance_along_route)
+        # Even if the other agent is turning across as well, and so won't
+        # intersect (i.e. both agents turning left in right hand traffic)
+        # we should be cautious while making the left.
+        inputs[REWARD_IN_YIELD] = (self.incent_yield_to_oncoming_traffic and
+                                   self.will_turn_across_opposing_lanes and
+                                   self.upcoming_opposing_lane_agents())
+        inputs[REWARD_IN_WON] = won
+        inputs[REWARD_IN_COLLIDED] = collided
+        inputs[REWARD_IN_GFORCE] = gforce
+        inputs[REWARD_IN_JERK] = jerk_magnitude
+        inputs[REWARD_IN_LEFT_LANE_DISTANCE] = left_lane_distance
+        inputs[REWARD_IN_RIGHT_LANE_DISTANCE] = right_lane_distance
+        totals, terms = compute_rewards(self.reward_inputs,
+                                        self.reward_params)
+        self.reward_terms = terms[0]
+        info.stats.reward_terms = self.reward_terms
 
         self.accel_magnitude = self.gforce * G_ACCEL
-
-        # log.debug(f'jerk {round(jerk_magnitude)} accel {round(accel_magnitude)}')
-
         self.angle_accuracies.append(angle_accuracy)
         info.stats.angle_accuracy = angle_accuracy
 
-        if collided:
-            # TODO: Make dependent on |Δv|
-            collision_penalty = self.collision_penalty_coeff
-        else:
-            collision_penalty = 0
-
-        win_reward = self.get_win_reward(won)
-        ret = (
-           + speed_reward
-           + win_reward
-           - gforce_penalty
-           - collision_penalty
-           - jerk_penalty
-           - lane_penalty
-        )
-
         # IDEA: Induce curriculum by zeroing things like static obstacle
         # until we've learned to steer smoothly. Alternatively, we could
         # train with the full complexity, then fine-tune to improve
         # smoothness.
 
-        # if self.agent_index == 0:
-        #     log.debug(
-        #         f'reward {ret} '
-        #         # f'next waypoint {self.next_map_index} '
-        #         f'distance {self.distance_along_route} '
-        #         # f'rew/dist {round(ret/(self.distance - self.prev_distance),3)} '
-        #         f'speed {speed_reward} '
-        #         f'gforce {accel_penalty} '
-        #         f'jerk {jerk_penalty} '
-        #         f'lane {lane_penalty} '
-        #         f'win {win_reward} '
-        #         f'angle_accuracy {angle_accuracy} '
-        #         # f'collision {collision_penalty} '
-        #         # f'steer {steer_penalty} '
-        #         # f'accel {accel_penalty} '
-        #     )
-
-        return ret, info
-
-    def get_progress_reward(self):
-        frame_distance = self.distance_along_route - self.prev_distance_along_route
-        speed_reward = frame_distance * self.speed_reward_coeff
-        return speed_reward
-
-    def get_win_reward(self, won):
-        win_reward = 0
-        if self.incent_win and won:
-            win_reward = self.win_coefficient
-        return win_reward
+        return totals[0], info
 
     def get_observation(self, steer, accel, brake, info):
 
         closest_map_point, closest_map_index, closest_waypoint_distance = \
-            get_closest_point((self.front_x, self.front_y), self.map_kd_tree)
+            get_closest_point((self.front_x, self.front_y), self.map.waypoints)
 
         self.closest_waypoint_distance = closest_waypoint_distance
         self.closest_map_index = closest_map_index
@@ -1481,17 +1625,14 @@ class Agent:
         but we may want to bring it back as we are able to achieve more complex
         behavior.
         """
-        distances = self.map.distances
-
-        return get_angles_ahead(total_points=len(distances),
-                                route_length=self.map.route_length,
-                                speed=self.speed,
-                                map_points=self.map.waypoints,
-                                ego_angle=self.angle,
-                                seconds_ahead=self.map_query_seconds_ahead,
-                                closest_map_index=closest_map_index,
-                                heading=self.heading,
-                                ego_front=self.ego_pos)
+        return list(get_angles_ahead(
+            points=self.map.waypoints,
+            arc_lengths=self.map.distances,
+            distance_along_route=self.map.distances[closest_map_index],
+            speed=self.speed,
+            seconds_ahead=self.map_query_seconds_ahead,
+            heading=self.heading,
+            ego_front=self.ego_pos))
 
     def get_one_waypoint_angle_ahead(self):
         waypoint = np.array((self.map.x[-1], self.map.y[-1]))
@@ -1548,7 +1689,7 @@ class Agent:
             # [wp2dist, 0] => after waypoint 1, before waypoint 2
             # Also, for multi-agent, we need the max number of waypoints for
             # all agents which is why self.env.agents must be set
-            max_waypoints = max(len(a.map.waypoints) for a in self.env.agents)  # TODO: Avoid recalculating this - do it on last agent map gen or create env map gen
+            max_waypoints = self.env.map_store.max_num_points()
             waypoint_distances = np.zeros((max_waypoints - 1,))
             next_index = self.next_map_index
             for i in range(len(self.map.waypoints) - next_index):
@@ -1568,41 +1709,35 @@ class Agent:
         if self.prev_distance_along_route is None:
             # Init prev distance
             self.prev_distance_along_route = self.distance_along_route
+        self.env.invalidate_crossing_conflicts()
 
     def gen_map(self):
-        # TODO: Move map to env.py. Right now the map is really just a couple
-        #   of waypoints, so it's fine to duplicate it for each agent.
+        if self.env.scenario_bank is None:
+            map_params = self.sample_map_params()
+        else:
+            self.scenario_id, map_params = \
+                self.env.get_next_scenario(self.route_index)
 
         lane_width = 10 * 0.3048
         # Generate one waypoint map
         if self.is_one_waypoint_map:
-            x_norm, y_norm = self.gen_one_waypoint_map()
+            x_norm, y_norm = self.gen_one_waypoint_map(map_params)
             x_pixels = x_norm * MAP_WIDTH_PX + SCREEN_MARGIN
             y_pixels = y_norm * MAP_HEIGHT_PX + SCREEN_MARGIN
             x_meters = x_pixels / self.px_per_m
             y_meters = y_pixels / self.px_per_m
         elif self.is_intersection_map:
             x_meters, y_meters, lane_width, lane_lines = \
-                self.gen_intersection_map()
+                self.gen_intersection_map(map_params)
             x_pixels = x_meters * self.px_per_m
             y_pixels = y_meters * self.px_per_m
         else:
             raise NotImplementedError()
 
-        waypoints = list(zip(list(x_meters), list(y_meters)))
-
-        distances = np.cumsum(np.linalg.norm(np.diff(waypoints, axis=0), axis=1))
-        distances = np.concatenate((np.array([0]), distances))
-
-        self.map = Box(x=x_meters,
-                       y=y_meters,
-                       x_pixels=x_pixels,
-                       y_pixels=y_pixels,
-                       waypoints=waypoints,
-                       distances=distances,
-                       route_length=distances[-1],
-                       static_obst_pixels=self.static_obst_pixels,
-                       lane_width=lane_width)
+        self.map = self.env.map_store.set_route(
+            self.route_index, x_meters, y_meters, lane_width,
+            x_pixels=x_pixels, y_pixels=y_pixels,
+            static_obst_pixels=self.static_obst_pixels)
 
         self.x = self.map.x[0]
         self.y = self.map.y[0]
@@ -1612,9 +1747,6 @@ class Agent:
 
         # Physics properties
         # x is right, y is straight
-        self.map_kd_tree = spatial.KDTree(self.map.waypoints)
-
-        self.map_flat = flatten_points(self.map.waypoints)
         if self.is_one_waypoint_map:
             self.angle = -pi / 2
         elif self.is_intersection_map:
@@ -1630,8 +1762,27 @@ class Agent:
             # self.angle = self.get_start_angle()
 
         self.start_angle = self.angle
+        self.env.invalidate_conflict_zones()
+
+    def sample_map_params(self):
+        """
+        Unit uniform draws consumed by gen_map, see scenario_bank.py for
+        pre-sampling these.
+        """
+        ret = np.zeros(NUM_MAP_PARAMS)
+        if self.is_one_waypoint_map:
+            if not self.static_map:
+                ret[0] = np_rand()
+                ret[1] = np_rand()
+            if self.add_static_obstacle:
+                ret[2] = np_rand()
+                ret[3] = np_rand()
+                ret[4] = np_rand()
+        elif self.is_intersection_map:
+            ret[0] = random.random()
+        return ret
 
-    def gen_one_waypoint_map(self):
+    def gen_one_waypoint_map(self, map_params):
         m = self.max_one_waypoint_mult
         x1 = 0.1
         y1 = 0.5
@@ -1639,13 +1790,13 @@ class Agent:
             x2 = x1 + 0.2 * m + 0.1
             y2 = y1 + (2 * 0.2 - 1) * m
         else:
-            x2 = x1 + np_rand() * m + 0.1
-            y2 = y1 + (2 * np_rand() - 1) * m
+            x2 = x1 + map_params[0] * m + 0.1
+            y2 = y1 + (2 * map_params[1] - 1) * m
         x = np.array([x1, x2])
         y = np.array([y1, y2])
         if self.add_static_obstacle:
             _, self.static_obst_pixels = \
-                get_static_obst(m, x, y)
+                get_static_obst(m, x, y, rand=map_params[2:5])
 
             # Need to work backward from pixels to incorporate
             # screen margin offset
@@ -1656,7 +1807,7 @@ class Agent:
                 map(tuple, self.static_obstacle_points.tolist()))
         return x, y
 
-    def gen_intersection_map(self):
+    def gen_intersection_map(self, map_params):
         lines, lane_width = get_intersection()
         self.intersection = (lines, lane_width)
         left_vert, mid_vert, right_vert, top_horiz, mid_horiz, bottom_horiz = \
@@ -1665,12 +1816,13 @@ class Agent:
         # Get waypoints
         wps = []
         if self.agent_index == 0:
-            wps.append((27.0770290995851, random.uniform(6, 18)))
+            wps.append((27.0770290995851, 6 + 12 * map_params[0]))
             wps.append((mid_vert[0][0] + lane_width / 2, bottom_horiz[0][1]))
             wps.append((left_vert[0][0], mid_horiz[0][1] + lane_width / 2))
             wps.append((1.840549443086846, mid_horiz[0][1] + lane_width / 2))
         elif self.agent_index == 1:
-            wps.append((mid_vert[0][0] - lane_width / 2, random.uniform(33, 47)))
+            wps.append((mid_vert[0][0] - lane_width / 2,
+                        33 + 14 * map_params[0]))
             # wps.append((mid_vert[0][0] - lane_width / 2, 30.139197872452702))
             # wps.append((mid_vert[0][0] - lane_width / 2, 15.139197872452702))
             wps.append((mid_vert[0][0] - lane_width / 2, 4.139197872452702))
@@ -1681,8 +1833,8 @@ class Agent:
 
         return x, y, lane_width, lines
 
-    def step_physics(self, steer, accel, brake, info, interpolation_steps,
-                     start_interpolation_index):
+    def step_physics(self, steer, accel, brake, info):
+        interpolation_steps = self.physics_steps_per_observation
         dt = self.dt
         start = time.time()
         self.prev_speed = self.speed
@@ -1690,8 +1842,16 @@ class Agent:
         self.prev_y = self.y
         self.prev_angle = self.angle
 
-        self.update_physics(steer, accel, brake, interpolation_steps,
-                            start_interpolation_index)
+        if self.should_sleep(steer, accel, brake):
+            self.hold_physics(interpolation_steps)
+        elif self.low_detail_physics:
+            # Same simulated time in fewer, longer substeps
+            self.update_physics(
+                steer, accel, brake, self.lod_physics_steps,
+                dt=dt * interpolation_steps / self.lod_physics_steps)
+        else:
+            self.update_physics(steer, accel, brake, interpolation_steps)
+        info.stats.asleep = self.asleep
 
         # self.compute_rolling_state()
 
@@ -1704,15 +1864,90 @@ class Agent:
         self.env.total_episode_time += dt * interpolation_steps
 
 
-        self.ego_rect, self.ego_rect_tuple = get_rect(
-            self.x, self.y, self.angle, self.vehicle_width, self.vehicle_length)
+        self.set_pose_frame()
+
+        info.stats.gforce_max = self.comfort[COMFORT_GFORCE_MAX]
+        info.stats.jerk_max = self.comfort[COMFORT_JERK_MAX]
 
-        if self.physics_interpolation_state.ready():
+        if self.comfort_metric == 'last':
             self.episode_gforces.append(self.gforce)
             self.episode_jerks.append(self.jerk_magnitude)
+        else:
+            # Observations are equal length, so averaging these gives the
+            # mean over every substep in the episode
+            self.episode_gforces.append(self.comfort[COMFORT_GFORCE_MEAN])
+            self.episode_jerks.append(self.comfort[COMFORT_JERK_MEAN])
+
+    def should_sleep(self, steer, accel, brake) -> bool:
+        """
+        Sleep once we've been stopped with no throttle and unchanged controls
+        for SLEEP_AFTER_STEPS steps. Any control change or collision wakes us.
+        """
+        quiet = (self.sleep_stationary and
+                 not self.collided_with and
+                 abs(self.speed) < SLEEP_SPEED and
+                 abs(self.angle_change) < SLEEP_ANGLE_CHANGE and
+                 abs(accel) < SLEEP_CONTROL_DELTA and
+                 abs(accel - self.prev_throttle) < SLEEP_CONTROL_DELTA and
+                 abs(steer - self.prev_steer) < SLEEP_CONTROL_DELTA and
+                 abs(brake - self.prev_brake) < SLEEP_CONTROL_DELTA)
+        self.quiet_steps = self.quiet_steps + 1 if quiet else 0
+        self.asleep = self.quiet_steps > SLEEP_AFTER_STEPS
+        return self.asleep
+
+    def hold_physics(self, interpolation_steps):
+        """Physics step for sleeping agents, i.e. stay put"""
+        self.speed = 0
+        self.angle_change = 0
+        self.velocity = np.zeros_like(self.velocity)
+        self.acceleration = np.zeros_like(self.acceleration)
+        self.jerk = np.zeros_like(self.jerk)
+        self.angular_velocity = 0
+        self.gforce = 0
+        self.comfort[:] = 0
+        if self.record_trajectory:
+            self.trajectory[:interpolation_steps] = (
+                self.x, self.y, self.angle, self.speed)
+            self.num_trajectory_steps = interpolation_steps
+
+    def get_comfort_levels(self) -> Tuple[float, float]:
+        """:return: g-force and jerk magnitude per comfort_metric"""
+        if self.comfort_metric == 'mean':
+            return (self.comfort[COMFORT_GFORCE_MEAN],
+                    self.comfort[COMFORT_JERK_MEAN])
+        elif self.comfort_metric == 'max':
+            return (self.comfort[COMFORT_GFORCE_MAX],
+                    self.comfort[COMFORT_JERK_MAX])
+        return self.gforce, np.linalg.norm(self.jerk)
+
+    def set_pose_frame(self):
+        """
+        Front, back, heading and corners for the current pose, see
+        pose_frame.py. Call whenever x, y or angle change.
+        """
+        frame = get_pose_frame(
+            float(self.x), float(self.y), float(self.angle),
+            float(self.vehicle_width), float(self.vehicle_length))
+        self.set_pose_attributes(frame)
+        # Numba likes tuples
+        self.ego_rect_tuple = tuple(map(tuple, self.ego_rect.tolist()))
+
+    def set_pose_attributes(self, frame):
+        """Frame stays float64 like other kernel inputs, ego_rect is dtype"""
+        self.pose_frame = frame
+        self.env.invalidate_agent_arrays()
+        if frame is None:
+            return
+        self.front_pos = frame[POSE_FRONT:POSE_FRONT + 2]
+        self.front_x, self.front_y = self.front_pos.tolist()
+        self.back_x, self.back_y = frame[POSE_BACK:POSE_BACK + 2].tolist()
+        self.heading = frame[POSE_HEADING:POSE_HEADING + 2]
+        self.ego_rect = frame[POSE_RECT:].reshape(4, 2)
+        if self.dtype != np.float64:
+            self.ego_rect = self.ego_rect.astype(self.dtype)
 
     def update_physics(self, steer, throttle, brake, interpolation_steps,
-                       start_interpolation_index=0):
+                       dt=None):
         (self.acceleration,
          self.angle,
          self.angle_change,
@@ -1733,19 +1968,20 @@ class Agent:
             add_longitudinal_friction=self.add_longitudinal_friction,
             add_rotational_friction=self.add_rotational_friction,
             brake=brake,
-            curr_acceleration=self.acceleration,
-            jerk=self.jerk,
-            curr_angle=self.angle,
-            curr_angle_change=self.angle_change,
-            curr_angular_velocity=self.angular_velocity,
-            curr_gforce=self.gforce,
+            # Kernels work in float64, see cast_physics_state
+            curr_acceleration=np.asarray(self.acceleration, dtype=np.float64),
+            jerk=np.asarray(self.jerk, dtype=np.float64),
+            curr_angle=float(self.angle),
+            curr_angle_change=float(self.angle_change),
+            curr_angular_velocity=float(self.angular_velocity),
+            curr_gforce=float(self.gforce),
             curr_max_gforce=self.max_gforce,
             curr_max_jerk=self.max_jerk,
-            curr_speed=self.speed,
-            curr_velocity=self.velocity,
-            curr_x=self.x,
-            curr_y=self.y,
-            dt=self.dt,
+            curr_speed=float(self.speed),
+            curr_velocity=np.asarray(self.velocity, dtype=np.float64),
+            curr_x=float(self.x),
+            curr_y=float(self.y),
+            dt=dt or self.dt,
             interpolation_steps=interpolation_steps,
             prev_throttle=self.prev_throttle,
             prev_brake=self.prev_brake,
@@ -1757,17 +1993,41 @@ class Agent:
             max_steer_change=self.max_steer_change,
             max_throttle_change=self.max_accel_change,
             max_brake_change=self.max_brake_change,
-            distance_traveled=self.distance_traveled,
-            start_interpolation_index=start_interpolation_index,
-            interpolation_range=self.physics_steps_per_observation,)
-        if self.update_intermediate_physics:
-            self.physics_interpolation_state.update()
+            distance_traveled=float(self.distance_traveled),
+            start_interpolation_index=0,
+            interpolation_range=interpolation_steps,
+            integrator=self.integrator,
+            integrator_steps=self.integrator_steps,
+            trajectory_out=self.trajectory if self.record_trajectory else None,
+            comfort_out=self.comfort)
+        if self.record_trajectory:
+            self.num_trajectory_steps = interpolation_steps
+        if self.dtype != np.float64:
+            self.cast_physics_state()
 
         if max_gforce > self.max_gforce:
             # log.warning(f'New max g {max_gforce}')
             self.max_gforce = max_gforce
 
 
+    def cast_physics_state(self):
+        """
+        Store physics outputs as self.dtype. Kernels are always passed and
+        compute in float64, so they're only compiled once.
+        """
+        to_dtype = self.dtype.type
+        self.x = to_dtype(self.x)
+        self.y = to_dtype(self.y)
+        self.angle = to_dtype(self.angle)
+        self.angle_change = to_dtype(self.angle_change)
+        self.angular_velocity = to_dtype(self.angular_velocity)
+        self.speed = to_dtype(self.speed)
+        self.gforce = to_dtype(self.gforce)
+        self.distance_traveled = to_dtype(self.distance_traveled)
+        self.velocity = self.velocity.astype(self.dtype)
+        self.acceleration = self.acceleration.astype(self.dtype)
+        self.jerk = self.jerk.astype(self.dtype)
+
     def compute_rolling_state(self):
         self.state_buffer.append(
             ([self.x, self.y], self.velocity, self.acceleration))
@@ -1796,15 +2056,13 @@ class Agent:
             #     f'j: {round(self.rolling_jerk_magnitude, 2)} ')
 
     def upcoming_opposing_lane_agents(self) -> bool:
-        if (self.agent_index == 0 and
-                len(self.env.agents) > 1 and
-                self.env.agents[1].approaching_intersection):
-            # TODO: Make this more general when adding more agents,
-            #  larger maps, etc... i.e. approaching intersection will have to
-            #  identify some intersection id instead of just being a bool.
-            return True
-        else:
+        """
+        Whether any other agent has yet to enter a zone where its route
+        crosses ours and which we've yet to clear. Merges don't count.
+        """
+        if len(self.env.all_agents) < 2:
             return False
+        return bool(self.env.get_crossing_conflicts()[self.route_index])
 
     def convert_comfortable_actions(self, action):
         comfort_accel = 1  # Comfortable g-force is around 0.1 = 1 m/s**2
@@ -1949,29 +2207,47 @@ class Agent:
         throttle = 0.1
         return steer, throttle, brake
 
-    def get_angle_for_comfortable_turn(self):
-        # return get_angle_for_accel(
-        #     speed=self.speed,
-        #     vehicle_model=self.vehicle_model,
-        #     prev_angle_change=self.angle_change, aps=self.aps, angle=self.angle,
-        #     prev_accel=self.accel_magnitude)
-        # TODO: Automate this tuning with linear regression or analytically solve
-        #   with inverse kinematics for acceleration
-        return pi / (30 * max(self.speed, 1) ** 2)
-
-
-def get_closest_point(point, kd_tree):
-    distance, index = kd_tree.query(point)
-    if index >= kd_tree.n:
-        log.warning(f'kd tree index out of range, using last index. '
-                    f'point {point}\n'
-                    f'kd_tree: {json.dumps(kd_tree.data.tolist(), indent=2)}')
-        index = kd_tree.n - 1
-    point = kd_tree.data[index]
-    return point, index, distance
-
-
-def get_static_obst(m, x, y):
+    def get_angle_for_comfortable_turn(self, lateral_accel=1):
+        """
+        :param lateral_accel: m/s**2, comfortable is around 0.1g = 1 m/s**2
+        :return: Steering angle for a steady turn at lateral_accel at the
+            current speed, see steering_table.py
+        """
+        if self.steering_table is None:
+            self.steering_table = get_steering_table(self.vehicle_model,
+                                                     self.dt)
+        return get_steer_for_lateral_gforce(self.steering_table,
+                                            float(self.speed),
+                                            lateral_accel / G_ACCEL)
+
+
+def get_closest_point(point, points):
+    index, distance = _get_closest_point(points, point[0], point[1])
+    return points[index], index, distance
+
+
+@njit(cache=CACHE_NUMBA, nogil=True)
+def _get_closest_point(points, x, y):
+    # Linear scan beats building a KD-tree on every reset for our route sizes
+    closest_index = 0
+    closest_dist_sq = np.inf
+    for i in range(len(points)):
+        dx = points[i, 0] - x
+        dy = points[i, 1] - y
+        dist_sq = dx * dx + dy * dy
+        if dist_sq < closest_dist_sq:
+            closest_dist_sq = dist_sq
+            closest_index = i
+    return closest_index, np.sqrt(closest_dist_sq)
+
+
+def get_static_obst(m, x, y, rand=None):
+    """
+    :param rand: Unit uniform draws for obstacle center, angle and width,
+        sampled from np.random if None
+    """
+    if rand is None:
+        rand = np.random.rand(3)
     # Get point between here + 2 car lengths and destination
     # Draw random size / angle line
     # TODO: Allow circular obstacles using equation of circle and
@@ -1983,13 +2259,13 @@ def get_static_obst(m, x, y):
     y_dist = y[1] - y[0]
 
     total_dist = np.linalg.norm([x_dist, y_dist])
-    center_dist = np.random.rand() * total_dist * 0.6 + 0.1
+    center_dist = rand[0] * total_dist * 0.6 + 0.1
     theta = np.arctan(y_dist / x_dist)
     obst_center_x = cos(theta) * center_dist + x[0]
     obst_center_y = sin(theta) * center_dist + y[0]
 
-    obst_angle = np.random.rand() * pi
-    obst_width = np.random.rand() * 0.1 + 0.025
+    obst_angle = rand[1] * pi
+    obst_width = rand[2] * 0.1 + 0.025
     obst_end_x = obst_center_x + cos(obst_angle) * obst_width / 2
     obst_end_y = obst_center_y + sin(obst_angle) * obst_width / 2
     obst_beg_x = obst_center_x - cos(obst_angle) * obst_width / 2
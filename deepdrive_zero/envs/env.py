@@ -13,12 +13,30 @@ from gym import spaces
 import pyglet
 
 from deepdrive_zero.envs.agent import Agent
+from deepdrive_zero.map_gen import get_intersection
+from deepdrive_zero.map_store import MapStore
+from deepdrive_zero.normalization import Normalizer, get_clips
+from deepdrive_zero.observation_schema import ObservationSchema
+from deepdrive_zero.scenario_bank import ScenarioBank, \
+    SCENARIO_ORDER_SEQUENTIAL
+from deepdrive_zero.vehicles import compile_fleet
 from deepdrive_zero.physics.collision_detection import check_collision_ego_obj,\
     check_collision_agents
+from deepdrive_zero.physics.integrators import INTEGRATORS, \
+    MAX_PHYSICS_STEPS_PER_OBSERVATION
+from deepdrive_zero.physics.conflict_zones import get_conflict_zones, \
+    get_approaching_agents, get_crossing_conflicts
+from deepdrive_zero.physics.neighbors import build_grid, query_neighbors, \
+    NEIGHBOR_ORDER_TTC
+from deepdrive_zero.physics.pairwise_geometry import get_pairwise_geometry, \
+    get_ego_geometry
+from deepdrive_zero.sensors.lidar import cast_lidar, LIDAR_HIT_LANE, \
+    LIDAR_HIT_OBSTACLE
+from deepdrive_zero.sensors.polar_occupancy import get_polar_occupancy
+from deepdrive_zero.sensors.raster import rasterize_envs
 from deepdrive_zero.constants import USE_VOYAGE, MAP_WIDTH_PX, MAP_HEIGHT_PX, \
     SCREEN_MARGIN, VEHICLE_LENGTH, VEHICLE_WIDTH, PX_PER_M, \
-    MAX_METERS_PER_SEC_SQ, IS_DEBUG_MODE, GAME_OVER_PENALTY, FPS, \
-    PARTIAL_PHYSICS_STEP, COMPLETE_PHYSICS_STEP
+    MAX_METERS_PER_SEC_SQ, IS_DEBUG_MODE, GAME_OVER_PENALTY, FPS
 from deepdrive_zero.logs import log
 
 
@@ -60,6 +78,7 @@ class Deepdrive2DEnv(gym.Env):
             speed_reward_coeff=0.50,
             win_coefficient=1,
             gforce_threshold=1,
+            gforce_penalty_threshold=0.05,
             jerk_threshold=None,
             constrain_controls=False,
             ignore_brake=False,
@@ -73,6 +92,42 @@ class Deepdrive2DEnv(gym.Env):
             physics_steps_per_observation=physics_steps_per_observation,
             end_on_lane_violation=False,
             lane_margin=0,
+            scenario_bank_path=None,
+            scenario_order=SCENARIO_ORDER_SEQUENTIAL,
+            scenario_id=None,
+            integrator='euler',
+            integrator_steps=1,
+            dtype='float64',
+            record_trajectory=False,
+            comfort_metric='last',
+            sleep_stationary=False,
+            lod_distance=None,
+            lod_physics_steps=1,
+            vehicles=None,
+            max_observed_agents=None,
+            observed_agent_order='distance',
+            polar_occupancy=False,
+            polar_sectors=16,
+            polar_range_bins=4,
+            polar_max_range=40,
+            lidar=False,
+            lidar_beams=32,
+            lidar_fov=2 * np.pi,
+            lidar_max_range=50,
+            raster=False,
+            raster_size=64,
+            raster_m_per_px=0.5,
+            history_length=0,
+            history_seconds=0.25,
+            history_fields=None,
+            normalize_observations=False,
+            normalize_rewards=False,
+            normalization_clip=10,
+            normalization_field_clips=None,
+            normalization_gamma=0.99,
+            normalization_frozen=False,
+            normalization_deferred=False,
+            normalization_path=None,
         )
 
         # All units in SI units (meters and radians) unless otherwise specified
@@ -94,6 +149,7 @@ class Deepdrive2DEnv(gym.Env):
 
         self.fps: int = FPS
         self.target_dt: float = 1 / self.fps
+        self.dtype = np.dtype(np.float64)  # See dtype in env_config
 
         self.match_angle_only: bool = match_angle_only
         self.is_one_waypoint_map: bool = is_one_waypoint_map
@@ -122,6 +178,15 @@ class Deepdrive2DEnv(gym.Env):
 
         self.agent_index: int = 0  # Current agent we are stepping
         self.discrete_actions = None
+
+        # Named layout of observations, set in setup_spaces
+        self.observation_schema: ObservationSchema = None
+
+        # Running observation and reward normalization, None when disabled.
+        # Envs in a batch can share one, each with its own stream_offset into
+        # its per agent discounted returns.
+        self.normalizer: Normalizer = None
+        self.normalizer_stream_offset: int = 0
         self.being_played = being_played
         self.update_intermediate_physics = self.should_render or self.being_played
         self.render_choppy_but_realtime = False
@@ -141,7 +206,22 @@ class Deepdrive2DEnv(gym.Env):
         self.agents = None
         self.dummy_accel_agents = None
         self.all_agents = None  # agents + dummy_agents
+        self.last_stepped_agent: Agent = None
+        self.render_substep: int = None  # Trajectory row being rendered
+        self.num_sleeping_agents: int = 0  # As of the last step
+
+        # Dummy agents further than this many meters from all learning agents
+        # use lod_physics_steps substeps per observation. None to disable.
+        self.lod_distance: float = None
+        self.map_store: MapStore = None  # Route geometry for all_agents
+        self.vehicle_params: np.array = None  # Per route, see vehicles.py
+        self.scenario_bank: ScenarioBank = None
+        self.scenario: tuple = None  # (id, params) shared by all_agents
+        self.scenario_routes: set = set()  # Routes that have started scenario
         self.last_step_output = None
+        self.conflict_zones: np.array = None  # Recomputed when routes change
+        self.crossing_conflicts: np.array = None  # Cleared when agents move
+        self.agent_arrays: dict = None  # Cleared when any agent moves
         # End env state --------------------------------------------------------
 
     def get_state(self):
@@ -181,6 +261,42 @@ class Deepdrive2DEnv(gym.Env):
         # constructor. # TODO: Move to an agent section of the config.
         agent_params = signature(Agent).parameters.keys()
         agent_config = {k: v for k,v in self.env_config.items() if k in agent_params}
+
+        integrator = env_config['integrator']
+        if integrator not in INTEGRATORS:
+            raise ValueError(f'Unknown integrator {integrator}, expected one '
+                             f'of {tuple(INTEGRATORS)}')
+        max_pso = MAX_PHYSICS_STEPS_PER_OBSERVATION.get(integrator)
+        pso = env_config['physics_steps_per_observation']
+        if max_pso is not None and pso > max_pso:
+            raise ValueError(
+                f'{integrator} integrator is only tested to match Euler for '
+                f'up to {max_pso} physics_steps_per_observation, got {pso}')
+
+        dummies = self.env_config['dummy_accel_agent_indices']
+        if dummies is not None:
+            self.dummy_accel_agent_indices = dummies
+
+        # Agents generate their maps on construction, so create store first
+        num_routes = self.num_agents + len(self.dummy_accel_agent_indices)
+        self.map_store = MapStore(num_routes=num_routes,
+                                  px_per_m=self.px_per_m)
+        self.vehicle_params = compile_fleet(env_config['vehicles'], num_routes)
+
+        if env_config['scenario_bank_path'] is not None:
+            self.scenario_bank = ScenarioBank(
+                env_config['scenario_bank_path'],
+                order=env_config['scenario_order'],
+                scenario_id=env_config['scenario_id'],
+                seed=self.seed_value)
+            if self.scenario_bank.num_routes < num_routes:
+                raise ValueError(
+                    f'Scenario bank has {self.scenario_bank.num_routes} '
+                    f'routes per scenario, need {num_routes}')
+
+        self.scenario = None
+        self.scenario_routes = set()
+
         self.agents: List[Agent] = [Agent(
                 env=self,
                 agent_index=i,
@@ -188,21 +304,23 @@ class Deepdrive2DEnv(gym.Env):
                 **agent_config)
             for i in range(self.num_agents)]
 
-        dummies = self.env_config['dummy_accel_agent_indices']
-        if dummies is not None:
-            self.dummy_accel_agent_indices = dummies
-
         self.dummy_accel_agents: List[Agent] = [Agent(
                 env=self,
                 agent_index=i,
+                route_index=self.num_agents + j,
                 disable_gforce_penalty=self.disable_gforce_penalty,
                 **agent_config)
-            for i in self.dummy_accel_agent_indices]
+            for j, i in enumerate(self.dummy_accel_agent_indices)]
 
         self.all_agents = self.agents + self.dummy_accel_agents
+        # Agents reset on construction, so reset() below starts the same
+        # scenario rather than skipping it
+        self.scenario_routes = set()
         self.num_agents = len(self.agents)
         self.discrete_actions = self.env_config['discrete_actions']
+        self.dtype = np.dtype(self.env_config['dtype'])
         self.physics_steps_per_observation = env_config['physics_steps_per_observation']
+        self.lod_distance = env_config['lod_distance']
 
         if '--no-timeout' in sys.argv:
             max_seconds = 100000
@@ -220,6 +338,7 @@ class Deepdrive2DEnv(gym.Env):
 
         self.reset()
         self.setup_spaces()
+        self.setup_normalizer()
 
     def _set_config(self, env_config):
         name_col_len = 45
@@ -251,7 +370,55 @@ class Deepdrive2DEnv(gym.Env):
             # TODO: Set steering limits as well
             self.action_space = spaces.Box(low=-10.2, high=10.2, shape=(agent.num_actions,))
         blank_obz = agent.get_blank_observation()
-        self.observation_space = spaces.Box(low=-np.inf, high=np.inf, shape=(len(blank_obz),))
+        self.observation_space = spaces.Box(low=-np.inf, high=np.inf,
+                                            shape=(len(blank_obz),),
+                                            dtype=self.dtype)
+        self.observation_schema = agent.get_observation_schema()
+        if len(self.observation_schema) != len(blank_obz):
+            raise RuntimeError(
+                f'Observation schema has {len(self.observation_schema)} '
+                f'inputs but observations have {len(blank_obz)}, update '
+                f'Agent.get_observation_schema')
+
+    def setup_normalizer(self):
+        config = self.env_config
+        if not (config['normalize_observations'] or
+                config['normalize_rewards']):
+            self.normalizer = None
+            return
+        clips = get_clips(self.observation_schema,
+                          config['normalization_clip'],
+                          config['normalization_field_clips'])
+        normalizer = Normalizer(
+            len(self.observation_schema), clips,
+            normalize_observations=config['normalize_observations'],
+            normalize_rewards=config['normalize_rewards'],
+            gamma=config['normalization_gamma'],
+            num_streams=self.num_agents,
+            frozen=config['normalization_frozen'],
+            deferred=config['normalization_deferred'])
+        if config['normalization_path'] is not None:
+            normalizer.load(config['normalization_path'])
+        self.set_normalizer(normalizer)
+
+    def set_normalizer(self, normalizer: Normalizer, stream_offset=0):
+        """
+        :param normalizer: Possibly shared with other envs, with num_streams
+            covering all their agents. Envs update it a row per step, so
+            shared normalizers should be deferred and flushed by the caller
+            once per batch of steps.
+        :param stream_offset: Where this env's agents' returns start in
+            normalizer.returns
+        """
+        self.normalizer = normalizer
+        self.normalizer_stream_offset = stream_offset
+
+    def normalize_step_output(self, step_output):
+        obs, reward, done, info = step_output
+        if self.normalizer is None:
+            return step_output
+        return (self.normalizer.normalize_observation(obs),
+                self.normalizer.normalize_reward(reward), done, info)
 
     def _enable_render(self):
         from deepdrive_zero import player
@@ -271,7 +438,10 @@ class Deepdrive2DEnv(gym.Env):
         self.total_episode_time = 0
         if self.agent_step_outputs:
             # Just reset the current agent
-            return self.agents[self.agent_index].reset()
+            obs = self.agents[self.agent_index].reset()
+            if self.normalizer is not None:
+                obs = self.normalizer.normalize_observation(obs)
+            return obs
         else:
             # First reset, reset entire env
             self.episode_steps = 0
@@ -283,7 +453,10 @@ class Deepdrive2DEnv(gym.Env):
             for agent in self.dummy_accel_agents:
                 agent.reset()
 
-        return self.get_blank_observation()
+        obs = self.get_blank_observation()
+        if self.normalizer is not None:
+            obs = self.normalizer.normalize_observation(obs)
+        return obs
 
     def seed(self, seed=None):
         self.seed_value = seed or 0
@@ -296,9 +469,8 @@ class Deepdrive2DEnv(gym.Env):
         self.start_step_time = time.time()
         agent = self.agents[self.agent_index]
         self.check_for_collisions()
-        step_out = agent.step(action)
-        if step_out == PARTIAL_PHYSICS_STEP:
-            return step_out
+        agent.step(action)
+        self.last_stepped_agent = agent
         ret = self.finish_step()
         return ret
 
@@ -310,13 +482,34 @@ class Deepdrive2DEnv(gym.Env):
             self.num_episodes += 1
         self.episode_steps += 1
         self.total_steps += 1
-        ret = self.get_step_output(done, info, obs, reward)
+        if self.normalizer is not None:
+            self.normalizer.update(
+                obs[None], np.array([reward]), np.array([done]),
+                np.array([self.normalizer_stream_offset + self.agent_index]))
+        ret = self.normalize_step_output(
+            self.get_step_output(done, info, obs, reward))
+        self.update_physics_lod()
         for dummy_accel_agent in self.dummy_accel_agents:
             # Random forward accel
             dummy_accel_agent.step([0, random.random(), 0])
+        self.num_sleeping_agents = sum(a.asleep for a in self.all_agents)
         self.last_step_output = ret
         return ret
 
+    def update_physics_lod(self):
+        """
+        Step dummy agents far from every learning agent with coarse physics,
+        promoting them back to full rate once within lod_distance
+        """
+        if self.lod_distance is None or not self.dummy_accel_agents:
+            return
+        ego = np.array([(a.x, a.y) for a in self.agents])
+        others = np.array([(a.x, a.y) for a in self.dummy_accel_agents])
+        distances = np.linalg.norm(others[:, None] - ego[None], axis=2)
+        far = distances.min(axis=1) > self.lod_distance
+        for agent, is_far in zip(self.dummy_accel_agents, far):
+            agent.low_detail_physics = bool(is_far)
+
     def get_step_output(self, done, info, obs, reward):
         """ Return the observation that corresponds with the correct agent/action
 
@@ -386,23 +579,46 @@ class Deepdrive2DEnv(gym.Env):
             # if self.physics_steps_per_observation != 1:
             #     self.update_intermediate_physics = True
             #     for agent in self.all_agents:
-            #         agent.update_intermediate_physics = True
-        agent = self.agents[self.agent_index]
+            #         agent.record_trajectory = True
+        agent = self.last_stepped_agent
         if self.update_intermediate_physics:
-            # Only works for one agent!
-
-            if agent.step_input is None:
+            if agent is None or not agent.num_trajectory_steps:
                 # First step does not call physics
                 return
-            while agent.possibly_partial_step() == PARTIAL_PHYSICS_STEP:
+            # Play back the substeps of the agent that was just stepped
+            for i in range(agent.num_trajectory_steps):
+                self.render_substep = i
                 self.render_one_frame()
-            self.finish_step()
+            self.render_substep = None
         else:
             self.render_one_frame()
             if self.render_choppy_but_realtime:
                 time.sleep(self.num_agents * self.target_dt)
 
 
+    def next_render_substep(self) -> bool:
+        """
+        Move get_render_pose on to the next substep recorded by the last
+        step, i.e. to draw one per frame when played.
+
+        :return: False once every substep has been drawn, so it's time to
+            step again
+        """
+        agent = self.last_stepped_agent
+        if self.render_substep is None or agent is None:
+            return False
+        if self.render_substep + 1 >= agent.num_trajectory_steps:
+            self.render_substep = None
+            return False
+        self.render_substep += 1
+        return True
+
+    def get_render_pose(self, agent):
+        """:return: x, y, angle to draw agent at for the current frame"""
+        if self.render_substep is not None and agent is self.last_stepped_agent:
+            return tuple(agent.trajectory[self.render_substep, :3])
+        return agent.x, agent.y, agent.angle
+
     def render_one_frame(self):
         platform_event_loop = pyglet.app.platform_event_loop
         # pyglet_event_loop = pyglet.app.event_loop
@@ -417,6 +633,186 @@ class Deepdrive2DEnv(gym.Env):
             pyglet.app.dispatch_event('on_exit')
             pyglet.app.platform_event_loop.stop()
 
+    def get_next_scenario(self, route_index):
+        """
+        One scenario is shared by every route in all_agents, so an episode
+        starts from the joint configuration that was sampled. The first route
+        to start its next episode takes the next scenario from the bank, and
+        the other routes use it as they reset.
+
+        :return: scenario id, map params for Agent.gen_map
+        """
+        if self.scenario is None or route_index in self.scenario_routes:
+            scenario_id = self.scenario_bank.next_id()
+            self.scenario = scenario_id, self.scenario_bank.get(scenario_id)
+            self.scenario_routes = set()
+        self.scenario_routes.add(route_index)
+        scenario_id, params = self.scenario
+        return scenario_id, params[route_index]
+
+    def invalidate_conflict_zones(self):
+        self.conflict_zones = None
+        self.crossing_conflicts = None
+
+    def get_conflict_zones(self):
+        """
+        Zones where routes of all_agents cross or merge, indexed by
+        Agent.route_index. See physics/conflict_zones.py
+        """
+        if self.conflict_zones is None:
+            agents = self.all_agents
+            self.conflict_zones = get_conflict_zones(
+                routes=[a.map.waypoints for a in agents],
+                half_lane_widths=[a.map.lane_width / 2 for a in agents],
+                vehicle_lengths=[a.vehicle_length for a in agents])
+        return self.conflict_zones
+
+    def get_approaching_agents(self):
+        """
+        :return: (approach_distances, arrival_times) where row i, column j
+            is how far / how long until agent j reaches a conflict zone shared
+            with agent i, or inf if it's not approaching one.
+        """
+        agents = self.all_agents
+        return get_approaching_agents(
+            self.get_conflict_zones(),
+            np.array([a.distance_along_route for a in agents],
+                     dtype=np.float64),
+            np.array([a.speed for a in agents], dtype=np.float64))
+
+    def get_crossing_conflicts(self):
+        """
+        :return: (N,) whether each agent, by route_index, has yet to clear a
+            crossing that another agent has yet to enter. Computed once per
+            move, see invalidate_crossing_conflicts.
+        """
+        if self.crossing_conflicts is None:
+            self.crossing_conflicts = get_crossing_conflicts(
+                self.get_conflict_zones(),
+                np.array([a.distance_along_route for a in self.all_agents],
+                         dtype=np.float64))
+        return self.crossing_conflicts
+
+    def invalidate_crossing_conflicts(self):
+        self.crossing_conflicts = None
+
+    def invalidate_agent_arrays(self):
+        self.agent_arrays = None
+
+    def get_agent_arrays(self) -> dict:
+        """
+        State of all_agents gathered into float64 arrays indexed by
+        route_index, shared by every query until an agent's pose changes,
+        see Agent.set_pose_attributes
+        """
+        if self.agent_arrays is None:
+            agents = self.all_agents
+            f64 = np.float64
+            self.agent_arrays = dict(
+                positions=np.array([(a.x, a.y) for a in agents], dtype=f64),
+                angles=np.array([a.angle for a in agents], dtype=f64),
+                fronts=np.array([a.front_pos for a in agents], dtype=f64),
+                headings=np.array([a.heading for a in agents], dtype=f64),
+                velocities=np.array([a.velocity for a in agents], dtype=f64),
+                accelerations=np.array([a.acceleration for a in agents],
+                                       dtype=f64),
+                rects=np.array([a.ego_rect for a in agents], dtype=f64),
+                speeds=np.array([abs(a.speed) for a in agents], dtype=f64))
+        return self.agent_arrays
+
+    def get_agent_grid(self):
+        """neighbors.build_grid of agent positions, built once per move"""
+        arrays = self.get_agent_arrays()
+        if 'grid' not in arrays:
+            arrays['grid'] = build_grid(arrays['positions'])
+        return arrays['grid']
+
+    def get_pairwise_geometry(self):
+        """
+        :return: (N, N, NUM_PAIRWISE_FEATURES) features of all_agents[j] as
+            seen from all_agents[i], see pairwise_geometry.py. Observations
+            only need one row, see get_ego_geometry.
+        """
+        arrays = self.get_agent_arrays()
+        return get_pairwise_geometry(
+            arrays['fronts'], arrays['headings'], arrays['velocities'],
+            arrays['accelerations'], arrays['rects'])
+
+    def get_ego_geometry(self, route_index, others):
+        """
+        :param others: Indices into all_agents
+        :return: (len(others), NUM_PAIRWISE_FEATURES) row route_index of
+            get_pairwise_geometry, just for others
+        """
+        arrays = self.get_agent_arrays()
+        return get_ego_geometry(
+            route_index, np.asarray(others, dtype=np.int64),
+            arrays['fronts'], arrays['headings'], arrays['velocities'],
+            arrays['accelerations'], arrays['rects'])
+
+    def get_observed_agents(self, route_index, k, order):
+        """
+        :param order: 'distance' or 'ttc', see neighbors.py
+        :return: (k,) indices into all_agents of the agents most relevant to
+            all_agents[route_index], padded with -1
+        """
+        arrays = self.get_agent_arrays()
+        return query_neighbors(arrays['positions'], arrays['speeds'],
+                               self.get_agent_grid(), route_index, k,
+                               order == NEIGHBOR_ORDER_TTC)
+
+    def get_polar_occupancy(self, route_indices, num_sectors, num_range_bins,
+                            max_range):
+        """
+        :return: (len(route_indices), NUM_OCCUPANCY_CHANNELS, num_sectors,
+            num_range_bins) occupancy around each of those agents, see
+            polar_occupancy.py
+        """
+        agents = self.all_agents
+        arrays = self.get_agent_arrays()
+        if self.add_static_obstacle:
+            segments = np.array([a.static_obstacle_points for a in agents],
+                                dtype=np.float64)
+        else:
+            segments = np.zeros((0, 2, 2))
+        return get_polar_occupancy(
+            np.asarray(route_indices, dtype=np.int64),
+            arrays['positions'], arrays['angles'], arrays['velocities'],
+            arrays['rects'], self.get_agent_grid(), segments, num_sectors,
+            num_range_bins, float(max_range))
+
+    def cast_lidar(self, route_indices, num_beams, fov, max_range):
+        """
+        :return: (len(route_indices), num_beams) distances and LIDAR_HIT_*
+            types around each of those agents, see lidar.py
+        """
+        agents = self.all_agents
+        f64 = np.float64
+        segments = []
+        segment_types = []
+        if self.is_intersection_map:
+            lines, _lane_width = get_intersection()
+            segments += lines
+            segment_types += [LIDAR_HIT_LANE] * len(lines)
+        if self.add_static_obstacle:
+            segments += [a.static_obstacle_points for a in agents]
+            segment_types += [LIDAR_HIT_OBSTACLE] * len(agents)
+        arrays = self.get_agent_arrays()
+        return cast_lidar(
+            np.asarray(route_indices, dtype=np.int64),
+            arrays['positions'], arrays['angles'], arrays['rects'],
+            self.get_agent_grid(),
+            np.array(segments, dtype=f64).reshape(-1, 2, 2),
+            np.array(segment_types, dtype=np.int64),
+            num_beams, float(fov), float(max_range))
+
+    def get_rasters(self, route_indices, size, m_per_px):
+        """
+        :return: (len(route_indices), NUM_RASTER_CHANNELS, size, size) uint8
+            top-down images around each of those agents, see raster.py
+        """
+        return rasterize_envs([(self, route_indices)], size, m_per_px)
+
     def check_for_collisions(self):
         if 'DISABLE_COLLISION_CHECK' in os.environ:
             return False
@@ -430,6 +826,508 @@ class Deepdrive2DEnv(gym.Env):
 
 
 
+def test_integrator_physics_steps():
+    env = Deepdrive2DEnv(is_intersection_map=True)
+    env.configure_env(dict(is_intersection_map=True, integrator='rk4',
+                           physics_steps_per_observation=12))
+    env.step([0.1, 1, 0])
+    try:
+        env.configure_env(dict(is_intersection_map=True, integrator='rk4',
+                               physics_steps_per_observation=24))
+    except ValueError:
+        pass
+    else:
+        raise AssertionError('Expected rk4 to be limited to tested pso')
+
+
+def test_record_trajectory():
+    env = Deepdrive2DEnv(is_intersection_map=True)
+    env.configure_env(dict(is_intersection_map=True, record_trajectory=True,
+                           physics_steps_per_observation=6))
+    env.reset()
+    # Each agent's first step just returns a blank observation
+    for _ in range(4):
+        env.step([0.1, 1, 0])
+    agent = env.last_stepped_agent
+    assert agent is env.agents[1]
+    assert agent.num_trajectory_steps == 6
+    assert np.allclose(agent.trajectory[-1],
+                       (agent.x, agent.y, agent.angle, agent.speed))
+    env.render_substep = 0
+    assert env.get_render_pose(agent) == tuple(agent.trajectory[0, :3])
+    other = env.agents[0]
+    assert env.get_render_pose(other) == (other.x, other.y, other.angle)
+
+    # Played one substep per frame, then it's time to step again
+    poses = [env.get_render_pose(agent)]
+    while env.next_render_substep():
+        poses.append(env.get_render_pose(agent))
+    assert poses == [tuple(p) for p in agent.trajectory[:6, :3]]
+    assert env.get_render_pose(agent) == (agent.x, agent.y, agent.angle)
+
+
+def test_comfort_metric():
+    from deepdrive_zero.physics.physics_step import COMFORT_GFORCE_MEAN
+    env = Deepdrive2DEnv(is_intersection_map=True)
+    env.configure_env(dict(is_intersection_map=True, comfort_metric='max',
+                           physics_steps_per_observation=6))
+    env.reset()
+    for _ in range(6):
+        env.step([0.1, 1, 0])
+    agent = env.last_stepped_agent
+    gforce, jerk = agent.get_comfort_levels()
+    assert gforce >= agent.gforce
+    assert jerk >= np.linalg.norm(agent.jerk)
+    assert len(agent.episode_gforces) == 2
+    assert agent.episode_gforces[-1] == agent.comfort[COMFORT_GFORCE_MEAN]
+
+    # Episode stats are per observation by default, as before substep metrics
+    env = Deepdrive2DEnv(is_intersection_map=True)
+    env.configure_env(dict(is_intersection_map=True,
+                           physics_steps_per_observation=6))
+    env.reset()
+    for _ in range(6):
+        env.step([0.1, 1, 0])
+    agent = env.last_stepped_agent
+    assert agent.episode_gforces[-1] == agent.gforce
+
+
+def test_sleep_stationary():
+    from deepdrive_zero.constants import SLEEP_AFTER_STEPS
+    env = Deepdrive2DEnv(is_intersection_map=True,
+                         expect_normalized_actions=False)
+    env.configure_env(dict(is_intersection_map=True, sleep_stationary=True))
+    env.reset()
+    agents = env.agents
+    starts = [(a.x, a.y, a.angle) for a in agents]
+    for _ in range(2 * (SLEEP_AFTER_STEPS + 2)):
+        env.step([0, 0, 0])
+    assert all(a.asleep for a in agents)
+    assert env.num_sleeping_agents == len(agents)
+    assert starts == [(a.x, a.y, a.angle) for a in agents]
+    assert all(a.speed == a.angle_change == 0 for a in agents)
+
+    # Throttle wakes the agent being stepped
+    stepped = agents[env.agent_index]
+    env.step([0, 1, 0])
+    assert not stepped.asleep
+    assert env.num_sleeping_agents == len(agents) - 1
+    assert stepped.speed > 0
+
+
+def test_physics_lod():
+    poses = {}
+    for lod_distance in (None, 0):
+        random.seed(0)
+        env = Deepdrive2DEnv(is_intersection_map=True)
+        env.configure_env(dict(is_intersection_map=True,
+                               dummy_accel_agent_indices=[1],
+                               physics_steps_per_observation=6,
+                               lod_distance=lod_distance,
+                               lod_physics_steps=2))
+        env.reset()
+        for _ in range(20):
+            env.step([0, 0, 0])
+        dummy = env.dummy_accel_agents[0]
+        assert dummy.low_detail_physics == (lod_distance is not None)
+        assert dummy.speed > 0
+        poses[lod_distance] = np.array((dummy.x, dummy.y))
+    # Coarse physics covers about the same ground
+    assert np.linalg.norm(poses[None] - poses[0]) < 0.2
+
+
+def test_comfortable_turn():
+    from deepdrive_zero.discrete.comfortable_actions import \
+        COMFORTABLE_ACTIONS, COMFORTABLE_ACTIONS_LARGE_STEER_LEFT, \
+        COMFORTABLE_ACTIONS_LARGE_STEER_RIGHT
+    env = Deepdrive2DEnv(is_intersection_map=True)
+    env.configure_env(dict(is_intersection_map=True,
+                           discrete_actions=COMFORTABLE_ACTIONS))
+    env.reset()
+    agent = env.agents[0]
+    agent.speed = 10
+    left, _, _ = agent.convert_comfortable_actions(
+        min(COMFORTABLE_ACTIONS_LARGE_STEER_LEFT))
+    right, _, _ = agent.convert_comfortable_actions(
+        min(COMFORTABLE_ACTIONS_LARGE_STEER_RIGHT))
+    assert left == -right > 0
+    # About what the hand tuned pi / (30 * speed ** 2) gave for ~0.1g
+    assert abs(left / (np.pi / 3000) - 1) < 0.2
+    agent.speed = 20
+    assert agent.get_angle_for_comfortable_turn() < left
+
+
+def test_observation_schema():
+    env = Deepdrive2DEnv(is_intersection_map=True)
+    env.configure_env(dict(is_intersection_map=True,
+                           incent_yield_to_oncoming_traffic=True))
+    schema = env.observation_schema
+    assert len(schema) == env.observation_space.shape[0]
+    for _ in range(6):
+        env.step([0, 1, 0])
+    agent = env.last_stepped_agent
+    obs = agent.last_step_output[0]
+    fields = schema.views(obs)
+    assert fields.speed == np.float64(agent.speed)
+    assert fields.prev_throttle == agent.prev_throttle
+    assert np.array_equal(fields.velocity, agent.velocity)
+    assert fields.other_agent_0_corners.shape == (8,)
+    assert fields.will_turn_across_opposing_lanes == \
+        agent.will_turn_across_opposing_lanes
+
+
+def test_observation_schema_fields():
+    """Every schema field holds what populate_observation put there"""
+    configs = [
+        (dict(is_intersection_map=True),
+         dict(is_intersection_map=True, incent_yield_to_oncoming_traffic=True,
+              history_length=2)),
+        (dict(is_intersection_map=True),
+         dict(is_intersection_map=True, max_observed_agents=3,
+              observed_agent_order='ttc')),
+        (dict(is_intersection_map=True),
+         dict(is_intersection_map=True, polar_occupancy=True, polar_sectors=8,
+              polar_range_bins=4, lidar=True, lidar_beams=8, raster=True,
+              raster_size=16)),
+        (dict(is_one_waypoint_map=True, add_static_obstacle=True), dict()),
+    ]
+    for env_kwargs, env_config in configs:
+        env = Deepdrive2DEnv(**env_kwargs)
+        env.configure_env(env_config)
+        for _ in range(6):
+            env.step([0.1, 1, 0])
+        agent = env.last_stepped_agent
+        obs, _reward, _done, info = agent.last_step_output
+        fields = env.observation_schema.views(obs)
+        expected = _get_expected_observation_fields(env, agent, info)
+        assert set(expected) == set(fields), env_config
+        for name, value in expected.items():
+            assert np.allclose(fields[name], value), (env_config, name)
+
+
+def _get_expected_observation_fields(env, agent, info) -> dict:
+    """
+    Observation inputs of the agent that was just stepped, by schema field,
+    gathered independently of populate_observation. Needs nobody else to
+    have moved since, i.e. no dummy agents.
+    """
+    from deepdrive_zero.physics.pairwise_geometry import \
+        NUM_PAIRWISE_FEATURES, PG_RELATIVE_VELOCITY, PG_VELOCITY, \
+        PG_ACCELERATION, PG_CORNERS
+    from deepdrive_zero.sensors.polar_occupancy import OCCUPANCY_DISTANCE, \
+        OCCUPANCY_CLOSING_SPEED
+    ret = dict()
+    angles_ahead = list(agent.angles_ahead)
+    if len(angles_ahead) == 1:
+        angles_ahead *= 2
+    ret['angles_ahead'] = angles_ahead
+    if agent.is_intersection_map:
+        ret['waypoint_distance'] = agent.waypoint_distances[0]
+        ret['waypoint_distance_2'] = agent.waypoint_distances[:2].sum()
+        if not agent.polar_occupancy:
+            if agent.max_observed_agents is None:
+                others = [i for i in range(env.num_agents)
+                          if i != agent.agent_index]
+                geometry = env.get_ego_geometry(agent.route_index, others)
+            else:
+                geometry = np.reshape(
+                    agent.other_agent_inputs,
+                    (agent.max_observed_agents, NUM_PAIRWISE_FEATURES + 1))
+            for i, row in enumerate(geometry):
+                prefix = f'other_agent_{i}_'
+                ret[prefix + 'relative_velocity'] = row[
+                    PG_RELATIVE_VELOCITY:PG_RELATIVE_VELOCITY + 2]
+                ret[prefix + 'velocity'] = row[PG_VELOCITY:PG_VELOCITY + 2]
+                ret[prefix + 'acceleration'] = row[
+                    PG_ACCELERATION:PG_ACCELERATION + 2]
+                ret[prefix + 'corners'] = row[PG_CORNERS:PG_CORNERS + 8]
+                if agent.max_observed_agents is not None:
+                    ret[prefix + 'valid'] = row[-1]
+        ret['velocity'] = agent.velocity
+        ret['acceleration'] = agent.acceleration
+    if env.add_static_obstacle:
+        ret['static_obstacle_distances'] = agent.static_obst_angle_info[:2]
+        ret['static_obstacle_angles'] = agent.static_obst_angle_info[2:]
+    if agent.polar_occupancy:
+        occupancy = env.get_polar_occupancy(
+            [agent.route_index], agent.polar_sectors, agent.polar_range_bins,
+            agent.polar_max_range)[0]
+        ret['polar_occupancy_distance'] = occupancy[OCCUPANCY_DISTANCE].ravel()
+        ret['polar_occupancy_closing_speed'] = \
+            occupancy[OCCUPANCY_CLOSING_SPEED].ravel()
+    if agent.lidar:
+        distances, hit_types = env.cast_lidar(
+            [agent.route_index], agent.lidar_beams, agent.lidar_fov,
+            agent.lidar_max_range)
+        ret['lidar_distance'] = distances[0]
+        ret['lidar_hit_type'] = hit_types[0]
+    if agent.raster:
+        ret['raster'] = env.get_rasters([agent.route_index], agent.raster_size,
+                                        agent.raster_m_per_px)[0].ravel()
+    ret['prev_steer'] = agent.prev_steer
+    ret['prev_throttle'] = agent.prev_throttle
+    ret['prev_brake'] = agent.prev_brake
+    ret['speed'] = agent.speed
+    ret['left_lane_distance'] = info['stats']['left_lane_distance']
+    ret['right_lane_distance'] = info['stats']['right_lane_distance']
+    if agent.incent_yield_to_oncoming_traffic:
+        ret['will_turn_across_opposing_lanes'] = \
+            agent.will_turn_across_opposing_lanes
+    if agent.history_length:
+        ret['history'] = agent.experience_buffer.get().ravel()
+    return ret
+
+
+def test_other_agent_inputs():
+    env = Deepdrive2DEnv(is_intersection_map=True)
+    env.configure_env(dict(is_intersection_map=True,
+                           dummy_accel_agent_indices=[1]))
+    for _ in range(6):
+        env.step([0.1, 1, 0])
+    for agent in env.all_agents:
+        expected = []
+        for i in range(env.num_agents):
+            if i == agent.agent_index:
+                continue
+            other = env.all_agents[i]
+            expected += list(other.velocity - agent.velocity)
+            expected += list(other.velocity)
+            expected += list(other.acceleration)
+            for p in other.ego_rect:
+                expected.append(agent.get_angle_to_point(p))
+                expected.append(np.linalg.norm(p - agent.front_pos))
+        assert np.allclose(agent.get_other_agent_inputs(), expected)
+
+    # Gathered once until someone moves
+    arrays = env.get_agent_arrays()
+    assert env.get_agent_arrays() is arrays
+    env.step([0.1, 1, 0])
+    assert env.get_agent_arrays() is not arrays
+
+
+def test_max_observed_agents():
+    sizes = []
+    for dummies in ([1], [1, 0]):
+        env = Deepdrive2DEnv(is_intersection_map=True)
+        env.configure_env(dict(is_intersection_map=True,
+                               dummy_accel_agent_indices=dummies,
+                               max_observed_agents=4,
+                               observed_agent_order='ttc'))
+        for _ in range(6):
+            env.step([0, 1, 0])
+        sizes.append(env.observation_space.shape[0])
+        agent = env.last_stepped_agent
+        fields = env.observation_schema.views(agent.last_step_output[0])
+        num_others = len(env.all_agents) - 1
+        assert [fields[f'other_agent_{i}_valid'] for i in range(4)] == \
+               [1] * num_others + [0] * (4 - num_others)
+        assert not fields.other_agent_3_corners.any()
+        # The grid is shared by every agent's query within a step
+        grid = env.get_agent_grid()
+        env.get_observed_agents(0, 4, 'ttc')
+        assert env.get_agent_grid() is grid
+    # Observation size doesn't depend on how many vehicles there are
+    assert sizes[0] == sizes[1]
+
+
+def test_polar_occupancy():
+    sizes = []
+    for dummies in ([], [1]):
+        env = Deepdrive2DEnv(is_intersection_map=True)
+        env.configure_env(dict(is_intersection_map=True,
+                               dummy_accel_agent_indices=dummies,
+                               polar_occupancy=True,
+                               polar_sectors=8,
+                               polar_range_bins=4,
+                               polar_max_range=40))
+        for _ in range(6):
+            env.step([0, 1, 0])
+        sizes.append(env.observation_space.shape[0])
+    assert 'other_agent_0_velocity' not in env.observation_schema
+    agent = env.last_stepped_agent
+    fields = env.observation_schema.views(agent.last_step_output[0])
+    distances = fields.polar_occupancy_distance.reshape(8, 4)
+    # The oncoming agent is ahead, the dummy following us is behind
+    assert (distances[4] < 40).any()
+    assert (distances[0] < 40).any()
+    assert sizes[0] == sizes[1]
+
+
+def test_lidar():
+    from deepdrive_zero.sensors.lidar import LIDAR_HIT_LANE, LIDAR_HIT_VEHICLE
+    env = Deepdrive2DEnv(is_intersection_map=True)
+    # The dummy shares agent 1's lane and can start on top of it, hiding
+    # everything else, so use start positions that are apart
+    env.seed(3)
+    env.configure_env(dict(is_intersection_map=True,
+                           dummy_accel_agent_indices=[1],
+                           lidar=True,
+                           lidar_beams=16,
+                           lidar_max_range=50))
+    for _ in range(6):
+        env.step([0, 1, 0])
+    agent = env.last_stepped_agent
+    fields = env.observation_schema.views(agent.last_step_output[0])
+    assert fields.lidar_distance.shape == (16,)
+    hit_types = set(fields.lidar_hit_type)
+    assert {LIDAR_HIT_LANE, LIDAR_HIT_VEHICLE} <= hit_types
+    assert (fields.lidar_distance <= 50).all()
+
+
+def test_raster():
+    from deepdrive_zero.sensors.raster import NUM_RASTER_CHANNELS, \
+        RASTER_EGO, RASTER_VEHICLES, RASTER_LANES, rasterize_envs
+    envs = []
+    for _ in range(2):
+        env = Deepdrive2DEnv(is_intersection_map=True)
+        env.configure_env(dict(is_intersection_map=True,
+                               dummy_accel_agent_indices=[1],
+                               raster=True,
+                               raster_size=32,
+                               raster_m_per_px=1))
+        for _ in range(6):
+            env.step([0, 1, 0])
+        envs.append(env)
+    agent = env.last_stepped_agent
+    fields = env.observation_schema.views(agent.last_step_output[0])
+    raster = fields.raster.reshape(NUM_RASTER_CHANNELS, 32, 32)
+    assert raster[RASTER_EGO].any() and raster[RASTER_LANES].any()
+    # The dummy following us
+    assert raster[RASTER_VEHICLES, 16:].any()
+
+    # Batched across envs
+    rasters = rasterize_envs([(e, range(e.num_agents)) for e in envs], 32, 1)
+    assert rasters.shape == (4, NUM_RASTER_CHANNELS, 32, 32)
+    assert (rasters[2:] == envs[1].get_rasters([0, 1], 32, 1)).all()
+
+
+def test_history():
+    env = Deepdrive2DEnv(is_intersection_map=True)
+    env.configure_env(dict(is_intersection_map=True,
+                           history_length=3,
+                           history_seconds=0.1,
+                           history_fields=['speed', 'prev_throttle']))
+    schema = env.observation_schema
+    assert schema['history'].length == 3 * 2
+    for _ in range(8):
+        env.step([0, 1, 0])
+    agent = env.last_stepped_agent
+    observation = agent.last_step_output[0]
+    history = schema.view(observation, 'history').reshape(3, 2)
+    # Newest capture is this observation, speeding up
+    assert history[0, 0] == schema.view(observation, 'speed')
+    assert history[0, 1] == schema.view(observation, 'prev_throttle')
+    assert history[0, 0] > history[1, 0] > history[2, 0] > 0
+
+
+def test_normalization():
+    import os
+    import tempfile
+    config = dict(is_intersection_map=True,
+                  normalize_observations=True,
+                  normalize_rewards=True,
+                  normalization_clip=5,
+                  normalization_field_clips=dict(
+                      will_turn_across_opposing_lanes=None))
+    env = Deepdrive2DEnv(is_intersection_map=True)
+    env.configure_env(config)
+    for _ in range(20):
+        obs, reward, done, info = env.step([0, 1, 0])
+        assert (np.abs(obs) <= 5).all()
+    agent = env.agents[env.agent_index]
+    raw_obs, raw_reward = agent.last_step_output[:2]
+    assert not np.allclose(obs, raw_obs)
+    turn = env.observation_schema.slice('will_turn_across_opposing_lanes')
+    assert (obs[turn] == raw_obs[turn]).all()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'normalization.npz')
+        env.normalizer.save(path)
+        eval_env = Deepdrive2DEnv(is_intersection_map=True)
+        eval_env.configure_env(dict(config, normalization_path=path,
+                                    normalization_frozen=True))
+    normalizer = eval_env.normalizer
+    assert np.allclose(normalizer.observation_rms.mean,
+                       env.normalizer.observation_rms.mean)
+    count = normalizer.observation_rms.count
+    eval_env.step([0, 1, 0])
+    assert normalizer.observation_rms.count == count
+
+    # Booleans pass through without being listed in field clips
+    env = Deepdrive2DEnv(is_intersection_map=True)
+    env.configure_env(dict(is_intersection_map=True,
+                           incent_yield_to_oncoming_traffic=True,
+                           normalize_observations=True))
+    turn = env.observation_schema.slice('will_turn_across_opposing_lanes')
+    assert np.isnan(env.normalizer.clip[turn]).all()
+    assert not np.isnan(env.normalizer.clip[:turn.start]).any()
+
+
+def test_reward_terms():
+    from deepdrive_zero.reward import REWARD_TERMS, REWARD_PROGRESS, \
+        REWARD_GFORCE
+    env = Deepdrive2DEnv(is_intersection_map=True,
+                         disable_gforce_penalty=True)
+    env.configure_env(dict(is_intersection_map=True))
+    for _ in range(6):
+        env.step([0, 1, 0])
+    agent = env.last_stepped_agent
+    _obs, reward, _done, info = agent.last_step_output
+    terms = info['stats']['reward_terms']
+    assert len(terms) == len(REWARD_TERMS)
+    assert np.isclose(reward, terms.sum())
+    assert terms[REWARD_PROGRESS] > 0
+    assert terms[REWARD_GFORCE] == 0
+
+
+def test_mixed_fleet():
+    from deepdrive_zero.constants import TESLA_LENGTH
+    env = Deepdrive2DEnv(is_intersection_map=True)
+    env.configure_env(dict(is_intersection_map=True,
+                           vehicles=['voyage_van', 'tesla']))
+    env.reset()
+    van, tesla = env.agents
+    assert tesla.vehicle_length == TESLA_LENGTH
+    assert van.vehicle_length != tesla.vehicle_length
+    assert np.shares_memory(tesla.vehicle_model, env.vehicle_params)
+    for _ in range(4):
+        env.step([0.1, 1, 0])
+    assert tesla.speed > 0
+
+
+def test_float32_tolerance():
+    """
+    float32 mode should track float64 trajectories within 1mm and 1e-3
+    radians, and observations within 1e-3 relative, over 150 steps of random
+    actions on the intersection map.
+    """
+    trajectories = {}
+    for dtype in ('float64', 'float32'):
+        np.random.seed(0)
+        random.seed(0)
+        env = Deepdrive2DEnv(is_intersection_map=True)
+        env.configure_env(dict(is_intersection_map=True, dtype=dtype,
+                               physics_steps_per_observation=12))
+        env.reset()
+        rng = np.random.RandomState(0)
+        trajectory = []
+        for _ in range(150):
+            obs, _, done, _ = env.step(rng.uniform(-1, 1, 3))
+            assert obs.dtype == np.dtype(dtype)
+            trajectory.append(
+                (obs, [(a.x, a.y, a.angle) for a in env.agents]))
+            if done:
+                env.reset()
+        trajectories[dtype] = trajectory
+    for (obs64, poses64), (obs32, poses32) in zip(trajectories['float64'],
+                                                  trajectories['float32']):
+        assert np.allclose(obs64, obs32, rtol=1e-3, atol=1e-3)
+        poses64 = np.array(poses64)
+        poses32 = np.array(poses32)
+        assert np.allclose(poses64[:, :2], poses32[:, :2], rtol=0, atol=1e-3)
+        assert np.allclose(poses64[:, 2], poses32[:, 2], rtol=0, atol=1e-3)
+
+
 def main():
     env = Deepdrive2DEnv()
 
@@ -1,55 +1,121 @@
-from collections import deque
-
 import numpy as np
 
 
 class ExperienceBuffer:
+    """
+    Last max_length captures, taken at least step_seconds apart, in a
+    preallocated circular NumPy buffer.
+
+    Each capture is written twice, max_length apart, so the newest
+    max_length captures are always one contiguous slice and reading them
+    back is a view rather than a concatenation.
+
+    With batch_size, each capture holds one row per env of a vector env,
+    all captured at the same time.
+    """
     def __init__(self, step_seconds=0.25, seconds_to_keep=2,
-                 fade_fn=None):
+                 dtype=np.float64, shape: tuple = None, batch_size=None):
         self.step_seconds: float = step_seconds
-        self.seconds_to_keep: int = seconds_to_keep
+        self.dtype = dtype
+        self.seconds_to_keep: float = seconds_to_keep
+        self.batch_size: int = batch_size
 
-        self.max_length = int(self.seconds_to_keep / self.step_seconds)
-        self.buffer = deque(maxlen=self.max_length)
+        self.max_length = max(1, round(self.seconds_to_keep /
+                                       self.step_seconds))
         self.last_capture_time = None
-        self.fade_fn = fade_fn or (lambda j: j)
+        self.num_captures: int = 0
+        self.head: int = 0  # Index of the newest capture
+        self.data: np.array = None
+        if shape is not None:
+            self.setup(shape)
 
-        self.fade_length = 0
-        while self.fade_fn(self.fade_length) < self.max_length:
-            self.fade_length += 1
-
-        self.blank_buffer = None
+    def setup(self, shape: tuple = None):
+        """Allocate for captures of shape, excluding any batch axis"""
+        shape = tuple(shape or (1,))
+        self.data = np.zeros(((self.batch_size or 1), 2 * self.max_length) +
+                             shape, dtype=self.dtype)
+        self.reset()
 
     def maybe_add(self, x, t):
-        if self.last_capture_time is None or \
-                t >= (self.last_capture_time + self.step_seconds):
-            self.buffer.appendleft(x)
-            self.last_capture_time = t
+        """
+        :param x: Capture, with a leading batch axis if batch_size
+        :return: Whether x was captured
+        """
+        if self.last_capture_time is not None and \
+                t < self.last_capture_time + self.step_seconds:
+            return False
+        if self.data is None:
+            self.setup(np.shape(x)[1:] if self.batch_size else np.shape(x))
+        # Newest first, so walk backwards
+        self.head = (self.head - 1) % self.max_length
+        if self.batch_size is None:
+            x = np.expand_dims(x, 0)
+        self.data[:, self.head] = x
+        self.data[:, self.head + self.max_length] = x
+        self.last_capture_time = t
+        self.num_captures = min(self.num_captures + 1, self.max_length)
+        return True
 
-    def setup(self, shape: tuple = None):
-        shape = shape or (1,)
-        for _ in range(self.max_length):
-            self.buffer.append(np.zeros(shape))
-        self.blank_buffer = self.buffer
+    def get(self) -> np.array:
+        """
+        :return: View of the last max_length captures, newest first and
+            zeros before anything was captured, shaped
+            ([batch_size,] max_length, *shape)
+        """
+        ret = self.data[:, self.head:self.head + self.max_length]
+        if self.batch_size is None:
+            ret = ret[0]
+        return ret
 
-    def reset(self):
-        self.buffer.clear()
+    def reset(self, batch_index=None):
+        """
+        :param batch_index: Zero just this env's history, e.g. when only it
+            is done, keeping the shared capture clock
+        """
+        if batch_index is not None:
+            if self.data is not None:
+                self.data[batch_index] = 0
+            return
+        if self.data is not None:
+            self.data[:] = 0
+        self.head = 0
+        self.num_captures = 0
+        self.last_capture_time = None
 
     def size(self):
-        return len(self.buffer)
+        return self.num_captures
 
     def __len__(self):
         return self.size()
 
 
-def sanity():
-    e = ExperienceBuffer()
-    e.reset()
-    for i in range(e.max_length):
-        e.maybe_add(np.array(i), i * e.step_seconds)
+def test_experience_buffer():
+    e = ExperienceBuffer(step_seconds=0.1, seconds_to_keep=0.3)
+    assert e.max_length == 3
+    assert e.maybe_add(np.array([0., 0.]), 0)
+    assert list(e.get()[:, 0]) == [0, 0, 0]
+    assert not e.maybe_add(np.array([1., 1.]), 0.05)
+    for i in range(1, 5):
+        e.maybe_add(np.array([i, -i]), i * e.step_seconds)
+    history = e.get()
+    assert history.shape == (3, 2)
+    assert np.shares_memory(history, e.data)
+    assert history.flags.c_contiguous
+    assert list(history[:, 0]) == [4, 3, 2]
     assert e.size() == e.max_length
-    assert e.buffer[-1] == e.max_length - 1
+    e.reset()
+    assert e.size() == 0 and not e.get().any()
+
+    batch = ExperienceBuffer(step_seconds=1, seconds_to_keep=2, batch_size=3)
+    for t in range(3):
+        batch.maybe_add(np.arange(3.)[:, None] * 10 + t, t)
+    history = batch.get()
+    assert history.shape == (3, 2, 1)
+    assert list(history[2, :, 0]) == [22, 21]
+    batch.reset(batch_index=2)
+    assert not batch.get()[2].any()
+    assert list(batch.get()[1, :, 0]) == [12, 11]
 
 
 if __name__ == '__main__':
-    sanity()
+    test_experience_buffer()
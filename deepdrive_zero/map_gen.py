@@ -1,82 +1,115 @@
 import os
 import time
+from functools import lru_cache
 
 import numpy as np
 from loguru import logger as log
-from scipy.interpolate import interp1d
+from numba import njit
 
 from deepdrive_zero.constants import PX_PER_M, MAP_WIDTH_PX, MAP_HEIGHT_PX, \
-    SCREEN_MARGIN, MAP_IMAGE
+    SCREEN_MARGIN, MAP_IMAGE, CACHE_NUMBA
+from deepdrive_zero.physics.arc_length import get_arc_lengths, \
+    resample_equidistant
 
 GAP_M = 1
 DIR = os.path.dirname(os.path.realpath(__file__))
 
 
-# TODO: @njit
 def gen_random_map(should_plot=False, num_course_points=3, resolution=10,
-                   should_save=True) -> np.array:
+                   should_save=False) -> np.array:
     # TODO: Linear interp with 2 points for straight roads
     # TODO: Randomize spacing
-    # TODO: Different interpolations
     # TODO: Randomize num course points
     min_x = 0
     max_x = 1
-    min_y = 0.1
-    max_y = 0.9
     x = np.linspace(min_x, max_x, num=num_course_points + 1,
                     endpoint=True)
-    y = np.array(list(np.random.rand(num_course_points + 1)))
+    y = np.random.rand(num_course_points + 1)
     return gen_map(x, y, resolution, should_plot, should_save)
 
 
-def gen_map(x, y, resolution=10, should_plot=True, should_save=False):
-    linear_interp = interp1d(x, y)
-    min_x = x.min()
-    max_x = x.max()
-    num_course_points = len(x) - 1
-
-    # TODO: Remove first interpolation if making equidistant
-    cubic_interp = interp1d(x, y, kind='cubic')
-
-    xnew = np.linspace(min_x, max_x,
-                       num=num_course_points * resolution, endpoint=True)
+def gen_map(x, y, resolution=10, should_plot=False, should_save=False):
+    """
+    Equidistant points along a spline through x, y with y normalized to 0->1.
 
-    ynew = cubic_interp(xnew)
+    :param should_save: Render the map to MAP_IMAGE with matplotlib. This
+        takes orders of magnitude longer than generating the map, so
+        it's opt-in.
+    """
+    num_course_points = len(x) - 1
+    control_points = np.column_stack((x, y)).astype(np.float64)
+    dense = _catmull_rom(control_points, resolution)
 
     # Normalize 0->1
-    ynew = (ynew - ynew.min()) / (ynew.max() - ynew.min())
+    ynew = dense[:, 1]
+    y_range = ynew.max() - ynew.min()
+    if y_range > 0:
+        dense[:, 1] = (ynew - ynew.min()) / y_range
 
-    equidistant = interpolate_equidistant(np.column_stack((xnew, ynew)),
-                                          distance=1/len(xnew))
+    equidistant = resample_equidistant(
+        dense, get_arc_lengths(dense),
+        spacing=1 / (num_course_points * resolution))
 
     xequi = equidistant[:, 0]
     yequi = equidistant[:, 1]
 
-    if should_plot or should_save:
+    if should_plot:
         import matplotlib.pyplot as plt
-
-        if should_plot:
-            plt.plot(x, y, 'o', xequi, linear_interp(xequi), '-', xequi,
-                     yequi,
-                     '--')
-            plt.legend(['data', 'linear', 'cubic'], loc='best')
-            plt.show()
-        elif should_save:
-            plt.plot(xnew, ynew, '--', color='xkcd:orange', linewidth=1)
-            plt.axis('off')
-            start_save = time.time()
-            # TODO: Specify height and width
-            plt.savefig(MAP_IMAGE, bbox_inches='tight',
-                        pad_inches=0,
-                        facecolor='xkcd:cornflower blue',
-                        edgecolor='xkcd:cornflower blue',
-                        dpi=200)
-            log.debug(f'Save image time {time.time() - start_save}')
-
-    retx = xequi
-    rety = yequi
-
-    return retx, rety
+        plt.plot(x, y, 'o', xequi, yequi, '--')
+        plt.legend(['data', 'spline'], loc='best')
+        plt.show()
+    if should_save:
+        save_map_image(xequi, yequi)
+
+    return xequi, yequi
+
+
+def save_map_image(x, y, path=MAP_IMAGE):
+    import matplotlib.pyplot as plt
+    plt.plot(x, y, '--', color='xkcd:orange', linewidth=1)
+    plt.axis('off')
+    start_save = time.time()
+    # TODO: Specify height and width
+    plt.savefig(path, bbox_inches='tight',
+                pad_inches=0,
+                facecolor='xkcd:cornflower blue',
+                edgecolor='xkcd:cornflower blue',
+                dpi=200)
+    log.debug(f'Save image time {time.time() - start_save}')
+
+
+@njit(cache=CACHE_NUMBA, nogil=True)
+def _catmull_rom(control_points, resolution):
+    """
+    Sample a uniform Catmull-Rom spline through control_points, resolution
+    times per segment. End tangents come from reflected phantom points.
+    """
+    n = len(control_points)
+    num_segments = n - 1
+    ret = np.empty((num_segments * resolution + 1, 2))
+    for seg in range(num_segments):
+        p1 = control_points[seg]
+        p2 = control_points[seg + 1]
+        if seg == 0:
+            p0 = 2 * p1 - p2
+        else:
+            p0 = control_points[seg - 1]
+        if seg == num_segments - 1:
+            p3 = 2 * p2 - p1
+        else:
+            p3 = control_points[seg + 2]
+        for j in range(resolution):
+            t = j / resolution
+            t2 = t * t
+            t3 = t2 * t
+            for k in range(2):
+                ret[seg * resolution + j, k] = 0.5 * (
+                    2 * p1[k] +
+                    (p2[k] - p0[k]) * t +
+                    (2 * p0[k] - 5 * p1[k] + 4 * p2[k] - p3[k]) * t2 +
+                    (3 * p1[k] - p0[k] - 3 * p2[k] + p3[k]) * t3)
+    ret[-1] = control_points[-1]
+    return ret
 
 
 def interpolate_equidistant(points: np.array,
@@ -87,21 +120,14 @@ def interpolate_equidistant(points: np.array,
     :param distance: Desired distance between output spline points
     :return: Equidistant spline points with same shape as input
     """
-    distances = np.cumsum(np.linalg.norm(np.diff(points, axis=0), axis=1))
-    distances = np.hstack([[0], distances])
-    total_distance = distances[-1]
+    points = np.asarray(points, dtype=np.float64)
+    arc_lengths = get_arc_lengths(points)
     if distance is None:
-        distance = total_distance / len(points)
-    total_points = total_distance // distance + 1
-    chords = list(np.arange(0, total_points) * distance)
-    if distances[-1] % distance > (distance / 3):
-        # Add an extra interp point so there won't be big gap at the end
-        chords.append(distances[-1])
-    cubic_interpolator = interp1d(distances, points, 'cubic', axis=0)
-    ret = cubic_interpolator(chords)
-    return ret
+        distance = arc_lengths[-1] / len(points)
+    return resample_equidistant(points, arc_lengths, distance)
 
 
+@lru_cache()
 def get_intersection():
     """
     Returns lane width and 6 lines that make up the intersection,
@@ -109,6 +135,8 @@ def get_intersection():
 
     Each line consists of 2 points and has shape 2x2
 
+    The geometry is static, so it's computed once per process and shared
+    (read-only) by all agents and envs.
     """
     ppm = PX_PER_M
     _lane_width_feet = 10  # https://www.citylab.com/design/2014/10/why-12-foot-traffic-lanes-are-disastrous-for-safety-and-must-be-replaced-now/381117/
@@ -136,14 +164,26 @@ def get_intersection():
     bottom_horiz = np.array(((margin, bottom_horiz_y),
                              (map_width + margin, bottom_horiz_y)))
     lines = left_vert, mid_vert, right_vert, top_horiz, mid_horiz, bottom_horiz
+    for line in lines:
+        line.flags.writeable = False
     return lines, lane_width
 
 
+def test_gen_random_map():
+    start = time.time()
+    x, y = gen_random_map()
+    assert not os.path.exists(MAP_IMAGE) or \
+        os.path.getmtime(MAP_IMAGE) < start
+    assert np.isclose(y.min(), 0, atol=0.02)
+    assert np.isclose(y.max(), 1, atol=0.02)
+    assert x[0] == 0 and np.isclose(x[-1], 1, atol=0.05)
+
+
 def main():
     coords = ((0, 1), (0.5, 1), (1, 1), (1.02, 0))
     zipped = list(zip(*coords))
     gen_map(x=np.array(zipped[0]),
-            y=np.array(zipped[1]))
+            y=np.array(zipped[1]), should_plot=True)
 
 
 if __name__ == '__main__':
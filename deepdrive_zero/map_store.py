@@ -0,0 +1,115 @@
+import numpy as np
+from box import Box
+
+from deepdrive_zero.physics.arc_length import get_arc_lengths
+
+# Grown on demand, so this just avoids reallocating for small maps
+DEFAULT_MAX_ROUTE_POINTS = 8
+
+
+class MapStore:
+    """
+    Route geometry for all agents in an env, kept in preallocated NumPy arrays
+    indexed by Agent.route_index.
+
+    Agents only hold read-only views into these arrays (see get_route), so
+    building a map on reset is just a copy of the route's points into the
+    store - no per-agent arrays, KD-trees, or pixel coordinate lists. Static
+    geometry shared by all agents and envs in the process, like the
+    intersection lines, lives in map_gen.get_intersection.
+    """
+    def __init__(self, num_routes: int, px_per_m: float,
+                 max_route_points: int = DEFAULT_MAX_ROUTE_POINTS):
+        self.num_routes: int = num_routes
+        self.px_per_m: float = px_per_m
+        self.points: np.array = np.zeros((num_routes, max_route_points, 2))
+        self.pixels: np.array = np.zeros((num_routes, max_route_points, 2))
+        self.distances: np.array = np.zeros((num_routes, max_route_points))
+        self.num_points: np.array = np.zeros(num_routes, dtype=np.int64)
+        self.lane_widths: np.array = np.zeros(num_routes)
+
+    @property
+    def max_route_points(self) -> int:
+        return self.points.shape[1]
+
+    def max_num_points(self) -> int:
+        return int(self.num_points.max())
+
+    def reserve(self, max_route_points: int):
+        """
+        Grow storage to hold routes of max_route_points. Views handed out
+        before growing still point at the old arrays, but as routes are only
+        written by the agent that owns them, which then takes new views,
+        those old views still hold correct values.
+        """
+        if max_route_points <= self.max_route_points:
+            return
+        def grow(arr):
+            ret = np.zeros((self.num_routes, max_route_points) + arr.shape[2:])
+            ret[:, :arr.shape[1]] = arr
+            return ret
+        self.points = grow(self.points)
+        self.pixels = grow(self.pixels)
+        self.distances = grow(self.distances)
+
+    def set_route(self, route_index, x_meters, y_meters, lane_width,
+                  x_pixels=None, y_pixels=None, **extra) -> Box:
+        """
+        Copy a route's waypoints into the store.
+
+        :param extra: Non-geometry map properties to add to the returned Box
+        :return: Map Box of read-only views into the store, see get_route
+        """
+        n = len(x_meters)
+        self.reserve(n)
+        i = route_index
+        self.points[i, :n, 0] = x_meters
+        self.points[i, :n, 1] = y_meters
+        if x_pixels is None:
+            self.pixels[i, :n] = self.points[i, :n] * self.px_per_m
+        else:
+            self.pixels[i, :n, 0] = x_pixels
+            self.pixels[i, :n, 1] = y_pixels
+        # Arc-length table for lookups along the route, see arc_length.py
+        self.distances[i, :n] = get_arc_lengths(self.points[i, :n])
+        self.num_points[i] = n
+        self.lane_widths[i] = lane_width
+        return self.get_route(route_index, **extra)
+
+    def get_route(self, route_index, **extra) -> Box:
+        i = route_index
+        n = self.num_points[i]
+        waypoints = _read_only(self.points[i, :n])
+        pixels = _read_only(self.pixels[i, :n])
+        distances = _read_only(self.distances[i, :n])
+        return Box(x=waypoints[:, 0],
+                   y=waypoints[:, 1],
+                   x_pixels=pixels[:, 0],
+                   y_pixels=pixels[:, 1],
+                   waypoints=waypoints,
+                   distances=distances,
+                   route_length=distances[-1],
+                   lane_width=self.lane_widths[i],
+                   **extra)
+
+
+def _read_only(arr):
+    ret = arr.view()
+    ret.flags.writeable = False
+    return ret
+
+
+def test_map_store():
+    store = MapStore(num_routes=2, px_per_m=2, max_route_points=2)
+    mp = store.set_route(0, np.array([0., 3.]), np.array([0., 4.]),
+                         lane_width=3)
+    assert mp.route_length == 5
+    assert list(mp.x_pixels) == [0, 6]
+    assert not mp.waypoints.flags.writeable
+    assert np.shares_memory(mp.waypoints, store.points)
+
+    # Growing keeps other routes intact
+    store.set_route(1, np.arange(4.), np.zeros(4), lane_width=3)
+    assert store.get_route(0).route_length == 5
+    assert store.get_route(1).route_length == 3
+    assert store.max_num_points() == 4
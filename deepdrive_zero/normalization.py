@@ -0,0 +1,262 @@
+"""
+Running normalization of observations and rewards
+
+Observations are standardized per input with running means and variances,
+then clipped. Rewards are divided by the running standard deviation of the
+discounted return, which keeps their sign and doesn't depend on the mean
+reward.
+
+Statistics are merged a batch at a time with Chan et al.'s parallel
+form of Welford's algorithm, so one Normalizer can be shared by a batch of
+envs and updated from all of them at once. Envs call update with one row per
+step, so for a shared normalizer construct it with deferred=True, which
+queues those rows, and call flush once per vectorized step to merge them as
+a single batch.
+
+Inputs whose schema units are bool are passed through by get_clips, as
+standardizing them only adds noise.
+"""
+import numpy as np
+
+from deepdrive_zero.observation_schema import ObservationSchema
+
+# Fields with these units are left unnormalized by get_clips
+RAW_UNITS = ('bool',)
+
+
+class RunningMeanStd:
+    def __init__(self, shape=(), epsilon=1e-4):
+        """
+        :param epsilon: Initial count, so the first batch doesn't divide by
+            zero
+        """
+        self.mean = np.zeros(shape, dtype=np.float64)
+        self.var = np.ones(shape, dtype=np.float64)
+        self.count: float = epsilon
+
+    def update(self, batch):
+        """:param batch: (B, *shape)"""
+        batch = np.asarray(batch, dtype=np.float64)
+        batch_count = batch.shape[0]
+        if batch_count == 0:
+            return
+        batch_mean = batch.mean(axis=0)
+        batch_var = batch.var(axis=0)
+        delta = batch_mean - self.mean
+        total = self.count + batch_count
+        self.mean = self.mean + delta * batch_count / total
+        m2 = (self.var * self.count + batch_var * batch_count +
+              delta ** 2 * self.count * batch_count / total)
+        self.var = m2 / total
+        self.count = total
+
+    @property
+    def std(self):
+        return np.sqrt(self.var)
+
+
+class Normalizer:
+    """
+    Observation and reward normalization for an env, or shared by a batch
+    of envs.
+
+    Set frozen for evaluation so statistics saved with a checkpoint aren't
+    updated by what the policy sees.
+    """
+    def __init__(self, observation_size, clip=10., normalize_observations=True,
+                 normalize_rewards=False, gamma=0.99, num_streams=1,
+                 frozen=False, epsilon=1e-8, deferred=False):
+        """
+        :param clip: Scalar or (observation_size,) bound on normalized
+            inputs. Inputs with a NaN clip are passed through unnormalized.
+        :param num_streams: Number of agents whose discounted returns are
+            tracked, e.g. num_agents times the number of envs sharing this
+        :param deferred: Queue updates until flush, e.g. when shared by envs
+            that each update a row per step
+        """
+        self.clip = np.broadcast_to(np.asarray(clip, dtype=np.float64),
+                                    (observation_size,))
+        self.raw = np.isnan(self.clip)
+        self.normalize_observations: bool = normalize_observations
+        self.normalize_rewards: bool = normalize_rewards
+        self.gamma: float = gamma
+        self.frozen: bool = frozen
+        self.epsilon: float = epsilon
+        self.observation_rms = RunningMeanStd((observation_size,))
+        self.return_rms = RunningMeanStd()
+        self.returns = np.zeros(num_streams)
+        self.deferred: bool = deferred
+        self.pending: list = []
+
+    def update(self, observations, rewards, dones, streams=None):
+        """
+        :param observations: (B, observation_size)
+        :param rewards: (B,)
+        :param dones: (B,)
+        :param streams: (B,) indices into returns, defaults to range(B).
+            A stream may repeat, its rows are taken in order.
+        """
+        if self.frozen:
+            return
+        if streams is None:
+            streams = np.arange(len(rewards))
+        if self.deferred:
+            self.pending.append((observations, rewards, dones, streams))
+            return
+        if self.normalize_observations:
+            self.observation_rms.update(observations)
+        if self.normalize_rewards:
+            returns = np.empty(len(rewards))
+            for i, stream in enumerate(streams):
+                returns[i] = self.returns[stream] * self.gamma + rewards[i]
+                self.returns[stream] = 0 if dones[i] else returns[i]
+            self.return_rms.update(returns)
+
+    def flush(self):
+        """Merge updates queued while deferred as one batch"""
+        if not self.pending:
+            return
+        batch = [np.concatenate(b) for b in zip(*self.pending)]
+        self.pending = []
+        self.deferred = False
+        try:
+            self.update(*batch)
+        finally:
+            self.deferred = True
+
+    def normalize_observation(self, observation):
+        """:param observation: (observation_size,) or (B, observation_size)"""
+        if not self.normalize_observations:
+            return observation
+        rms = self.observation_rms
+        ret = (observation - rms.mean) / np.sqrt(rms.var + self.epsilon)
+        ret = np.clip(ret, -self.clip, self.clip)
+        return np.where(self.raw, observation, ret).astype(observation.dtype)
+
+    def normalize_reward(self, reward):
+        if not self.normalize_rewards:
+            return reward
+        return reward / np.sqrt(self.return_rms.var + self.epsilon)
+
+    def state_dict(self) -> dict:
+        return dict(observation_mean=self.observation_rms.mean,
+                    observation_var=self.observation_rms.var,
+                    observation_count=self.observation_rms.count,
+                    return_mean=self.return_rms.mean,
+                    return_var=self.return_rms.var,
+                    return_count=self.return_rms.count,
+                    returns=self.returns)
+
+    def load_state_dict(self, d):
+        if d['observation_mean'].shape != self.observation_rms.mean.shape:
+            raise ValueError(
+                f'Normalization is for {d["observation_mean"].shape[0]} '
+                f'inputs, expected {self.observation_rms.mean.shape[0]}')
+        self.observation_rms.mean = np.array(d['observation_mean'])
+        self.observation_rms.var = np.array(d['observation_var'])
+        self.observation_rms.count = float(d['observation_count'])
+        self.return_rms.mean = np.array(d['return_mean'])
+        self.return_rms.var = np.array(d['return_var'])
+        self.return_rms.count = float(d['return_count'])
+        if len(d['returns']) == len(self.returns):
+            self.returns = np.array(d['returns'])
+
+    def save(self, path):
+        """Save statistics, e.g. alongside a checkpoint, as .npz"""
+        np.savez(path, **self.state_dict())
+
+    def load(self, path):
+        with np.load(path) as d:
+            self.load_state_dict(d)
+
+
+def get_clips(schema: ObservationSchema, clip=10., field_clips=None):
+    """
+    :param field_clips: Per field name overrides of clip, None to leave a
+        field unnormalized, e.g. for enums. Fields in RAW_UNITS are left
+        unnormalized unless given a clip here.
+    :return: (schema.size,) clip per input for Normalizer
+    """
+    ret = np.full(schema.size, float(clip))
+    for field in schema:
+        if field.units in RAW_UNITS:
+            ret[schema.slice(field.name)] = np.nan
+    for name, field_clip in (field_clips or {}).items():
+        ret[schema.slice(name)] = np.nan if field_clip is None else field_clip
+    return ret
+
+
+def test_running_mean_std():
+    rng = np.random.RandomState(0)
+    data = rng.randn(100, 3) * [1, 10, 100] + [5, -5, 0]
+    rms = RunningMeanStd((3,), epsilon=0)
+    for batch in np.split(data, [1, 10, 45]):
+        rms.update(batch)
+    assert rms.count == 100
+    assert np.allclose(rms.mean, data.mean(axis=0))
+    assert np.allclose(rms.var, data.var(axis=0))
+
+
+def test_normalizer():
+    import os
+    import tempfile
+    schema = ObservationSchema()
+    schema.add('speed', 1, 'm/s')
+    schema.add('will_turn_across_opposing_lanes', 1, 'bool')
+    clips = get_clips(schema, 2)
+    assert np.isnan(clips[1])
+    assert get_clips(schema, 2,
+                     dict(will_turn_across_opposing_lanes=1))[1] == 1
+    normalizer = Normalizer(2, clips, normalize_rewards=True, gamma=0.5,
+                            num_streams=2)
+    rng = np.random.RandomState(0)
+    for _ in range(100):
+        observations = np.stack([rng.randn(2) * 10 + 20,
+                                 rng.randint(0, 2, 2)], axis=1)
+        normalizer.update(observations, np.ones(2), np.zeros(2))
+    normalized = normalizer.normalize_observation(np.array([[20., 1.],
+                                                            [1000., 0.]]))
+    assert abs(normalized[0, 0]) < 0.5
+    assert normalized[1, 0] == 2  # Clipped
+    assert list(normalized[:, 1]) == [1, 0]  # Passed through
+    # Returns approach 1 / (1 - gamma)
+    assert np.isclose(normalizer.return_rms.mean, 2, atol=0.1)
+
+    normalizer.frozen = True
+    mean = normalizer.observation_rms.mean.copy()
+    normalizer.update(np.zeros((1, 2)), np.zeros(1), np.zeros(1))
+    assert (normalizer.observation_rms.mean == mean).all()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'normalization.npz')
+        normalizer.save(path)
+        loaded = Normalizer(2, clips, normalize_rewards=True, num_streams=2)
+        loaded.load(path)
+    assert (loaded.observation_rms.mean == mean).all()
+    assert loaded.normalize_reward(3.) == normalizer.normalize_reward(3.)
+
+
+def test_deferred_update():
+    rng = np.random.RandomState(0)
+    observations = rng.randn(6, 2)
+    rewards = rng.randn(6)
+    dones = np.array([0, 0, 1, 0, 0, 0])
+    streams = np.array([0, 1, 0, 1, 0, 1])
+    eager = Normalizer(2, normalize_rewards=True, num_streams=2)
+    deferred = Normalizer(2, normalize_rewards=True, num_streams=2,
+                          deferred=True)
+    for i in range(6):
+        # e.g. two envs sharing the normalizer, each updating a row per step
+        args = observations[i:i + 1], rewards[i:i + 1], dones[i:i + 1], \
+            streams[i:i + 1]
+        eager.update(*args)
+        deferred.update(*args)
+    assert (deferred.observation_rms.mean == 0).all()
+    deferred.flush()
+    assert deferred.pending == [] and deferred.deferred
+    assert np.allclose(deferred.observation_rms.mean,
+                       eager.observation_rms.mean)
+    assert np.allclose(deferred.observation_rms.var,
+                       eager.observation_rms.var)
+    assert np.allclose(deferred.returns, eager.returns)
+    assert np.isclose(deferred.return_rms.var, eager.return_rms.var)
@@ -0,0 +1,111 @@
+import json
+from collections import namedtuple
+
+import numpy as np
+from box import Box
+
+# normalization is None for raw values
+ObservationField = namedtuple(
+    'ObservationField', ['name', 'offset', 'length', 'units', 'normalization'])
+
+
+class ObservationSchema:
+    """
+    Named layout of an agent's observation vector, see
+    Agent.get_observation_schema.
+
+    Built once per configure_env and saved alongside anything that stores
+    observations, so models and tooling can find inputs by name rather than
+    by the order of appends in Agent.populate_observation.
+    """
+    def __init__(self, fields=()):
+        self.fields: dict = {}
+        self.size: int = 0
+        for field in fields:
+            self.add(field.name, field.length, field.units,
+                     field.normalization)
+
+    def add(self, name, length=1, units='', normalization=None):
+        if name in self.fields:
+            raise ValueError(f'Duplicate observation field {name}')
+        self.fields[name] = ObservationField(name, self.size, length, units,
+                                             normalization)
+        self.size += length
+
+    def __getitem__(self, name) -> ObservationField:
+        return self.fields[name]
+
+    def __contains__(self, name):
+        return name in self.fields
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        return iter(self.fields.values())
+
+    def __eq__(self, other):
+        return (isinstance(other, ObservationSchema) and
+                list(self) == list(other))
+
+    def slice(self, name) -> slice:
+        field = self.fields[name]
+        return slice(field.offset, field.offset + field.length)
+
+    def view(self, observations: np.ndarray, name) -> np.ndarray:
+        """
+        :param observations: One observation or a batch with observations
+            along the last axis
+        :return: Zero-copy view of the field, without the last axis for
+            length 1 fields
+        """
+        field = self.fields[name]
+        if field.length == 1:
+            return observations[..., field.offset]
+        return observations[..., self.slice(name)]
+
+    def views(self, observations: np.ndarray) -> Box:
+        return Box({name: self.view(observations, name)
+                    for name in self.fields})
+
+    def to_dict(self) -> dict:
+        return dict(size=self.size,
+                    fields=[field._asdict() for field in self])
+
+    @classmethod
+    def from_dict(cls, d):
+        ret = cls(ObservationField(**f) for f in d['fields'])
+        if ret.size != d['size']:
+            raise ValueError(f'Fields add up to {ret.size} inputs, '
+                             f'expected {d["size"]}')
+        return ret
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            return cls.from_dict(json.load(f))
+
+
+def test_observation_schema():
+    import os
+    import tempfile
+    schema = ObservationSchema()
+    schema.add('angles_ahead', 2, 'rad')
+    schema.add('speed', 1, 'm/s')
+    assert schema['speed'].offset == 2
+    assert len(schema) == 3
+
+    batch = np.arange(12.).reshape(4, 3)
+    speeds = schema.view(batch, 'speed')
+    assert list(speeds) == [2, 5, 8, 11]
+    assert np.shares_memory(speeds, batch)
+    assert schema.views(batch[0]).angles_ahead.tolist() == [0, 1]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'observation_schema.json')
+        schema.save(path)
+        assert ObservationSchema.load(path) == schema
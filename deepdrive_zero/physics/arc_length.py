@@ -0,0 +1,113 @@
+import numpy as np
+from numba import njit
+
+from deepdrive_zero.constants import CACHE_NUMBA
+from deepdrive_zero.utils import get_angle
+
+
+@njit(cache=CACHE_NUMBA, nogil=True)
+def get_arc_lengths(points):
+    """:return: Cumulative distance along points for each point"""
+    ret = np.zeros(len(points))
+    for i in range(1, len(points)):
+        dx = points[i, 0] - points[i - 1, 0]
+        dy = points[i, 1] - points[i - 1, 1]
+        ret[i] = ret[i - 1] + np.sqrt(dx * dx + dy * dy)
+    return ret
+
+
+@njit(cache=CACHE_NUMBA, nogil=True)
+def sample_route(points, arc_lengths, distances):
+    """
+    Points and headings at arbitrary distances along a polyline route, by
+    binary search in its arc-length table and linear interpolation.
+
+    :param points: (n, 2) route points
+    :param arc_lengths: Cumulative distance for each point, see get_arc_lengths
+    :param distances: Distances along the route to sample, clamped to the
+        start and end of the route
+    :return: (len(distances), 2) points and len(distances) headings in
+        radians of the segment each point lies on
+    """
+    ret_points = np.empty((len(distances), 2))
+    ret_headings = np.empty(len(distances))
+    last_seg = max(len(points) - 2, 0)
+    total_distance = arc_lengths[-1]
+    for i in range(len(distances)):
+        s = min(max(distances[i], 0.), total_distance)
+        seg = min(np.searchsorted(arc_lengths, s, side='right') - 1, last_seg)
+        if len(points) == 1:
+            ret_points[i] = points[0]
+            ret_headings[i] = 0.
+            continue
+        seg_length = arc_lengths[seg + 1] - arc_lengths[seg]
+        if seg_length > 0:
+            frac = (s - arc_lengths[seg]) / seg_length
+        else:
+            frac = 0.
+        dx = points[seg + 1, 0] - points[seg, 0]
+        dy = points[seg + 1, 1] - points[seg, 1]
+        ret_points[i, 0] = points[seg, 0] + frac * dx
+        ret_points[i, 1] = points[seg, 1] + frac * dy
+        ret_headings[i] = np.arctan2(dy, dx)
+    return ret_points, ret_headings
+
+
+@njit(cache=CACHE_NUMBA, nogil=True)
+def resample_equidistant(points, arc_lengths, spacing):
+    """
+    :return: Points spacing apart along the route, ending at the last point
+    """
+    total_distance = arc_lengths[-1]
+    num_points = int(total_distance // spacing) + 1
+    if total_distance % spacing > (spacing / 3):
+        # Add an extra point so there won't be big gap at the end
+        num_points += 1
+    distances = np.arange(num_points) * spacing
+    ret, _ = sample_route(points, arc_lengths, distances)
+    return ret
+
+
+@njit(cache=CACHE_NUMBA, nogil=True)
+def get_angles_ahead(points, arc_lengths, distance_along_route, speed,
+                     seconds_ahead, heading, ego_front,
+                     min_first_point_dist=2.):
+    """
+    Angles between our heading and where the route will be at each
+    seconds_ahead horizon at the current speed, looking at least
+    min_first_point_dist meters ahead. Horizons past the end of the route
+    use the last point.
+    """
+    distances = np.empty(len(seconds_ahead))
+    for i in range(len(seconds_ahead)):
+        distances[i] = distance_along_route + max(
+            speed * seconds_ahead[i], min_first_point_dist)
+    points_ahead, _ = sample_route(points, arc_lengths, distances)
+    ret = np.empty(len(seconds_ahead))
+    for i in range(len(seconds_ahead)):
+        ret[i] = get_angle(heading, points_ahead[i] - ego_front)
+    return ret
+
+
+def test_sample_route():
+    points = np.array([[0., 0.], [10., 0.], [10., 10.]])
+    arc_lengths = get_arc_lengths(points)
+    assert list(arc_lengths) == [0, 10, 20]
+    sampled, headings = sample_route(
+        points, arc_lengths, np.array([-1., 5., 10., 15., 30.]))
+    assert np.allclose(sampled, [[0, 0], [5, 0], [10, 0], [10, 5], [10, 10]])
+    assert np.allclose(headings, [0, 0, np.pi / 2, np.pi / 2, np.pi / 2])
+
+    resampled = resample_equidistant(points, arc_lengths, 3.)
+    assert len(resampled) == 8
+    assert np.allclose(resampled[-1], [10, 10])
+
+
+def test_get_angles_ahead():
+    points = np.array([[0., 0.], [10., 0.], [10., 10.]])
+    angles = get_angles_ahead(
+        points, get_arc_lengths(points), distance_along_route=10.,
+        speed=10., seconds_ahead=np.array([0.5, 1., 5.]),
+        heading=np.array([1., 0.]), ego_front=np.array([10., 0.]))
+    # Route turns left at the corner we're on, our convention is left < 0
+    assert np.allclose(angles, -np.pi / 2)
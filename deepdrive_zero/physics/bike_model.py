@@ -3,13 +3,31 @@ from math import pi, cos, sin
 import numpy as np
 from numba import njit
 
-from deepdrive_zero.constants import USE_VOYAGE, VEHICLE_WIDTH, CACHE_NUMBA
+from deepdrive_zero.constants import USE_VOYAGE, CACHE_NUMBA
 
 TUNED_FPS = 1 / 60  # The FPS we tuned friction ratios at
 ROTATIONAL_FRICTION = 0.95
 LONGITUDINAL_FRICTION = 0.999
 BRAKE_FRICTION = 0.96
 
+# Columns of the vehicle parameter rows the kernels take as vehicle_model,
+# see vehicles.py
+VP_CG_TO_FRONT_AXLE = 0
+VP_CG_TO_REAR_AXLE = 1
+VP_SLIP = 2  # cg_to_front_axle / (cg_to_front_axle + cg_to_rear_axle)
+VP_ROTATIONAL_FRICTION = 3
+VP_LONGITUDINAL_FRICTION = 4
+VP_BRAKE_FRICTION = 5
+VP_ROTATIONAL_FRICTION_RATE = 6  # ln(friction) / TUNED_FPS, for integrators
+VP_LONGITUDINAL_FRICTION_RATE = 7
+VP_BRAKE_FRICTION_RATE = 8
+VP_WIDTH = 9
+VP_LENGTH = 10
+VP_MAX_ACCEL = 11  # m/s^2
+VP_MAX_BRAKE = 12  # m/s^2
+VP_STEERING_RANGE = 13  # radians, lock to lock
+NUM_VEHICLE_PARAMS = 14
+
 @njit(cache=CACHE_NUMBA, nogil=True)
 def bike_with_friction_step(
         steer,
@@ -39,8 +57,7 @@ def bike_with_friction_step(
         Whether to slow angular velocity every time step
     :param add_longitudinal_friction: (bool)
         Whether to slow velocity every time step
-    :param vehicle_model:
-        Distance from center of gravity to front and rear axles
+    :param vehicle_model: Vehicle parameter row, see VP_* and vehicles.py
     :return:
     """
     steer = min(pi, steer)
@@ -53,15 +70,18 @@ def bike_with_friction_step(
     friction_exponent = (dt / TUNED_FPS)
     if add_rotational_friction:
         # Causes steering to drift back to zero
-        angle_change *= ROTATIONAL_FRICTION ** friction_exponent
+        angle_change *= (vehicle_model[VP_ROTATIONAL_FRICTION] **
+                         friction_exponent)
     if add_longitudinal_friction:
-        speed *= LONGITUDINAL_FRICTION ** friction_exponent
+        speed *= (vehicle_model[VP_LONGITUDINAL_FRICTION] **
+                  friction_exponent)
 
     # TODO: We should just output the desired accel (+-) and allow higher magnitude
     #   negative accel than positive due to brake force. Otherwise network will
     #   be riding brakes more than reasonable (esp without disincentivizing this
     #   in the reward)
-    speed = BRAKE_FRICTION ** (brake * friction_exponent) * speed
+    speed = (vehicle_model[VP_BRAKE_FRICTION] ** (brake * friction_exponent)
+             * speed)
 
     theta1 = angle
     theta2 = theta1 + pi / 2
@@ -96,11 +116,11 @@ def f_KinBkMdl(state, steer_angle, accel, vehicle_model, dt):
     speed = state[3]         # meters per second
 
     # extract parameters
-    # Distance from center of gravity to front and rear axles
-    (cg_to_front_axle, cg_to_rear_axle) = vehicle_model
+    # Distance from center of gravity to rear axle
+    cg_to_rear_axle = vehicle_model[VP_CG_TO_REAR_AXLE]
 
     # compute slip angle
-    slip = cg_to_front_axle / (cg_to_front_axle + cg_to_rear_axle)
+    slip = vehicle_model[VP_SLIP]
     slip_angle = np.arctan(slip * np.tan(steer_angle))
 
     # compute next state
@@ -193,17 +213,18 @@ def get_angle_for_accel_pid(target_accel, current_accel, current_angle,
     return throttle
 
 
-def get_vehicle_model(width):
+def get_vehicle_model(width, front_bias=None):
     """
     :param width: Width of vehicle  # TODO: Should be length! Change after ablation test
+    :param front_bias: Fraction of width the center of gravity is forward of
+        center, defaults to the Voyage van's if USE_VOYAGE
     :return: Distance from center of gravity to front and rear axles
     """
     # Bias towards the front a bit
     # https://www.fcausfleet.com/content/dam/fca-fleet/na/fleet/en_us/chrysler/2017/pacifica/vlp/docs/Pacifica_Specifications.pdf
-    if USE_VOYAGE:
-        bias_towards_front = .05 * width
-    else:
-        bias_towards_front = 0
+    if front_bias is None:
+        front_bias = .05 if USE_VOYAGE else 0
+    bias_towards_front = front_bias * width
 
     # Center of gravity
     center_of_gravity = (width / 2) + bias_towards_front
@@ -216,7 +237,8 @@ def get_vehicle_model(width):
 
 
 def test_bike_with_friction_step():
-    vehicle_model = get_vehicle_model(VEHICLE_WIDTH)
+    from deepdrive_zero.vehicles import get_vehicle_params
+    vehicle_model = get_vehicle_params()
 
     # Do nothing
     x, y, angle, angle_change, speed = bike_with_friction_step(
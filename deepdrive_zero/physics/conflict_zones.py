@@ -0,0 +1,338 @@
+"""
+Conflict zones
+
+Regions where two agents' routes cross or merge, stored as arc-length
+intervals along each of the two routes. These are computed once whenever
+routes change, after which checking whether other agents are approaching
+a zone we're about to enter (e.g. to yield when turning across oncoming
+traffic) just compares each agent's distance along its route to the zone
+bounds.
+
+All arc-lengths are measured along route waypoints from the first waypoint
+and correspond to the position of the front of the vehicle, i.e.
+Agent.distance_along_route.
+"""
+import math
+
+import numpy as np
+from numba import njit
+
+from deepdrive_zero.constants import CACHE_NUMBA
+
+CROSSING_ZONE = 0
+MERGE_ZONE = 1
+
+# Zone columns
+ZONE_ROUTE_A = 0
+ZONE_ROUTE_B = 1
+ZONE_ENTRY_A = 2
+ZONE_EXIT_A = 3
+ZONE_ENTRY_B = 4
+ZONE_EXIT_B = 5
+ZONE_TYPE = 6
+NUM_ZONE_COLS = 7
+
+# Status columns
+STATUS_DIST_TO_ENTRY = 0
+STATUS_DIST_TO_EXIT = 1
+STATUS_ARRIVAL_TIME = 2
+NUM_STATUS_COLS = 3
+
+# Segments closer to parallel than this are checked for merges, not crossings
+MERGE_MAX_SIN = math.sin(math.radians(15))
+MIN_ARRIVAL_SPEED = 0.01  # m/s, below which we never arrive
+
+
+def get_conflict_zones(routes, half_lane_widths, vehicle_lengths):
+    """
+    :param routes: List of n x 2 route waypoints in meters, one per agent
+    :param half_lane_widths: Half lane width for each route
+    :param vehicle_lengths: Length of the vehicle driving each route
+    :return: num_zones x NUM_ZONE_COLS array, see ZONE_* columns
+    """
+    points = np.concatenate([np.asarray(r, dtype=np.float64).reshape(-1, 2)
+                             for r in routes])
+    offsets = np.cumsum([0] + [len(r) for r in routes]).astype(np.int64)
+    return _get_conflict_zones(
+        points, offsets,
+        np.asarray(half_lane_widths, dtype=np.float64),
+        np.asarray(vehicle_lengths, dtype=np.float64))
+
+
+@njit(cache=CACHE_NUMBA, nogil=True)
+def _get_conflict_zones(points, offsets, half_lane_widths, vehicle_lengths):
+    num_routes = len(offsets) - 1
+    max_zones = 0
+    for a in range(num_routes):
+        for b in range(a + 1, num_routes):
+            max_zones += (max(offsets[a + 1] - offsets[a] - 1, 0) *
+                          max(offsets[b + 1] - offsets[b] - 1, 0))
+    zones = np.empty((max_zones, NUM_ZONE_COLS))
+    num_zones = 0
+    for a in range(num_routes):
+        for b in range(a + 1, num_routes):
+            pair_start = num_zones
+            num_zones = _add_pair_zones(points, offsets, half_lane_widths,
+                                        vehicle_lengths, a, b, zones,
+                                        num_zones)
+            num_zones = _coalesce_zones(zones, pair_start, num_zones)
+    return zones[:num_zones].copy()
+
+
+@njit(cache=CACHE_NUMBA, nogil=True)
+def _add_pair_zones(points, offsets, half_lane_widths, vehicle_lengths,
+                    a, b, zones, num_zones):
+    s_a = 0.
+    for i in range(offsets[a], offsets[a + 1] - 1):
+        p0x, p0y = points[i]
+        p1x, p1y = points[i + 1]
+        len_a = math.hypot(p1x - p0x, p1y - p0y)
+        if len_a == 0:
+            continue
+        dax, day = (p1x - p0x) / len_a, (p1y - p0y) / len_a
+        s_b = 0.
+        for j in range(offsets[b], offsets[b + 1] - 1):
+            q0x, q0y = points[j]
+            q1x, q1y = points[j + 1]
+            len_b = math.hypot(q1x - q0x, q1y - q0y)
+            if len_b == 0:
+                continue
+            dbx, dby = (q1x - q0x) / len_b, (q1y - q0y) / len_b
+            sin_ab = dax * dby - day * dbx
+            rx, ry = q0x - p0x, q0y - p0y
+            if abs(sin_ab) >= MERGE_MAX_SIN:
+                # Crossing - solve p0 + t * da = q0 + u * db
+                t = (rx * dby - ry * dbx) / sin_ab
+                u = (rx * day - ry * dax) / sin_ab
+                if 0 <= t <= len_a and 0 <= u <= len_b:
+                    # Distance travelled along one route while inside the
+                    # other route's lane
+                    extent_a = half_lane_widths[b] / abs(sin_ab)
+                    extent_b = half_lane_widths[a] / abs(sin_ab)
+                    _set_zone(zones[num_zones], a, b,
+                              s_a + t - extent_a,
+                              s_a + t + extent_a + vehicle_lengths[a],
+                              s_b + u - extent_b,
+                              s_b + u + extent_b + vehicle_lengths[b],
+                              CROSSING_ZONE)
+                    num_zones += 1
+            elif dax * dbx + day * dby > 0:
+                # Near parallel and in the same direction, merge if the
+                # center lines are within half a lane of each other.
+                lateral0 = abs(rx * day - ry * dax)
+                lateral1 = abs((q1x - p0x) * day - (q1y - p0y) * dax)
+                max_lateral = (half_lane_widths[a] + half_lane_widths[b]) / 2
+                if lateral0 < max_lateral or lateral1 < max_lateral:
+                    # Overlap of b projected onto a
+                    ta0 = max(0., min(len_a, rx * dax + ry * day))
+                    ta1 = max(0., min(len_a, (q1x - p0x) * dax +
+                                      (q1y - p0y) * day))
+                    # Overlap of a projected onto b
+                    tb0 = max(0., min(len_b, -(rx * dbx + ry * dby)))
+                    tb1 = max(0., min(len_b, (p1x - q0x) * dbx +
+                                      (p1y - q0y) * dby))
+                    if ta1 > ta0 and tb1 > tb0:
+                        _set_zone(zones[num_zones], a, b,
+                                  s_a + ta0,
+                                  s_a + ta1 + vehicle_lengths[a],
+                                  s_b + tb0,
+                                  s_b + tb1 + vehicle_lengths[b],
+                                  MERGE_ZONE)
+                        num_zones += 1
+            s_b += len_b
+        s_a += len_a
+    return num_zones
+
+
+@njit(cache=CACHE_NUMBA, nogil=True)
+def _set_zone(zone, route_a, route_b, entry_a, exit_a, entry_b, exit_b,
+              zone_type):
+    zone[ZONE_ROUTE_A] = route_a
+    zone[ZONE_ROUTE_B] = route_b
+    zone[ZONE_ENTRY_A] = entry_a
+    zone[ZONE_EXIT_A] = exit_a
+    zone[ZONE_ENTRY_B] = entry_b
+    zone[ZONE_EXIT_B] = exit_b
+    zone[ZONE_TYPE] = zone_type
+
+
+@njit(cache=CACHE_NUMBA, nogil=True)
+def _coalesce_zones(zones, start, end):
+    """
+    Merge zones of the same pair that overlap on both routes, i.e. where
+    a crossing lands exactly on a shared waypoint or consecutive segments
+    merge.
+    """
+    if end - start < 2:
+        return end
+    order = np.argsort(zones[start:end, ZONE_ENTRY_A]) + start
+    pair = zones[order].copy()
+    out = start
+    zones[out] = pair[0]
+    for k in range(1, len(pair)):
+        z = pair[k]
+        prev = zones[out]
+        if (z[ZONE_TYPE] == prev[ZONE_TYPE] and
+                z[ZONE_ENTRY_A] <= prev[ZONE_EXIT_A] and
+                z[ZONE_ENTRY_B] <= prev[ZONE_EXIT_B] and
+                prev[ZONE_ENTRY_B] <= z[ZONE_EXIT_B]):
+            prev[ZONE_EXIT_A] = max(prev[ZONE_EXIT_A], z[ZONE_EXIT_A])
+            prev[ZONE_ENTRY_B] = min(prev[ZONE_ENTRY_B], z[ZONE_ENTRY_B])
+            prev[ZONE_EXIT_B] = max(prev[ZONE_EXIT_B], z[ZONE_EXIT_B])
+        else:
+            out += 1
+            zones[out] = z
+    return out + 1
+
+
+@njit(cache=CACHE_NUMBA, nogil=True)
+def get_conflict_zone_status(zones, distances_along_route, speeds):
+    """
+    :param zones: Output of get_conflict_zones
+    :param distances_along_route: Front arc-length of each route's agent
+    :param speeds: Speed of each route's agent in m/s
+    :return: num_zones x 2 x NUM_STATUS_COLS array with distance to entry,
+        distance to exit and estimated arrival time for route a and b of each
+        zone. Arrival time is zero once inside the zone and inf if the zone
+        has been exited or the agent is stopped.
+    """
+    status = np.empty((len(zones), 2, NUM_STATUS_COLS))
+    for z in range(len(zones)):
+        for k in range(2):
+            route = int(zones[z, ZONE_ROUTE_A + k])
+            s = distances_along_route[route]
+            to_entry = zones[z, ZONE_ENTRY_A + 2 * k] - s
+            to_exit = zones[z, ZONE_EXIT_A + 2 * k] - s
+            if to_exit < 0:
+                arrival_time = np.inf
+            elif to_entry <= 0:
+                arrival_time = 0.
+            elif speeds[route] < MIN_ARRIVAL_SPEED:
+                arrival_time = np.inf
+            else:
+                arrival_time = to_entry / speeds[route]
+            status[z, k, STATUS_DIST_TO_ENTRY] = to_entry
+            status[z, k, STATUS_DIST_TO_EXIT] = to_exit
+            status[z, k, STATUS_ARRIVAL_TIME] = arrival_time
+    return status
+
+
+@njit(cache=CACHE_NUMBA, nogil=True)
+def get_approaching_agents(zones, distances_along_route, speeds):
+    """
+    Per-step query of which agents are approaching each agent's conflict
+    zones.
+
+    :return: (approach_distances, arrival_times), both num_routes x num_routes
+        where row i, column j holds the minimum distance / estimated arrival
+        time for agent j to reach a conflict zone it shares with agent i.
+        Entries are inf where agent j is not approaching, i.e. it has no
+        shared zone, or is already inside or past all shared zones.
+    """
+    num_routes = len(distances_along_route)
+    approach_distances = np.full((num_routes, num_routes), np.inf)
+    arrival_times = np.full((num_routes, num_routes), np.inf)
+    status = get_conflict_zone_status(zones, distances_along_route, speeds)
+    for z in range(len(zones)):
+        for k in range(2):
+            ego = int(zones[z, ZONE_ROUTE_A + k])
+            other = int(zones[z, ZONE_ROUTE_B - k])
+            to_entry = status[z, 1 - k, STATUS_DIST_TO_ENTRY]
+            if to_entry > 0:
+                approach_distances[ego, other] = min(
+                    approach_distances[ego, other], to_entry)
+                arrival_times[ego, other] = min(
+                    arrival_times[ego, other],
+                    status[z, 1 - k, STATUS_ARRIVAL_TIME])
+    return approach_distances, arrival_times
+
+
+@njit(cache=CACHE_NUMBA, nogil=True)
+def get_crossing_conflicts(zones, distances_along_route):
+    """
+    Per-step query of which agents should yield, i.e. have yet to clear a
+    zone where their route crosses another that the other agent has yet to
+    enter. Merges and zones we've already exited don't count.
+
+    :return: (num_routes,) bool
+    """
+    ret = np.zeros(len(distances_along_route), dtype=np.bool_)
+    for z in range(len(zones)):
+        if zones[z, ZONE_TYPE] != CROSSING_ZONE:
+            continue
+        for k in range(2):
+            ego = int(zones[z, ZONE_ROUTE_A + k])
+            other = int(zones[z, ZONE_ROUTE_B - k])
+            ego_to_exit = (zones[z, ZONE_EXIT_A + 2 * k] -
+                           distances_along_route[ego])
+            other_to_entry = (zones[z, ZONE_ENTRY_B - 2 * k] -
+                              distances_along_route[other])
+            if ego_to_exit > 0 and other_to_entry > 0:
+                ret[ego] = True
+    return ret
+
+
+def test_get_conflict_zones():
+    north = np.array([(0., -10.), (0., 10.)])
+    east = np.array([(-10., 0.), (10., 0.)])
+    south_adjacent = np.array([(-3., 10.), (-3., -10.)])
+    zones = get_conflict_zones([north, east, south_adjacent],
+                               half_lane_widths=[1.5, 1.5, 1.5],
+                               vehicle_lengths=[5., 5., 5.])
+
+    # Opposing adjacent lanes don't conflict, both cross the east route
+    assert len(zones) == 2
+    assert list(zones[:, ZONE_ROUTE_A]) == [0, 1]
+    assert list(zones[:, ZONE_ROUTE_B]) == [1, 2]
+    north_east = zones[0]
+    assert north_east[ZONE_TYPE] == CROSSING_ZONE
+    assert np.isclose(north_east[ZONE_ENTRY_A], 8.5)
+    assert np.isclose(north_east[ZONE_EXIT_A], 16.5)
+
+    # Merging into the same lane
+    merge = np.array([(-10., -1.), (-1., 0.), (10., 0.)])
+    zones = get_conflict_zones([east, merge], [1.5, 1.5], [5., 5.])
+    assert len(zones) == 1
+    assert zones[0][ZONE_TYPE] == MERGE_ZONE
+
+
+def test_get_approaching_agents():
+    north = np.array([(0., -10.), (0., 10.)])
+    east = np.array([(-10., 0.), (10., 0.)])
+    zones = get_conflict_zones([north, east], [1.5, 1.5], [5., 5.])
+    distances, times = get_approaching_agents(
+        zones, np.array([0., 4.5]), np.array([10., 2.]))
+    assert np.isclose(distances[0, 1], 4)
+    assert np.isclose(times[0, 1], 2)
+    assert np.isclose(times[1, 0], 0.85)
+
+    # Agent 1 inside zone, no longer approaching
+    distances, times = get_approaching_agents(
+        zones, np.array([0., 9.]), np.array([10., 0.]))
+    assert distances[0, 1] == np.inf
+    assert times[0, 1] == np.inf
+    assert np.isclose(distances[1, 0], 8.5)
+
+
+def test_get_crossing_conflicts():
+    north = np.array([(0., -10.), (0., 10.)])
+    east = np.array([(-10., 0.), (10., 0.)])
+    zones = get_conflict_zones([north, east], [1.5, 1.5], [5., 5.])
+
+    # Both approaching
+    assert list(get_crossing_conflicts(zones, np.array([0., 0.]))) == \
+        [True, True]
+
+    # Agent 0 past the zone while agent 1 is still approaching, so neither
+    # has anyone to yield to
+    assert list(get_crossing_conflicts(zones, np.array([17., 0.]))) == \
+        [False, False]
+
+    # Agent 0 inside the zone, so it no longer approaches for agent 1
+    assert list(get_crossing_conflicts(zones, np.array([10., 0.]))) == \
+        [True, False]
+
+    # Merging isn't crossing
+    merge = np.array([(-10., -1.), (-1., 0.), (10., 0.)])
+    zones = get_conflict_zones([east, merge], [1.5, 1.5], [5., 5.])
+    assert not get_crossing_conflicts(zones, np.array([0., 0.])).any()
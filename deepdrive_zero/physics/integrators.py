@@ -0,0 +1,298 @@
+"""
+Higher-order integration of the bike model in physics_step.
+
+bike_with_friction_step is an explicit Euler step of the following ODE with
+state [x, y, angle, angle_change, speed], where angle_change is the angle
+added per Euler step of length dt, and friction is a per step ratio tuned at
+TUNED_FPS, i.e. an exponential decay:
+
+    d(x, y)/dt        = speed rotated by angle_change + slip angle, then angle
+    d angle/dt        = angle_change / dt
+    d angle_change/dt = speed / cg_to_rear_axle * sin(slip_angle)
+                        + angle_change * ln(ROTATIONAL_FRICTION) / TUNED_FPS
+    d speed/dt        = accel + speed * (ln(LONGITUDINAL_FRICTION)
+                        + brake * ln(BRAKE_FRICTION)) / TUNED_FPS
+
+Controls ramp linearly from their previous to their new values over the
+observation, as physics_step does per substep.
+
+Euler steps move with the state at the start of each step, use controls
+from the end, and apply friction after each change, so bike_derivatives
+corrects for each of these. This makes the ODE's solution match the Euler
+trajectory to second order in dt, so one RK4 step (4 derivative evaluations)
+per observation stays within TOLERANCE_M of 12 Euler steps. Beyond
+MAX_PHYSICS_STEPS_PER_OBSERVATION the model mismatch dominates, so more
+integrator steps don't help. Run this module to benchmark accuracy vs cost
+across physics_steps_per_observation.
+"""
+
+import time
+from math import pi, cos, sin
+
+import numpy as np
+from box import Box
+from numba import njit
+
+from deepdrive_zero.constants import CACHE_NUMBA
+from deepdrive_zero.physics.bike_model import VP_CG_TO_REAR_AXLE, VP_SLIP, \
+    VP_ROTATIONAL_FRICTION_RATE, VP_LONGITUDINAL_FRICTION_RATE, \
+    VP_BRAKE_FRICTION_RATE
+
+INTEGRATOR_EULER = 0
+INTEGRATOR_MIDPOINT = 1
+INTEGRATOR_RK4 = 2
+INTEGRATORS = dict(
+    euler=INTEGRATOR_EULER,
+    midpoint=INTEGRATOR_MIDPOINT,
+    rk4=INTEGRATOR_RK4,
+)
+
+# Max distance from the Euler trajectory after an observation, see
+# compare_to_euler
+TOLERANCE_M = 0.01
+
+# Largest physics_steps_per_observation each integrator stays within
+# TOLERANCE_M at with one step per observation, see test_integrators
+MAX_PHYSICS_STEPS_PER_OBSERVATION = {
+    'midpoint': 3,
+    'rk4': 12,
+}
+
+
+@njit(cache=CACHE_NUMBA, nogil=True)
+def integrate_bike(state, t0, t1, ramp_duration, prev_steer, steer_change,
+                   prev_throttle, throttle_change, prev_brake, brake_change,
+                   dt, add_rotational_friction, add_longitudinal_friction,
+                   vehicle_model, integrator, num_steps):
+    """
+    Integrate the bike model ODE from t0 to t1 seconds into an observation.
+
+    :param state: [x, y, angle, angle_change, speed]
+    :param ramp_duration: Seconds over which controls go from prev_* to
+        prev_* + *_change
+    :param dt: Euler step the angle_change state is relative to
+    :param integrator: INTEGRATOR_MIDPOINT or INTEGRATOR_RK4
+    :param num_steps: Integrator steps from t0 to t1
+    :return: state at t1, number of derivative evaluations
+    """
+    params = np.array((ramp_duration, prev_steer, steer_change, prev_throttle,
+                       throttle_change, prev_brake, brake_change, dt,
+                       vehicle_model[VP_ROTATIONAL_FRICTION_RATE]
+                       if add_rotational_friction else 0.,
+                       vehicle_model[VP_LONGITUDINAL_FRICTION_RATE]
+                       if add_longitudinal_friction else 0.,
+                       vehicle_model[VP_BRAKE_FRICTION_RATE],
+                       vehicle_model[VP_SLIP],
+                       vehicle_model[VP_CG_TO_REAR_AXLE]))
+    y = state.copy()
+    h = (t1 - t0) / num_steps
+    evals = 0
+    for i in range(num_steps):
+        t = t0 + i * h
+        if integrator == INTEGRATOR_MIDPOINT:
+            k1 = bike_derivatives(t, y, params)
+            k2 = bike_derivatives(t + h / 2, y + h / 2 * k1, params)
+            y = y + h * k2
+            evals += 2
+        else:
+            k1 = bike_derivatives(t, y, params)
+            k2 = bike_derivatives(t + h / 2, y + h / 2 * k1, params)
+            k3 = bike_derivatives(t + h / 2, y + h / 2 * k2, params)
+            k4 = bike_derivatives(t + h, y + h * k3, params)
+            y = y + h / 6 * (k1 + 2 * k2 + 2 * k3 + k4)
+            evals += 4
+    return y, evals
+
+
+@njit(cache=CACHE_NUMBA, nogil=True)
+def bike_derivatives(t, state, params):
+    (ramp_duration, prev_steer, steer_change, prev_throttle, throttle_change,
+     prev_brake, brake_change, dt, rotational_friction_rate,
+     longitudinal_friction_rate, brake_friction_rate, slip,
+     cg_to_rear_axle) = params
+    # Euler substeps use the control value at the end of each substep
+    ramp = min(1., (t + dt / 2) / ramp_duration)
+    steer = prev_steer + ramp * steer_change
+    accel = prev_throttle + ramp * throttle_change
+    brake = prev_brake + ramp * brake_change
+    steer = max(-pi, min(pi, steer))
+
+    angle = state[2]
+    angle_change = state[3]
+    speed = state[4]
+
+    slip_angle = np.arctan(slip * np.tan(steer))
+
+    speed_friction_rate = (longitudinal_friction_rate +
+                           brake * brake_friction_rate)
+
+    ret = np.empty(5)
+    ret[3] = (_friction_gain(rotational_friction_rate, dt) *
+              speed / cg_to_rear_axle * sin(slip_angle) +
+              angle_change * rotational_friction_rate)
+    # Euler steps add angle_change after updating it
+    ret[2] = angle_change / dt + ret[3]
+    ret[4] = (_friction_gain(speed_friction_rate, dt) * accel +
+              speed * speed_friction_rate)
+
+    # Euler steps move with the state at the start of each step, i.e. half
+    # a step behind on average
+    angle -= dt / 2 * ret[2]
+    angle_change -= dt / 2 * ret[3]
+    speed -= dt / 2 * ret[4]
+
+    # Same frame conventions as bike_with_friction_step
+    change_x = speed * cos(angle_change + slip_angle)
+    change_y = speed * sin(angle_change + slip_angle)
+    theta2 = angle + pi / 2
+    ret[0] = change_x * cos(theta2) + change_y * cos(angle)
+    ret[1] = change_x * sin(theta2) + change_y * sin(angle)
+    return ret
+
+
+@njit(cache=CACHE_NUMBA, nogil=True)
+def _friction_gain(rate, dt):
+    """
+    Euler steps apply friction after adding the step's change, i.e.
+    v' = (v + dt * a) * r, which settles at a different speed than
+    dv/dt = a + v * ln(r) / dt. Scaling a by this makes both settle at,
+    and decay towards, the same values.
+    """
+    x = rate * dt
+    if x == 0:
+        return 1.
+    r = np.exp(x)
+    return x * r / (r - 1)
+
+
+def test_integrators():
+    for integrator, max_pso in MAX_PHYSICS_STEPS_PER_OBSERVATION.items():
+        for pso in (1, max_pso):
+            max_err, _, _, _ = compare_to_euler(integrator, pso)
+            assert max_err < TOLERANCE_M, (integrator, pso, max_err)
+
+
+def compare_to_euler(integrator, physics_steps_per_observation, num_steps=1,
+                     num_observations=120, seed=0):
+    """
+    Step random controls through physics_step with Euler and with integrator,
+    starting each observation from the Euler state.
+
+    :return: Max position error in meters after an observation, derivative
+        evaluations per observation, seconds per physics_step for Euler and
+        for integrator
+    """
+    from deepdrive_zero.vehicles import get_vehicle_params
+    rng = np.random.RandomState(seed)
+    vehicle_model = get_vehicle_params()
+    pso = physics_steps_per_observation
+    dt = 1 / 60
+    euler = _get_benchmark_state()
+    max_err = 0.
+    evals = 0
+    euler_duration = 0.
+    duration = 0.
+    for _ in range(num_observations):
+        steer = rng.uniform(-0.05, 0.05)
+        throttle = rng.uniform(-2, 4)
+        brake = float(rng.rand() < 0.1)
+
+        start = time.perf_counter()
+        other = _benchmark_step(euler, steer, throttle, brake, dt, pso,
+                                vehicle_model, INTEGRATORS[integrator],
+                                num_steps)
+        duration += time.perf_counter() - start
+
+        _, num_evals = integrate_bike(
+            np.array((euler.x, euler.y, euler.angle, euler.angle_change,
+                      euler.speed)),
+            0., pso * dt, pso * dt, euler.steer, steer - euler.steer,
+            euler.throttle, throttle - euler.throttle, euler.brake,
+            brake - euler.brake, dt, True, True, vehicle_model,
+            INTEGRATORS[integrator], num_steps)
+        evals += num_evals
+
+        start = time.perf_counter()
+        euler = _benchmark_step(euler, steer, throttle, brake, dt, pso,
+                                vehicle_model, INTEGRATOR_EULER, 1)
+        euler_duration += time.perf_counter() - start
+
+        max_err = max(max_err, np.hypot(euler.x - other.x,
+                                        euler.y - other.y))
+    return (max_err, evals / num_observations,
+            euler_duration / num_observations, duration / num_observations)
+
+
+def _get_benchmark_state():
+    zero2d = np.zeros(2)
+    return Box(acceleration=zero2d, angle=0., angle_change=0.,
+               angular_velocity=0., gforce=0., jerk=zero2d, max_gforce=0.,
+               max_jerk=0., speed=0., x=0., y=0., throttle=0., brake=0.,
+               steer=0., velocity=zero2d, distance_traveled=0.)
+
+
+def _benchmark_step(s, steer, throttle, brake, dt, pso, vehicle_model,
+                    integrator, num_steps):
+    from deepdrive_zero.physics.physics_step import physics_step
+    out = physics_step(
+        throttle=throttle,
+        add_longitudinal_friction=True,
+        add_rotational_friction=True,
+        brake=brake,
+        constrain_controls=False,
+        curr_acceleration=s.acceleration,
+        jerk=s.jerk,
+        curr_angle=s.angle,
+        curr_angle_change=s.angle_change,
+        curr_angular_velocity=s.angular_velocity,
+        curr_gforce=s.gforce,
+        curr_max_gforce=s.max_gforce,
+        curr_max_jerk=s.max_jerk,
+        curr_speed=s.speed,
+        curr_velocity=s.velocity,
+        curr_x=s.x,
+        curr_y=s.y,
+        distance_traveled=s.distance_traveled,
+        dt=dt,
+        ignore_brake=False,
+        max_throttle_change=0.,
+        max_brake_change=0.,
+        max_steer_change=0.,
+        interpolation_steps=pso,
+        prev_throttle=s.throttle,
+        prev_brake=s.brake,
+        prev_steer=s.steer,
+        steer=steer,
+        vehicle_model=vehicle_model,
+        start_interpolation_index=0,
+        interpolation_range=pso,
+        integrator=integrator,
+        integrator_steps=num_steps)
+    return Box(zip(('acceleration', 'angle', 'angle_change',
+                    'angular_velocity', 'gforce', 'jerk', 'max_gforce',
+                    'max_jerk', 'speed', 'x', 'y', 'throttle', 'brake',
+                    'steer', 'velocity', 'distance_traveled'), out))
+
+
+def main():
+    """
+    Benchmark accuracy vs cost relative to Euler across
+    physics_steps_per_observation
+    """
+    configs = (('midpoint', 1), ('midpoint', 2), ('rk4', 1), ('rk4', 2))
+    for integrator, _ in configs:
+        compare_to_euler(integrator, 1)  # Compile
+    print(f'{"pso":>4} {"integrator":>10} {"steps":>5} {"evals":>6} '
+          f'{"euler evals":>11} {"max err (m)":>11} {"us/obs":>7} '
+          f'{"euler us/obs":>12}')
+    for pso in (1, 3, 6, 12, 24):
+        for integrator, num_steps in configs:
+            err, evals, euler_duration, duration = compare_to_euler(
+                integrator, pso, num_steps=num_steps)
+            print(f'{pso:>4} {integrator:>10} {num_steps:>5} {evals:>6.1f} '
+                  f'{pso:>11} {err:>11.5f} {duration * 1e6:>7.1f} '
+                  f'{euler_duration * 1e6:>12.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,152 @@
+"""
+Neighbors
+
+Pick the K agents most relevant to each ego, i.e. nearest or soonest to
+collide, so observations stay a fixed size however many vehicles are
+simulated. Agents are bucketed into a uniform grid sized for about one
+agent per cell, then each query searches rings of cells outward until no
+unvisited agent could rank in its top K.
+"""
+import math
+
+import numpy as np
+from numba import njit
+
+from deepdrive_zero.constants import CACHE_NUMBA
+
+NEIGHBOR_ORDER_DISTANCE = 'distance'
+NEIGHBOR_ORDER_TTC = 'ttc'
+NEIGHBOR_ORDERS = (NEIGHBOR_ORDER_DISTANCE, NEIGHBOR_ORDER_TTC)
+
+# Floor on closing speed for time to collision so stopped pairs still rank
+# by distance, m/s
+MIN_CLOSING_SPEED = 0.1
+
+
+@njit(cache=CACHE_NUMBA, nogil=True)
+def build_grid(positions):
+    """
+    :param positions: (N, 2)
+    :return: (min_x, min_y, cell_size, dims, cell_starts, order) where agents
+        in cell (cx, cy) are order[cell_starts[c]:cell_starts[c + 1]] for
+        c = cx * dims + cy
+    """
+    n = len(positions)
+    min_x, min_y = positions[:, 0].min(), positions[:, 1].min()
+    extent = max(positions[:, 0].max() - min_x, positions[:, 1].max() - min_y)
+    dims = max(1, int(math.ceil(math.sqrt(n))))
+    cell_size = extent / dims if extent > 0 else 1.
+    cells = np.empty(n, dtype=np.int64)
+    cell_starts = np.zeros(dims * dims + 1, dtype=np.int64)
+    for i in range(n):
+        cx, cy = get_cell(positions[i, 0], positions[i, 1], min_x, min_y,
+                          cell_size, dims)
+        cells[i] = cx * dims + cy
+        cell_starts[cells[i] + 1] += 1
+    for c in range(dims * dims):
+        cell_starts[c + 1] += cell_starts[c]
+    fill = cell_starts[:-1].copy()
+    order = np.empty(n, dtype=np.int64)
+    for i in range(n):
+        order[fill[cells[i]]] = i
+        fill[cells[i]] += 1
+    return min_x, min_y, cell_size, dims, cell_starts, order
+
+
+@njit(cache=CACHE_NUMBA, nogil=True)
+def get_cell(x, y, min_x, min_y, cell_size, dims):
+    """:return: Grid cell containing (x, y), clamped to the grid"""
+    cx = max(0, min(int(math.floor((x - min_x) / cell_size)), dims - 1))
+    cy = max(0, min(int(math.floor((y - min_y) / cell_size)), dims - 1))
+    return cx, cy
+
+
+@njit(cache=CACHE_NUMBA, nogil=True)
+def query_neighbors(positions, speeds, grid, ego, k, by_ttc):
+    """
+    :param speeds: (N,) speed magnitudes, used if by_ttc
+    :param grid: build_grid(positions)
+    :param by_ttc: Rank by approximate time to collision, i.e. distance over
+        closing speed were both to drive straight at each other, rather than
+        by distance
+    :return: (k,) indices of ego's most relevant other agents, most relevant
+        first, padded with -1
+    """
+    min_x, min_y, cell_size, dims, cell_starts, order = grid
+    best = np.full(k, -1, dtype=np.int64)
+    best_keys = np.full(k, np.inf)
+    x, y = positions[ego, 0], positions[ego, 1]
+    cx, cy = get_cell(x, y, min_x, min_y, cell_size, dims)
+    max_closing_speed = max(speeds[ego] + speeds.max(), MIN_CLOSING_SPEED)
+    for r in range(dims):
+        # Perimeter of the ring of cells r cells away
+        for gx in range(cx - r, cx + r + 1):
+            if 0 <= gx < dims:
+                # Whole column on the ring's sides, just its ends otherwise
+                step = 1 if gx == cx - r or gx == cx + r else 2 * r
+                for gy in range(cy - r, cy + r + 1, step):
+                    if 0 <= gy < dims:
+                        _visit_cell(positions, speeds, cell_starts, order,
+                                    gx * dims + gy, ego, x, y, by_ttc, best,
+                                    best_keys)
+        # Unvisited agents are at least r cells away
+        bound = r * cell_size
+        if by_ttc:
+            bound /= max_closing_speed
+        if best_keys[k - 1] <= bound:
+            break
+    return best
+
+
+@njit(cache=CACHE_NUMBA, nogil=True)
+def _visit_cell(positions, speeds, cell_starts, order, cell, ego, x, y,
+                by_ttc, best, best_keys):
+    k = len(best)
+    for o in range(cell_starts[cell], cell_starts[cell + 1]):
+        j = order[o]
+        if j == ego:
+            continue
+        key = math.hypot(positions[j, 0] - x, positions[j, 1] - y)
+        if by_ttc:
+            key /= max(speeds[ego] + speeds[j], MIN_CLOSING_SPEED)
+        if key >= best_keys[k - 1]:
+            continue
+        m = k - 1
+        while m > 0 and best_keys[m - 1] > key:
+            best_keys[m] = best_keys[m - 1]
+            best[m] = best[m - 1]
+            m -= 1
+        best_keys[m] = key
+        best[m] = j
+
+
+@njit(cache=CACHE_NUMBA, nogil=True)
+def get_neighbors(positions, speeds, k, by_ttc):
+    """:return: (N, k) query_neighbors for every agent"""
+    grid = build_grid(positions)
+    ret = np.empty((len(positions), k), dtype=np.int64)
+    for i in range(len(positions)):
+        ret[i] = query_neighbors(positions, speeds, grid, i, k, by_ttc)
+    return ret
+
+
+def test_get_neighbors():
+    rng = np.random.RandomState(0)
+    positions = rng.rand(200, 2) * 100
+    positions[:20] = positions[20]  # Stacked agents share a cell
+    speeds = rng.rand(200) * 10
+    k = 5
+    for by_ttc in (False, True):
+        neighbors = get_neighbors(positions, speeds, k, by_ttc)
+        for i in range(len(positions)):
+            keys = np.linalg.norm(positions - positions[i], axis=1)
+            if by_ttc:
+                keys /= np.maximum(speeds[i] + speeds, MIN_CLOSING_SPEED)
+            keys[i] = np.inf
+            assert i not in neighbors[i]
+            assert np.allclose(keys[neighbors[i]], np.sort(keys)[:k])
+
+    # Fewer agents than k are padded
+    neighbors = get_neighbors(positions[:3], speeds[:3], k, False)
+    assert (neighbors[:, 2:] == -1).all()
+    assert sorted(neighbors[0, :2]) == [1, 2]
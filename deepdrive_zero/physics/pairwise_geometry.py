@@ -0,0 +1,117 @@
+"""
+Pairwise geometry
+
+What every agent observes about every other agent, computed for all pairs
+in one kernel call rather than per agent and per corner in Python. Row i,
+column j of the result holds agent j's features as seen from agent i,
+laid out as in Agent.get_observation_schema's other_agent_* fields.
+"""
+import math
+
+import numpy as np
+from numba import njit
+
+from deepdrive_zero.constants import CACHE_NUMBA
+
+# Feature columns
+PG_RELATIVE_VELOCITY = 0  # x, y of their velocity minus ours
+PG_VELOCITY = 2  # x, y
+PG_ACCELERATION = 4  # x, y
+PG_CORNERS = 6  # (angle, distance) from our front to each of their 4 corners
+NUM_PAIRWISE_FEATURES = 14
+
+
+@njit(cache=CACHE_NUMBA, nogil=True)
+def get_pairwise_geometry(fronts, headings, velocities, accelerations, rects):
+    """
+    :param fronts: (N, 2) front middle of each vehicle
+    :param headings: (N, 2) vector from center to front of each vehicle
+    :param velocities: (N, 2)
+    :param accelerations: (N, 2)
+    :param rects: (N, 4, 2) corners, i.e. Agent.ego_rect
+    :return: (N, N, NUM_PAIRWISE_FEATURES) features, see PG_*
+    """
+    n = len(fronts)
+    ret = np.zeros((n, n, NUM_PAIRWISE_FEATURES))
+    others = np.arange(n)
+    for i in range(n):
+        ret[i] = get_ego_geometry(i, others, fronts, headings, velocities,
+                                  accelerations, rects)
+    return ret
+
+
+@njit(cache=CACHE_NUMBA, nogil=True)
+def get_ego_geometry(ego, others, fronts, headings, velocities,
+                     accelerations, rects):
+    """
+    Row ego of get_pairwise_geometry, for just the others columns, so a
+    single agent's observation is O(N) rather than O(N^2)
+
+    :param others: (M,) indices of the agents to observe
+    :return: (M, NUM_PAIRWISE_FEATURES)
+    """
+    ret = np.zeros((len(others), NUM_PAIRWISE_FEATURES))
+    i = ego
+    hx, hy = headings[i, 0], headings[i, 1]
+    h_norm = math.hypot(hx, hy)
+    hx, hy = hx / h_norm, hy / h_norm
+    for m in range(len(others)):
+        j = others[m]
+        out = ret[m]
+        out[PG_RELATIVE_VELOCITY] = velocities[j, 0] - velocities[i, 0]
+        out[PG_RELATIVE_VELOCITY + 1] = velocities[j, 1] - velocities[i, 1]
+        out[PG_VELOCITY] = velocities[j, 0]
+        out[PG_VELOCITY + 1] = velocities[j, 1]
+        out[PG_ACCELERATION] = accelerations[j, 0]
+        out[PG_ACCELERATION + 1] = accelerations[j, 1]
+        for k in range(4):
+            dx = rects[j, k, 0] - fronts[i, 0]
+            dy = rects[j, k, 1] - fronts[i, 1]
+            dist = math.hypot(dx, dy)
+            out[PG_CORNERS + 2 * k] = _get_steer_angle(hx, hy, dx, dy, dist)
+            out[PG_CORNERS + 2 * k + 1] = dist
+    return ret
+
+
+@njit(cache=CACHE_NUMBA, nogil=True)
+def _get_steer_angle(hx, hy, dx, dy, dist):
+    """
+    utils.get_angle from unit heading (hx, hy) to (dx, dy), i.e. positive
+    to the right
+    """
+    if dist == 0:
+        return 0.
+    ux, uy = dx / dist, dy / dist
+    minor = hx * uy - hy * ux
+    sign = 1. if minor == 0 else -math.copysign(1., minor)
+    dot_p = min(max(hx * ux + hy * uy, -1.), 1.)
+    return sign * math.acos(dot_p)
+
+
+def test_get_pairwise_geometry():
+    from deepdrive_zero.utils import get_angle
+    # Facing up at the origin and facing right at (0, 10)
+    fronts = np.array([[0., 1.], [1., 10.]])
+    headings = np.array([[0., 1.], [1., 0.]])
+    velocities = np.array([[0., 2.], [3., 0.]])
+    accelerations = np.array([[0., 1.], [0., 0.]])
+    rects = np.array([[[-.5, 1.], [.5, 1.], [.5, -1.], [-.5, -1.]],
+                      [[1., 9.5], [1., 10.5], [-1., 10.5], [-1., 9.5]]])
+    geometry = get_pairwise_geometry(fronts, headings, velocities,
+                                     accelerations, rects)
+    assert geometry.shape == (2, 2, NUM_PAIRWISE_FEATURES)
+    ours = geometry[0, 1]
+    assert list(ours[PG_RELATIVE_VELOCITY:PG_VELOCITY]) == [3, -2]
+    assert list(ours[PG_VELOCITY:PG_ACCELERATION]) == [3, 0]
+    for k in range(4):
+        to_corner = rects[1, k] - fronts[0]
+        assert np.isclose(ours[PG_CORNERS + 2 * k],
+                          get_angle(headings[0], to_corner))
+        assert np.isclose(ours[PG_CORNERS + 2 * k + 1],
+                          np.linalg.norm(to_corner))
+    # Their front right corner is to our right
+    assert ours[PG_CORNERS] > 0
+
+    row = get_ego_geometry(1, np.array([0]), fronts, headings, velocities,
+                           accelerations, rects)
+    assert (row[0] == geometry[1, 0]).all()
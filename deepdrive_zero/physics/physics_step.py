@@ -1,4 +1,5 @@
 import math
+import time
 from copy import deepcopy
 
 import numpy as np
@@ -6,8 +7,24 @@ from box import Box
 from numba import njit
 
 from deepdrive_zero.constants import CACHE_NUMBA, MAX_STEER_CHANGE_PER_SECOND, \
-    MAX_ACCEL_CHANGE_PER_SECOND, VEHICLE_WIDTH
+    MAX_ACCEL_CHANGE_PER_SECOND
 from deepdrive_zero.physics.bike_model import bike_with_friction_step
+from deepdrive_zero.physics.integrators import INTEGRATOR_EULER, \
+    integrate_bike
+
+# Columns of physics_step's trajectory_out
+TRAJECTORY_FIELDS = ('x', 'y', 'angle', 'speed')
+
+# Indices into physics_step's comfort_out. G-force is in g's, jerk in m/s^3,
+# and integrals are over the seconds simulated in the call.
+COMFORT_GFORCE_MAX = 0
+COMFORT_GFORCE_MEAN = 1
+COMFORT_GFORCE_INTEGRAL = 2
+COMFORT_JERK_MAX = 3
+COMFORT_JERK_MEAN = 4
+COMFORT_JERK_INTEGRAL = 5
+NUM_COMFORT_METRICS = 6
+
 
 @njit(cache=CACHE_NUMBA, nogil=True)
 def physics_step(throttle,
@@ -40,7 +57,19 @@ def physics_step(throttle,
                  steer,
                  vehicle_model,
                  start_interpolation_index,
-                 interpolation_range, ):
+                 interpolation_range,
+                 integrator=INTEGRATOR_EULER,
+                 integrator_steps=1,
+                 trajectory_out=None,
+                 comfort_out=None,):
+    """
+    :param trajectory_out: Optional (interpolation_steps, 4) array that gets
+        the pose at the end of each substep, see TRAJECTORY_FIELDS, for
+        rendering or recording the full-rate trajectory
+    :param comfort_out: Optional NUM_COMFORT_METRICS array that gets the max,
+        mean and integral of g-force and jerk across all substeps, so comfort
+        penalties see spikes between observations
+    """
     if ignore_brake:
         brake = 0
     if curr_speed > 100:
@@ -56,8 +85,23 @@ def physics_step(throttle,
 
         i_steer, i_throttle, i_brake = 0, 0, 0
 
-    start_x = curr_x
-    start_y = curr_y
+    if integrator != INTEGRATOR_EULER:
+        return integrated_physics_step(
+            throttle_change, add_longitudinal_friction,
+            add_rotational_friction, brake, brake_change, curr_acceleration,
+            curr_angle, curr_angle_change, curr_max_gforce, curr_max_jerk,
+            curr_speed, curr_velocity, curr_x, curr_y, distance_traveled, dt,
+            interpolation_steps, prev_throttle, prev_brake, prev_steer,
+            steer_change, vehicle_model, start_interpolation_index,
+            interpolation_range, integrator, integrator_steps, trajectory_out,
+            comfort_out)
+
+    # Vectors are carried as scalar components through the substeps so the
+    # loop doesn't allocate, then packed once per call
+    vx, vy = curr_velocity[0], curr_velocity[1]
+    ax, ay = curr_acceleration[0], curr_acceleration[1]
+    jx, jy = jerk[0], jerk[1]
+    gforce_max = gforce_sum = jerk_max = jerk_sum = 0.
     out_steer = prev_steer
     out_throttle = prev_throttle
     out_brake = prev_brake
@@ -89,20 +133,17 @@ def physics_step(throttle,
          curr_x,
          curr_y,
          distance_traveled,
-         curr_acceleration,
-         curr_jerk,
-         curr_velocity) = interp_physics_step(
-            throttle,
+         ax, ay,
+         jx, jy,
+         vx, vy) = interp_physics_step(
             add_longitudinal_friction,
             add_rotational_friction,
             curr_angle,
             curr_angle_change,
-            curr_angular_velocity,
-            curr_gforce,
             curr_max_gforce,
             curr_max_jerk,
             curr_speed,
-            curr_velocity,
+            vx, vy,
             curr_x,
             curr_y,
             distance_traveled,
@@ -114,20 +155,35 @@ def physics_step(throttle,
             prev_x,
             prev_y,
             vehicle_model,
-            curr_acceleration,
-            jerk,)
+            ax, ay)
+
+        jerk_magnitude = math.hypot(jx, jy)
+        gforce_max = max(gforce_max, curr_gforce)
+        gforce_sum += curr_gforce
+        jerk_max = max(jerk_max, jerk_magnitude)
+        jerk_sum += jerk_magnitude
+
+        if trajectory_out is not None:
+            trajectory_out[i, 0] = curr_x
+            trajectory_out[i, 1] = curr_y
+            trajectory_out[i, 2] = curr_angle
+            trajectory_out[i, 3] = curr_speed
 
         if interp_index == interpolation_range - 1:
             out_steer = i_steer
             out_throttle = i_throttle
             out_brake = i_brake
 
-    return (curr_acceleration,
+    if comfort_out is not None:
+        set_comfort_metrics(comfort_out, gforce_max, gforce_sum, jerk_max,
+                            jerk_sum, interpolation_steps, dt)
+
+    return (np.array((ax, ay)),
             curr_angle,
             curr_angle_change,
             curr_angular_velocity,
             curr_gforce,
-            curr_jerk,
+            np.array((jx, jy)),
             curr_max_gforce,
             curr_max_jerk,
             curr_speed,
@@ -136,22 +192,148 @@ def physics_step(throttle,
             out_throttle,
             out_brake,
             out_steer,
-            curr_velocity,
+            np.array((vx, vy)),
+            distance_traveled)
+
+
+@njit(cache=CACHE_NUMBA, nogil=True)
+def integrated_physics_step(throttle_change,
+                            add_longitudinal_friction,
+                            add_rotational_friction,
+                            brake,
+                            brake_change,
+                            curr_acceleration,
+                            curr_angle,
+                            curr_angle_change,
+                            curr_max_gforce,
+                            curr_max_jerk,
+                            curr_speed,
+                            curr_velocity,
+                            curr_x,
+                            curr_y,
+                            distance_traveled,
+                            dt,
+                            interpolation_steps,
+                            prev_throttle,
+                            prev_brake,
+                            prev_steer,
+                            steer_change,
+                            vehicle_model,
+                            start_interpolation_index,
+                            interpolation_range,
+                            integrator,
+                            integrator_steps,
+                            trajectory_out=None,
+                            comfort_out=None):
+    """
+    physics_step for the interpolation_steps substeps with a higher-order
+    integrator, see integrators.py. G-force and jerk are measured across all
+    of the substeps rather than the last one, so comfort_out max and mean are
+    that one measurement, and trajectory_out poses are linearly interpolated
+    between the start and end of the step.
+    """
+    if brake:
+        ramp_prev_brake = prev_brake
+        ramp_brake_change = brake_change
+    else:
+        ramp_prev_brake = 0.
+        ramp_brake_change = 0.
+    t0 = start_interpolation_index * dt
+    t1 = (start_interpolation_index + interpolation_steps) * dt
+    state, _evals = integrate_bike(
+        np.array((curr_x, curr_y, curr_angle, curr_angle_change, curr_speed)),
+        t0, t1, interpolation_range * dt, prev_steer, steer_change,
+        prev_throttle, throttle_change, ramp_prev_brake, ramp_brake_change,
+        dt, add_rotational_friction, add_longitudinal_friction, vehicle_model,
+        integrator, integrator_steps)
+    x, y, angle, angle_change, speed = state
+    distance_traveled += math.hypot(x - curr_x, y - curr_y)
+
+    if trajectory_out is not None:
+        for i in range(interpolation_steps):
+            frac = (i + 1) / interpolation_steps
+            trajectory_out[i, 0] = curr_x + frac * (x - curr_x)
+            trajectory_out[i, 1] = curr_y + frac * (y - curr_y)
+            trajectory_out[i, 2] = curr_angle + frac * (angle - curr_angle)
+            trajectory_out[i, 3] = curr_speed + frac * (speed - curr_speed)
+
+    (gforce,
+     max_gforce,
+     max_jerk,
+     jx, jy,
+     ax, ay,
+     angular_velocity,
+     vx, vy) = get_gforce_levels(x=x,
+                                 y=y,
+                                 angle=angle,
+                                 prev_x=curr_x,
+                                 prev_y=curr_y,
+                                 prev_angle=curr_angle,
+                                 dt=t1 - t0,
+                                 prev_vx=curr_velocity[0],
+                                 prev_vy=curr_velocity[1],
+                                 prev_ax=curr_acceleration[0],
+                                 prev_ay=curr_acceleration[1],
+                                 max_gforce=curr_max_gforce,
+                                 max_jerk=curr_max_jerk)
+
+    if comfort_out is not None:
+        jerk_magnitude = math.hypot(jx, jy)
+        set_comfort_metrics(comfort_out, gforce, gforce * interpolation_steps,
+                            jerk_magnitude, jerk_magnitude * interpolation_steps,
+                            interpolation_steps, dt)
+
+    if start_interpolation_index + interpolation_steps == interpolation_range:
+        out_steer = prev_steer + steer_change
+        out_throttle = prev_throttle + throttle_change
+        out_brake = ramp_prev_brake + ramp_brake_change
+    else:
+        out_steer = prev_steer
+        out_throttle = prev_throttle
+        out_brake = prev_brake
+
+    return (np.array((ax, ay)),
+            angle,
+            angle_change,
+            angular_velocity,
+            gforce,
+            np.array((jx, jy)),
+            max_gforce,
+            max_jerk,
+            speed,
+            x,
+            y,
+            out_throttle,
+            out_brake,
+            out_steer,
+            np.array((vx, vy)),
             distance_traveled)
 
 
 @njit(cache=CACHE_NUMBA, nogil=True)
-def interp_physics_step(throttle,
-                        add_longitudinal_friction,
+def set_comfort_metrics(comfort_out, gforce_max, gforce_sum, jerk_max,
+                        jerk_sum, num_substeps, dt):
+    comfort_out[COMFORT_GFORCE_MAX] = gforce_max
+    comfort_out[COMFORT_JERK_MAX] = jerk_max
+    comfort_out[COMFORT_GFORCE_INTEGRAL] = gforce_sum * dt
+    comfort_out[COMFORT_JERK_INTEGRAL] = jerk_sum * dt
+    if num_substeps:
+        comfort_out[COMFORT_GFORCE_MEAN] = gforce_sum / num_substeps
+        comfort_out[COMFORT_JERK_MEAN] = jerk_sum / num_substeps
+    else:
+        comfort_out[COMFORT_GFORCE_MEAN] = 0.
+        comfort_out[COMFORT_JERK_MEAN] = 0.
+
+
+@njit(cache=CACHE_NUMBA, nogil=True)
+def interp_physics_step(add_longitudinal_friction,
                         add_rotational_friction,
                         angle,
                         angle_change,
-                        angular_velocity,
-                        gforce,
                         max_gforce,
                         max_jerk,
                         speed,
-                        velocity,
+                        vx, vy,
                         x,
                         y,
                         distance_traveled,
@@ -163,8 +345,7 @@ def interp_physics_step(throttle,
                         prev_x,
                         prev_y,
                         vehicle_model,
-                        acceleration,
-                        jerk,):
+                        ax, ay):
     (x,
      y,
      angle,
@@ -183,26 +364,27 @@ def interp_physics_step(throttle,
         add_longitudinal_friction=add_longitudinal_friction,
         vehicle_model=vehicle_model,)
 
-    distance_traveled += np.linalg.norm(
-        np.array([x - prev_x, y - prev_y]))
+    distance_traveled += math.hypot(x - prev_x, y - prev_y)
 
     (gforce,
      max_gforce,
      max_jerk,
-     jerk,
-     acceleration,
+     jx, jy,
+     ax, ay,
      angular_velocity,
-     velocity) = get_gforce_levels(x=x,
-                                   y=y,
-                                   angle=angle,
-                                   prev_x=prev_x,
-                                   prev_y=prev_y,
-                                   prev_angle=prev_angle,
-                                   dt=dt,
-                                   prev_velocity=velocity,
-                                   prev_acceleration=acceleration,
-                                   max_gforce=max_gforce,
-                                   max_jerk=max_jerk)
+     vx, vy) = get_gforce_levels(x=x,
+                                 y=y,
+                                 angle=angle,
+                                 prev_x=prev_x,
+                                 prev_y=prev_y,
+                                 prev_angle=prev_angle,
+                                 dt=dt,
+                                 prev_vx=vx,
+                                 prev_vy=vy,
+                                 prev_ax=ax,
+                                 prev_ay=ay,
+                                 max_gforce=max_gforce,
+                                 max_jerk=max_jerk)
     return (angle,
             angle_change,
             angular_velocity,
@@ -213,9 +395,9 @@ def interp_physics_step(throttle,
             x,
             y,
             distance_traveled,
-            acceleration,
-            jerk,
-            velocity)
+            ax, ay,
+            jx, jy,
+            vx, vy)
 
 
 @njit(cache=CACHE_NUMBA, nogil=True)
@@ -226,33 +408,56 @@ def get_gforce_levels(x,
                       prev_y,
                       prev_angle,
                       dt,
-                      prev_velocity,
-                      prev_acceleration,
+                      prev_vx,
+                      prev_vy,
+                      prev_ax,
+                      prev_ay,
                       max_gforce,
                       max_jerk):
-    pos_change = np.array([prev_x - x, prev_y - y])
-    velocity = pos_change / dt
-    acceleration = (velocity - prev_velocity) / dt
+    """
+    Finite difference velocity, acceleration and jerk, as x and y
+    components, from the change in position over dt
+    """
+    vx = (prev_x - x) / dt
+    vy = (prev_y - y) / dt
+    ax = (vx - prev_vx) / dt
+    ay = (vy - prev_vy) / dt
     angular_velocity = (angle - prev_angle) / dt
-    accel_magnitude = np.linalg.norm(acceleration)
-    gforce = accel_magnitude / 9.807
+    gforce = math.hypot(ax, ay) / 9.807
     max_gforce = max(gforce, max_gforce)
-    jerk = (acceleration - prev_acceleration) / dt
-    jerk_magnitude = np.linalg.norm(jerk)
-    max_jerk = max(jerk_magnitude, max_jerk)
-    return (gforce, max_gforce, max_jerk, jerk, acceleration, angular_velocity,
-            velocity)
+    jx = (ax - prev_ax) / dt
+    jy = (ay - prev_ay) / dt
+    max_jerk = max(math.hypot(jx, jy), max_jerk)
+    return (gforce, max_gforce, max_jerk, jx, jy, ax, ay, angular_velocity,
+            vx, vy)
 
 
 def test_physics_step():
-    from deepdrive_zero.physics.bike_model import get_vehicle_model
-    vehicle_model = get_vehicle_model(VEHICLE_WIDTH)
-    zero2d = np.array((0,0), dtype=np.float64)
-
     # Do 1 step with 12 pso
     # Do 12 steps with 1 interp
     physics_steps_per_observation = 12
-    state_interp = Box(
+    state_interp = _get_test_state(physics_steps_per_observation)
+    state_one_shot = deepcopy(state_interp)
+    state_one_shot.interpolation_steps = 12
+    for _ in range(10):
+        for _ in range(physics_steps_per_observation):
+            interpolation_steps = 1
+            state_interp = run_test_step(state_interp)
+            state_interp.start_interpolation_index += 1
+        state_one_shot = run_test_step(state_one_shot)
+    known_differences = {'interpolation_steps', 'start_interpolation_index'}
+    for k, v in state_interp.items():
+        if k not in known_differences and not np.allclose(v, state_one_shot[k]):
+            raise RuntimeError(f'Interp and One shot states not equal for '
+                               f'"{k}" interp={v}, one_shot={state_one_shot[k]}')
+
+
+
+def _get_test_state(physics_steps_per_observation):
+    from deepdrive_zero.vehicles import get_vehicle_params
+    vehicle_model = get_vehicle_params()
+    zero2d = np.array((0,0), dtype=np.float64)
+    return Box(
         throttle=1.,
         add_longitudinal_friction=True,
         add_rotational_friction=True,
@@ -285,23 +490,48 @@ def test_physics_step():
         start_interpolation_index=0,
         interpolation_range=physics_steps_per_observation,
     )
-    state_one_shot = deepcopy(state_interp)
-    state_one_shot.interpolation_steps = 12
-    for _ in range(10):
-        for _ in range(physics_steps_per_observation):
-            interpolation_steps = 1
-            state_interp = run_test_step(state_interp)
-            state_interp.start_interpolation_index += 1
-        state_one_shot = run_test_step(state_one_shot)
-    known_differences = {'interpolation_steps', 'start_interpolation_index'}
-    for k, v in state_interp.items():
-        if k not in known_differences and not np.allclose(v, state_one_shot[k]):
-            raise RuntimeError(f'Interp and One shot states not equal for '
-                               f'"{k}" interp={v}, one_shot={state_one_shot[k]}')
 
 
+def test_trajectory_out():
+    physics_steps_per_observation = 12
+    state_interp = _get_test_state(physics_steps_per_observation)
+    poses = []
+    for _ in range(physics_steps_per_observation):
+        state_interp = run_test_step(state_interp)
+        state_interp.start_interpolation_index += 1
+        poses.append((state_interp.curr_x, state_interp.curr_y,
+                      state_interp.curr_angle, state_interp.curr_speed))
 
-def run_test_step(state):
+    state_one_shot = _get_test_state(physics_steps_per_observation)
+    state_one_shot.interpolation_steps = physics_steps_per_observation
+    trajectory = np.zeros((physics_steps_per_observation,
+                           len(TRAJECTORY_FIELDS)))
+    run_test_step(state_one_shot, trajectory_out=trajectory)
+    assert np.allclose(trajectory, poses)
+
+
+def test_comfort_out():
+    physics_steps_per_observation = 12
+    state_interp = _get_test_state(physics_steps_per_observation)
+    gforces = []
+    jerks = []
+    for _ in range(physics_steps_per_observation):
+        state_interp = run_test_step(state_interp)
+        state_interp.start_interpolation_index += 1
+        gforces.append(state_interp.curr_gforce)
+        jerks.append(np.linalg.norm(state_interp.jerk))
+
+    state_one_shot = _get_test_state(physics_steps_per_observation)
+    state_one_shot.interpolation_steps = physics_steps_per_observation
+    comfort = np.zeros(NUM_COMFORT_METRICS)
+    run_test_step(state_one_shot, comfort_out=comfort)
+    dt = state_one_shot.dt
+    assert np.allclose(comfort, [max(gforces), np.mean(gforces),
+                                 sum(gforces) * dt, max(jerks), np.mean(jerks),
+                                 sum(jerks) * dt])
+
+
+def run_test_step(state, trajectory_out=None, comfort_out=None):
     (curr_acceleration,
      curr_angle,
      curr_angle_change,
@@ -317,7 +547,8 @@ def run_test_step(state):
      out_brake,
      out_steer,
      curr_velocity,
-     distance_traveled) = physics_step(**state)
+     distance_traveled) = physics_step(**state, trajectory_out=trajectory_out,
+                                       comfort_out=comfort_out)
 
     state.curr_acceleration = curr_acceleration
     state.curr_angle = curr_angle
@@ -339,5 +570,59 @@ def run_test_step(state):
     return state
 
 
-if __name__ == '__main__':
+def benchmark_substeps(num_substeps=10_000, repeats=20):
+    """
+    :return: Best seconds per Euler substep of physics_step, timed over
+        calls of num_substeps so call overhead is amortized
+    """
+    from deepdrive_zero.vehicles import get_vehicle_params
+    zero2d = np.zeros(2)
+    state = dict(
+        throttle=0.5,
+        add_longitudinal_friction=True,
+        add_rotational_friction=True,
+        brake=0.,
+        constrain_controls=False,
+        curr_acceleration=zero2d,
+        jerk=zero2d,
+        curr_angle=0.,
+        curr_angle_change=0.,
+        curr_angular_velocity=0.,
+        curr_gforce=0.,
+        curr_max_gforce=0.,
+        curr_max_jerk=0.,
+        curr_speed=5.,
+        curr_velocity=zero2d,
+        curr_x=0.,
+        curr_y=0.,
+        distance_traveled=0.,
+        dt=1 / 60,
+        ignore_brake=False,
+        max_throttle_change=0.,
+        max_brake_change=0.,
+        max_steer_change=0.,
+        interpolation_steps=num_substeps,
+        prev_throttle=0.,
+        prev_brake=0.,
+        prev_steer=0.,
+        steer=0.1,
+        vehicle_model=get_vehicle_params(),
+        start_interpolation_index=0,
+        interpolation_range=num_substeps,
+    )
+    physics_step(**state)  # Compile
+    best = math.inf
+    for _ in range(repeats):
+        start = time.perf_counter()
+        physics_step(**state)
+        best = min(best, time.perf_counter() - start)
+    return best / num_substeps
+
+
+def main():
     test_physics_step()
+    print(f'{benchmark_substeps() * 1e9:.1f} ns/substep')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+"""
+Pose frame
+
+Everything derived from a vehicle's x, y and angle that's read throughout a
+step, i.e. its front and back points, heading and corners, computed in one
+kernel call whenever the pose changes rather than on every read.
+"""
+import math
+from math import pi
+
+import numpy as np
+from numba import njit
+
+from deepdrive_zero.constants import CACHE_NUMBA
+from deepdrive_zero.physics.collision_detection import _get_rect
+
+# Frame layout
+POSE_FRONT = 0  # x, y of the front middle
+POSE_BACK = 2  # x, y of the back middle
+POSE_HEADING = 4  # x, y vector from center to front middle
+POSE_COS_SIN = 6  # cos, sin of the heading angle, i.e. pi / 2 + angle
+POSE_RECT = 8  # 4 corners as in get_rect, flattened
+POSE_FRAME_SIZE = 16
+
+
+@njit(cache=CACHE_NUMBA, nogil=True)
+def get_pose_frame(x, y, angle, width, length):
+    """
+    :param angle: Agent.angle, i.e. 0 is facing up
+    :return: (POSE_FRAME_SIZE,) see POSE_*
+    """
+    ret = np.empty(POSE_FRAME_SIZE)
+    theta = pi / 2 + angle
+    c, s = math.cos(theta), math.sin(theta)
+    ret[POSE_FRONT] = x + c * length / 2
+    ret[POSE_FRONT + 1] = y + s * length / 2
+    ret[POSE_BACK] = x - c * length / 2
+    ret[POSE_BACK + 1] = y - s * length / 2
+    ret[POSE_HEADING] = ret[POSE_FRONT] - x
+    ret[POSE_HEADING + 1] = ret[POSE_FRONT + 1] - y
+    ret[POSE_COS_SIN] = c
+    ret[POSE_COS_SIN + 1] = s
+    ret[POSE_RECT:] = _get_rect(x, y, angle, width, length).ravel()
+    return ret
+
+
+def test_get_pose_frame():
+    from deepdrive_zero.physics.collision_detection import get_rect
+    x, y, angle, width, length = 3., 4., 0.3, 2., 5.
+    frame = get_pose_frame(x, y, angle, width, length)
+    theta = pi / 2 + angle
+    front = frame[POSE_FRONT:POSE_FRONT + 2]
+    back = frame[POSE_BACK:POSE_BACK + 2]
+    assert np.allclose(front, (x + math.cos(theta) * length / 2,
+                               y + math.sin(theta) * length / 2))
+    assert np.allclose((front + back) / 2, (x, y))
+    assert np.allclose(frame[POSE_HEADING:POSE_HEADING + 2], front - (x, y))
+    assert np.isclose(np.linalg.norm(frame[POSE_HEADING:POSE_HEADING + 2]),
+                      length / 2)
+    rect = frame[POSE_RECT:].reshape(4, 2)
+    assert (rect == get_rect(x, y, angle, width, length)[0]).all()
+    # Front corners straddle the front middle
+    assert np.allclose(rect[:2].mean(axis=0), front)
@@ -0,0 +1,166 @@
+import math
+import time
+
+import numpy as np
+from numba import njit
+
+from deepdrive_zero.constants import CACHE_NUMBA
+from deepdrive_zero.physics.bike_model import bike_with_friction_step, \
+    VP_STEERING_RANGE
+from deepdrive_zero.physics.physics_step import get_gforce_levels
+
+# Table grid in m/s and g's. Speeds are spaced uniformly in sqrt(speed), which
+# keeps lookups O(1) while packing rows in at low speed, where the steer
+# needed for a given g falls off like 1 / speed**2.
+STEERING_TABLE_MAX_SPEED = 40
+STEERING_TABLE_NUM_SPEEDS = 41
+STEERING_TABLE_MAX_GFORCE = 0.5
+STEERING_TABLE_NUM_GFORCES = 26
+
+# Calibration grid and seconds simulated per (speed, steer) to reach a steady
+# turn, i.e. for the rotational friction on angle_change to settle
+CALIBRATION_NUM_STEERS = 128
+CALIBRATION_SECONDS = 4
+
+_tables = {}
+
+
+@njit(cache=CACHE_NUMBA, nogil=True)
+def simulate_lateral_gforces(speeds, steers, vehicle_model, dt, num_steps):
+    """
+    Hold each steering angle at each speed with the bike model the env
+    steps and measure the steady state g-force, which as speed is held
+    constant, is all lateral.
+
+    :return: (len(speeds), len(steers)) g's
+    """
+    ret = np.zeros((len(speeds), len(steers)))
+    for i in range(len(speeds)):
+        for j in range(len(steers)):
+            x = y = angle = angle_change = 0.
+            vx = vy = ax = ay = 0.
+            gforce = 0.
+            for _ in range(num_steps):
+                prev_x, prev_y, prev_angle = x, y, angle
+                # Speed is reset each step, i.e. throttle cancels friction
+                x, y, angle, angle_change, _speed = bike_with_friction_step(
+                    steer=steers[j], accel=0., brake=0., dt=dt, x=x, y=y,
+                    angle=angle, angle_change=angle_change, speed=speeds[i],
+                    add_rotational_friction=True,
+                    add_longitudinal_friction=True,
+                    vehicle_model=vehicle_model)
+                (gforce, _max_gforce, _max_jerk, _jx, _jy, ax, ay,
+                 _angular_velocity, vx, vy) = get_gforce_levels(
+                    x, y, angle, prev_x, prev_y, prev_angle, dt, vx, vy,
+                    ax, ay, 0., 0.)
+            ret[i, j] = gforce
+    return ret
+
+
+def build_steering_table(vehicle_model, dt,
+                         max_speed=STEERING_TABLE_MAX_SPEED,
+                         num_speeds=STEERING_TABLE_NUM_SPEEDS,
+                         max_gforce=STEERING_TABLE_MAX_GFORCE,
+                         num_gforces=STEERING_TABLE_NUM_GFORCES,
+                         num_steers=CALIBRATION_NUM_STEERS) -> np.array:
+    """
+    Calibrate the inverse bike model offline by simulating a grid of speeds
+    and steering angles, then inverting each speed's g-force curve.
+
+    :param vehicle_model: Vehicle parameter row, see vehicles.py
+    :param dt: Physics substep the table is valid for, as friction is per
+        substep
+    :return: (num_speeds, num_gforces) steering angles for speeds in
+        [0, max_speed] and lateral g's in [0, max_gforce]. Turns sharper than
+        the vehicle can make get full lock.
+    """
+    max_steer = vehicle_model[VP_STEERING_RANGE] / 2
+    speeds = max_speed * np.linspace(0, 1, num_speeds) ** 2
+    steers = np.linspace(0, max_steer, num_steers)
+    gforces = np.linspace(0, max_gforce, num_gforces)
+    num_steps = int(round(CALIBRATION_SECONDS / dt))
+    simulated = simulate_lateral_gforces(speeds, steers, vehicle_model,
+                                         float(dt), num_steps)
+    ret = np.full((num_speeds, num_gforces), max_steer)
+    ret[:, 0] = 0
+    for i in range(num_speeds):
+        curve = np.maximum.accumulate(simulated[i])
+        if curve[-1] > 0:
+            ret[i] = np.interp(gforces, curve, steers, right=max_steer)
+    return ret
+
+
+def get_steering_table(vehicle_model, dt) -> np.array:
+    """Memoized build_steering_table, as agents share vehicles and dt"""
+    key = (vehicle_model.tobytes(), dt)
+    if key not in _tables:
+        _tables[key] = build_steering_table(vehicle_model, dt)
+    return _tables[key]
+
+
+@njit(cache=CACHE_NUMBA, nogil=True)
+def get_steer_for_lateral_gforce(table, speed, lateral_gforce,
+                                 max_speed=STEERING_TABLE_MAX_SPEED,
+                                 max_gforce=STEERING_TABLE_MAX_GFORCE):
+    """
+    Bilinear lookup into a build_steering_table table
+
+    :return: Steering angle with the sign of lateral_gforce
+    """
+    num_speeds, num_gforces = table.shape
+    s = math.sqrt(min(abs(speed), max_speed) / max_speed) * (num_speeds - 1)
+    g = min(abs(lateral_gforce), max_gforce) / max_gforce * (num_gforces - 1)
+    i = min(int(s), num_speeds - 2)
+    j = min(int(g), num_gforces - 2)
+    fs = s - i
+    fg = g - j
+    steer = ((1 - fs) * ((1 - fg) * table[i, j] + fg * table[i, j + 1]) +
+             fs * ((1 - fg) * table[i + 1, j] + fg * table[i + 1, j + 1]))
+    return math.copysign(steer, lateral_gforce)
+
+
+def test_steering_table():
+    from deepdrive_zero.vehicles import get_vehicle_params
+    vehicle_model = get_vehicle_params()
+    dt = 1 / 60
+    table = get_steering_table(vehicle_model, dt)
+    assert table.shape == (STEERING_TABLE_NUM_SPEEDS,
+                           STEERING_TABLE_NUM_GFORCES)
+    assert get_steering_table(vehicle_model, dt) is table
+    assert (np.diff(table, axis=1) >= 0).all()
+
+    # Grid points are exact and sign follows the turn direction
+    g_step = STEERING_TABLE_MAX_GFORCE / (STEERING_TABLE_NUM_GFORCES - 1)
+    assert get_steer_for_lateral_gforce(table, 10., 5 * g_step) == \
+        table[20, 5]
+    assert get_steer_for_lateral_gforce(table, 10., -5 * g_step) == \
+        -table[20, 5]
+
+    # Steering from the table produces the requested g's, including between
+    # grid points
+    speeds = np.array([1.5, 5., 7.3, 12.5, 23.])
+    for target in (0.05, 0.1, 0.2):
+        steers = np.array([get_steer_for_lateral_gforce(table, s, target)
+                           for s in speeds])
+        for i in range(len(speeds)):
+            gforce = simulate_lateral_gforces(
+                speeds[i:i + 1], steers[i:i + 1], vehicle_model, dt,
+                int(CALIBRATION_SECONDS / dt))[0, 0]
+            assert abs(gforce - target) < 0.05 * target
+
+
+def main():
+    from deepdrive_zero.vehicles import get_vehicle_params, VEHICLES
+    dt = 1 / 60
+    for name in VEHICLES:
+        start = time.perf_counter()
+        table = build_steering_table(get_vehicle_params(name), dt)
+        print(f'{name}: built in {time.perf_counter() - start:.2f}s')
+        print('speed  steer for 0.1g (rad)')
+        for speed in (1, 5, 10, 20, 30):
+            print(f'{speed:5}  '
+                  f'{get_steer_for_lateral_gforce(table, speed, 0.1):.5f}')
+
+
+if __name__ == '__main__':
+    main()
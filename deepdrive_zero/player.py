@@ -16,8 +16,7 @@ from deepdrive_zero.constants import SCREEN_WIDTH, SCREEN_HEIGHT, SCREEN_MARGIN,
     MAP_WIDTH_PX, MAP_HEIGHT_PX, PLAYER_TURN_RADIANS_PER_KEYSTROKE, \
     SCREEN_TITLE, \
     CHARACTER_SCALING, MAX_PIXELS_PER_SEC_SQ, TESLA_LENGTH, VOYAGE_VAN_LENGTH, \
-    USE_VOYAGE, VEHICLE_PNG, MAX_METERS_PER_SEC_SQ, MAP_IMAGE, \
-    PARTIAL_PHYSICS_STEP
+    USE_VOYAGE, VEHICLE_PNG, MAX_METERS_PER_SEC_SQ, MAP_IMAGE
 # Constants
 from deepdrive_zero.envs.env import Deepdrive2DEnv
 from deepdrive_zero.map_gen import get_intersection
@@ -143,7 +142,7 @@ class Deepdrive2DPlayer(arcade.Window):
         e = self.env
         m = a.map
         ppm = e.px_per_m
-        angle = a.angle
+        x, y, angle = e.get_render_pose(a)
         theta = angle + pi / 2
         if self.env.is_one_waypoint_map:
             arcade.draw_circle_filled(
@@ -183,10 +182,10 @@ class Deepdrive2DPlayer(arcade.Window):
                 self.background)
         if a.ego_rect is not None and DRAW_COLLISION_BOXES:
             arcade.draw_rectangle_outline(
-                center_x=a.x * ppm, center_y=a.y * ppm,
+                center_x=x * ppm, center_y=y * ppm,
                 width=a.vehicle_width * ppm,
                 height=a.vehicle_length * ppm, color=color.LIME_GREEN,
-                border_width=2, tilt_angle=math.degrees(a.angle),
+                border_width=2, tilt_angle=math.degrees(angle),
             )
             arcade.draw_points(point_list=(a.ego_rect * ppm).tolist(),
                                color=color.YELLOW, size=3)
@@ -377,10 +376,10 @@ class Deepdrive2DPlayer(arcade.Window):
     def update(self, _delta_time):
         """ Movement and game logic """
         env = self.env
-        for i, agent in enumerate(env.all_agents):
-            sprite = self.player_list[i]
-            if self.human_controlled:
-                # print(f'setting throttle to {self.accel} for agent {i}')
+        if self.human_controlled:
+            # Draw one recorded substep per frame, so play is real time, and
+            # only step once all of the last step's substeps have been drawn
+            if not env.next_render_substep():
                 if env.agent_index == 0:
                     steer = self.steer
                     accel = self.accel
@@ -390,21 +389,19 @@ class Deepdrive2DPlayer(arcade.Window):
                     accel = random()
                     brake = 0
 
-                if agent.update_intermediate_physics:
-                    if agent.last_step_output == PARTIAL_PHYSICS_STEP:
-                        agent.possibly_partial_step()
-                    else:
-                        env.step([steer, accel, brake])
-
-                else:
-                    env.step([steer, accel, brake])
+                env.step([steer, accel, brake])
+                if env.last_stepped_agent.num_trajectory_steps:
+                    env.render_substep = 0
 
-                if agent.done:
-                    agent.reset()
+        for i, agent in enumerate(env.all_agents):
+            sprite = self.player_list[i]
+            if self.human_controlled and agent.done:
+                agent.reset()
 
-            sprite.center_x = agent.x * self.px_per_m
-            sprite.center_y = agent.y * self.px_per_m
-            sprite.angle = math.degrees(agent.angle)
+            x, y, angle = env.get_render_pose(agent)
+            sprite.center_x = x * self.px_per_m
+            sprite.center_y = y * self.px_per_m
+            sprite.angle = math.degrees(angle)
 
 
     # def update(self, _delta_time):
@@ -0,0 +1,143 @@
+"""
+Reward
+
+Each agent's reward is a sum of named terms, i.e. progress along the route
+and a win bonus less g-force, collision, jerk and lane penalties. Their
+coefficients, thresholds and margins come from env_config via
+get_reward_params, and compute_rewards evaluates every term for a batch of
+agents in one kernel call, e.g. to relabel recorded steps with new
+coefficients.
+"""
+import numpy as np
+from numba import njit
+
+from deepdrive_zero.constants import CACHE_NUMBA
+
+# Terms, signed as they're summed, so penalties are negative
+REWARD_PROGRESS = 0
+REWARD_WIN = 1
+REWARD_GFORCE = 2
+REWARD_COLLISION = 3
+REWARD_JERK = 4
+REWARD_LANE = 5
+NUM_REWARD_TERMS = 6
+REWARD_TERMS = ('progress', 'win', 'gforce', 'collision', 'jerk', 'lane')
+
+# Inputs, per agent
+REWARD_IN_PROGRESS = 0  # m along the route since the last step
+REWARD_IN_YIELD = 1  # Turning across oncoming traffic, so penalize progress
+REWARD_IN_WON = 2
+REWARD_IN_COLLIDED = 3
+REWARD_IN_GFORCE = 4
+REWARD_IN_JERK = 5  # m/s^3
+REWARD_IN_LEFT_LANE_DISTANCE = 6  # m
+REWARD_IN_RIGHT_LANE_DISTANCE = 7  # m
+NUM_REWARD_INPUTS = 8
+
+# Params
+REWARD_PARAM_PROGRESS_COEFF = 0
+REWARD_PARAM_WIN_COEFF = 1
+REWARD_PARAM_GFORCE_COEFF = 2
+REWARD_PARAM_GFORCE_THRESHOLD = 3  # No penalty at or below this g-force
+REWARD_PARAM_COLLISION_COEFF = 4
+REWARD_PARAM_JERK_COEFF = 5
+REWARD_PARAM_LANE_COEFF = 6
+REWARD_PARAM_LANE_MARGIN = 7  # Penalize lane distances under this, m
+NUM_REWARD_PARAMS = 8
+
+
+def get_reward_params(progress_coeff, win_coeff, gforce_coeff,
+                      gforce_threshold, collision_coeff, jerk_coeff,
+                      lane_coeff, lane_margin) -> np.array:
+    """:return: (NUM_REWARD_PARAMS,) for compute_rewards, see REWARD_PARAM_*"""
+    ret = np.zeros(NUM_REWARD_PARAMS)
+    ret[REWARD_PARAM_PROGRESS_COEFF] = progress_coeff
+    ret[REWARD_PARAM_WIN_COEFF] = win_coeff
+    ret[REWARD_PARAM_GFORCE_COEFF] = gforce_coeff
+    ret[REWARD_PARAM_GFORCE_THRESHOLD] = gforce_threshold
+    ret[REWARD_PARAM_COLLISION_COEFF] = collision_coeff
+    ret[REWARD_PARAM_JERK_COEFF] = jerk_coeff
+    ret[REWARD_PARAM_LANE_COEFF] = lane_coeff
+    ret[REWARD_PARAM_LANE_MARGIN] = lane_margin
+    return ret
+
+
+@njit(cache=CACHE_NUMBA, nogil=True)
+def compute_rewards(inputs, params):
+    """
+    :param inputs: (B, NUM_REWARD_INPUTS) see REWARD_IN_*
+    :param params: get_reward_params(...)
+    :return: (B,) rewards and (B, NUM_REWARD_TERMS) the terms they sum, see
+        REWARD_TERMS
+    """
+    n = len(inputs)
+    totals = np.zeros(n)
+    terms = np.zeros((n, NUM_REWARD_TERMS))
+    for i in range(n):
+        x = inputs[i]
+        out = terms[i]
+        progress = x[REWARD_IN_PROGRESS] * params[REWARD_PARAM_PROGRESS_COEFF]
+        if x[REWARD_IN_YIELD]:
+            # Cautious while turning across oncoming traffic. Once it's
+            # passed we're rewarded for the turn as usual.
+            progress = -abs(progress)
+        out[REWARD_PROGRESS] = progress
+
+        if x[REWARD_IN_WON]:
+            out[REWARD_WIN] = params[REWARD_PARAM_WIN_COEFF]
+
+        gforce = x[REWARD_IN_GFORCE]
+        if gforce > params[REWARD_PARAM_GFORCE_THRESHOLD]:
+            out[REWARD_GFORCE] = -params[REWARD_PARAM_GFORCE_COEFF] * gforce
+
+        if x[REWARD_IN_COLLIDED]:
+            # TODO: Make dependent on |Δv|
+            out[REWARD_COLLISION] = -params[REWARD_PARAM_COLLISION_COEFF]
+
+        out[REWARD_JERK] = -params[REWARD_PARAM_JERK_COEFF] * x[REWARD_IN_JERK]
+
+        # Both can be under the margin if we're orthogonal to the lane
+        lane_penalty = 0.
+        margin = params[REWARD_PARAM_LANE_MARGIN]
+        left = x[REWARD_IN_LEFT_LANE_DISTANCE] - margin
+        if left < 0:
+            lane_penalty += abs(left)
+        right = x[REWARD_IN_RIGHT_LANE_DISTANCE] - margin
+        if right < 0:
+            lane_penalty += abs(right)
+        out[REWARD_LANE] = -lane_penalty * params[REWARD_PARAM_LANE_COEFF]
+
+        total = 0.
+        for t in range(NUM_REWARD_TERMS):
+            total += out[t]
+        totals[i] = total
+    return totals, terms
+
+
+def test_compute_rewards():
+    params = get_reward_params(
+        progress_coeff=0.5, win_coeff=1, gforce_coeff=0.031,
+        gforce_threshold=0.05, collision_coeff=0.31, jerk_coeff=0.1,
+        lane_coeff=0.02, lane_margin=0.5)
+    inputs = np.zeros((3, NUM_REWARD_INPUTS))
+    inputs[:, REWARD_IN_PROGRESS] = 2
+    inputs[:, REWARD_IN_LEFT_LANE_DISTANCE] = 1
+    inputs[:, REWARD_IN_RIGHT_LANE_DISTANCE] = 1
+
+    # Yielding, over the g-force threshold and 0.25m past the lane margin
+    inputs[1, REWARD_IN_YIELD] = 1
+    inputs[1, REWARD_IN_GFORCE] = 0.2
+    inputs[1, REWARD_IN_JERK] = 3
+    inputs[1, REWARD_IN_LEFT_LANE_DISTANCE] = 0.25
+
+    # Won and collided, under the g-force threshold
+    inputs[2, REWARD_IN_WON] = 1
+    inputs[2, REWARD_IN_COLLIDED] = 1
+    inputs[2, REWARD_IN_GFORCE] = 0.05
+
+    totals, terms = compute_rewards(inputs, params)
+    assert terms.shape == (3, NUM_REWARD_TERMS)
+    assert np.allclose(totals, terms.sum(axis=1))
+    assert list(terms[0]) == [1, 0, 0, 0, 0, 0]
+    assert np.allclose(terms[1], [-1, 0, -0.031 * 0.2, 0, -0.3, -0.005])
+    assert np.allclose(terms[2], [1, 1, 0, -0.31, 0, 0])
@@ -0,0 +1,145 @@
+import numpy as np
+
+# Unit uniform draws Agent.gen_map consumes per route, i.e.
+#   intersection map: [start position, unused...]
+#   one waypoint map: [waypoint x, waypoint y,
+#                      obstacle center, obstacle angle, obstacle width]
+NUM_MAP_PARAMS = 5
+
+SCENARIO_ORDER_SEQUENTIAL = 'sequential'
+SCENARIO_ORDER_SHUFFLED = 'shuffled'
+SCENARIO_ORDER_ID = 'id'
+SCENARIO_ORDERS = (SCENARIO_ORDER_SEQUENTIAL, SCENARIO_ORDER_SHUFFLED,
+                   SCENARIO_ORDER_ID)
+
+_CHUNK_SIZE = 2 ** 18
+
+
+def get_scenario_dtype(num_routes):
+    return np.dtype([('id', np.int64),
+                     ('params', np.float32, (num_routes, NUM_MAP_PARAMS))])
+
+
+def gen_scenario_bank(path, num_scenarios, num_routes=3, seed=0):
+    """
+    Pre-sample initial configurations for num_routes agents (including dummy
+    agents) into a .npy file that can be memory mapped by ScenarioBank.
+
+    Params are stored rather than maps so that one bank works for every
+    map type and a scenario id reproduces the same episode start on any
+    worker.
+
+    :return: Memory mapped scenarios
+    """
+    rng = np.random.RandomState(seed)
+    scenarios = np.lib.format.open_memmap(
+        path, mode='w+', dtype=get_scenario_dtype(num_routes),
+        shape=(num_scenarios,))
+    for start in range(0, num_scenarios, _CHUNK_SIZE):
+        end = min(start + _CHUNK_SIZE, num_scenarios)
+        scenarios['id'][start:end] = np.arange(start, end)
+        scenarios['params'][start:end] = rng.rand(
+            end - start, num_routes, NUM_MAP_PARAMS)
+    scenarios.flush()
+    return scenarios
+
+
+class ScenarioBank:
+    """
+    Serves scenarios from a file made by gen_scenario_bank
+
+    :param order: 'sequential', 'shuffled' (a fixed permutation from seed) or
+        'id' to always serve scenario_id
+    :param scenario_id: Scenario to serve for 'id' order, or where to start
+        for the others, i.e. to split a bank across workers
+    """
+    def __init__(self, path, order=SCENARIO_ORDER_SEQUENTIAL, scenario_id=None,
+                 seed=0):
+        if order not in SCENARIO_ORDERS:
+            raise ValueError(f'Unknown scenario order {order}, '
+                             f'expected one of {SCENARIO_ORDERS}')
+        if order == SCENARIO_ORDER_ID and scenario_id is None:
+            raise ValueError('scenario_id is required for id order')
+        self.scenarios: np.ndarray = np.load(path, mmap_mode='r')
+        self.order: str = order
+        self.num_routes: int = self.scenarios.dtype['params'].shape[0]
+        self.permutation: np.array = None
+        if order == SCENARIO_ORDER_SHUFFLED:
+            self.permutation = np.random.RandomState(seed).permutation(
+                len(self.scenarios))
+        self.scenario_id: int = scenario_id or 0
+        self.index: int = self.scenario_id
+
+    def __len__(self):
+        return len(self.scenarios)
+
+    def get(self, scenario_id):
+        """:return: (num_routes, NUM_MAP_PARAMS) params for scenario_id"""
+        return np.asarray(self.scenarios[scenario_id]['params'],
+                          dtype=np.float64)
+
+    def next_id(self) -> int:
+        if self.order == SCENARIO_ORDER_ID:
+            return self.scenario_id
+        i = self.index % len(self.scenarios)
+        self.index += 1
+        if self.permutation is not None:
+            return int(self.permutation[i])
+        return i
+
+
+def test_scenario_bank():
+    import tempfile
+    import os
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'scenarios.npy')
+        scenarios = gen_scenario_bank(path, num_scenarios=10, num_routes=2)
+        assert scenarios.shape == (10,)
+
+        bank = ScenarioBank(path)
+        assert bank.num_routes == 2
+        assert [bank.next_id() for _ in range(12)] == list(range(10)) + [0, 1]
+        assert np.allclose(bank.get(3), scenarios[3]['params'])
+
+        shuffled = ScenarioBank(path, order=SCENARIO_ORDER_SHUFFLED)
+        assert sorted(shuffled.next_id() for _ in range(10)) == list(range(10))
+
+        fixed = ScenarioBank(path, order=SCENARIO_ORDER_ID, scenario_id=7)
+        assert fixed.next_id() == fixed.next_id() == 7
+        del scenarios, bank, shuffled, fixed  # Release memmaps
+
+
+def test_env_scenario_bank():
+    import tempfile
+    import os
+    from deepdrive_zero.envs.env import Deepdrive2DEnv
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'scenarios.npy')
+        scenarios = gen_scenario_bank(path, num_scenarios=5, num_routes=2)
+        env = Deepdrive2DEnv(is_intersection_map=True)
+        env.configure_env(dict(scenario_bank_path=path,
+                               scenario_order=SCENARIO_ORDER_ID,
+                               scenario_id=3))
+        env.reset()
+        starts = [(a.start_x, a.start_y) for a in env.agents]
+        assert all(a.scenario_id == 3 for a in env.agents)
+        assert np.isclose(env.agents[0].start_y,
+                          6 + 12 * scenarios[3]['params'][0, 0])
+        env.agents[0].reset()
+        env.agents[1].reset()
+        assert starts == [(a.start_x, a.start_y) for a in env.agents]
+        del env
+
+        # Agents share each scenario in turn
+        env = Deepdrive2DEnv(is_intersection_map=True)
+        env.configure_env(dict(scenario_bank_path=path))
+        assert [a.scenario_id for a in env.agents] == [0, 0]
+        for scenario_id in (1, 2):
+            for agent in env.agents:
+                agent.reset()
+            assert [a.scenario_id for a in env.agents] == \
+                [scenario_id, scenario_id]
+        params = scenarios[2]['params']
+        assert np.isclose(env.agents[0].start_y, 6 + 12 * params[0, 0])
+        assert np.isclose(env.agents[1].start_y, 33 + 14 * params[1, 0])
+        del env, scenarios
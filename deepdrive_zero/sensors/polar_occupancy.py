@@ -0,0 +1,201 @@
+"""
+Polar occupancy
+
+A fixed-size egocentric sensor: sectors around the ego's heading, split into
+range bins, each holding the distance to and closing speed of the nearest
+thing in it, whether another vehicle's rectangle or a static obstacle
+segment. Unlike per-agent feature blocks, its size doesn't depend on how
+many vehicles are around.
+
+Other vehicles are found through a neighbors.build_grid grid, shared with
+the env's other per-step queries, so each ego only visits vehicles within
+max_range.
+"""
+import math
+from math import pi
+
+import numpy as np
+from numba import njit
+
+from deepdrive_zero.constants import CACHE_NUMBA
+from deepdrive_zero.physics.neighbors import get_cell
+
+# Channels
+OCCUPANCY_DISTANCE = 0  # m, max_range when empty
+OCCUPANCY_CLOSING_SPEED = 1  # m/s, positive when approaching, 0 when empty
+NUM_OCCUPANCY_CHANNELS = 2
+
+
+@njit(cache=CACHE_NUMBA, nogil=True)
+def get_polar_occupancy(egos, positions, angles, velocities, rects, grid,
+                        segments, num_sectors, num_range_bins, max_range):
+    """
+    :param egos: Indices of the agents to sense for
+    :param positions: (N, 2) vehicle centers
+    :param angles: (N,) Agent.angle, i.e. 0 is facing up
+    :param velocities: (N, 2)
+    :param rects: (N, 4, 2) corners, i.e. Agent.ego_rect
+    :param grid: neighbors.build_grid(positions)
+    :param segments: (M, 2, 2) static obstacle end points
+    :return: (len(egos), NUM_OCCUPANCY_CHANNELS, num_sectors, num_range_bins)
+        where sector 0 is centered directly behind and sectors go
+        counterclockwise, so with an even num_sectors, sector
+        num_sectors // 2 is centered straight ahead
+    """
+    ret = np.zeros((len(egos), NUM_OCCUPANCY_CHANNELS, num_sectors,
+                    num_range_bins))
+    ret[:, OCCUPANCY_DISTANCE] = max_range
+    min_x, min_y, cell_size, dims, cell_starts, order = grid
+
+    # Vehicles whose center is this far away can still reach into range
+    max_corner_distance = 0.
+    for j in range(len(rects)):
+        for k in range(4):
+            max_corner_distance = max(max_corner_distance, math.hypot(
+                rects[j, k, 0] - positions[j, 0],
+                rects[j, k, 1] - positions[j, 1]))
+    reach = max_range + max_corner_distance
+
+    for e in range(len(egos)):
+        i = egos[e]
+        out = ret[e]
+        x, y = positions[i, 0], positions[i, 1]
+        heading = angles[i] + pi / 2
+        cx0, cy0 = get_cell(x - reach, y - reach, min_x, min_y, cell_size,
+                            dims)
+        cx1, cy1 = get_cell(x + reach, y + reach, min_x, min_y, cell_size,
+                            dims)
+        for gx in range(cx0, cx1 + 1):
+            for gy in range(cy0, cy1 + 1):
+                cell = gx * dims + gy
+                for o in range(cell_starts[cell], cell_starts[cell + 1]):
+                    j = order[o]
+                    if j == i:
+                        continue
+                    rvx = velocities[j, 0] - velocities[i, 0]
+                    rvy = velocities[j, 1] - velocities[i, 1]
+                    for k in range(4):
+                        _add_segment(out, rects[j, k], rects[j, (k + 1) % 4],
+                                     x, y, heading, rvx, rvy, max_range)
+        for m in range(len(segments)):
+            _add_segment(out, segments[m, 0], segments[m, 1], x, y, heading,
+                         -velocities[i, 0], -velocities[i, 1], max_range)
+    return ret
+
+
+@njit(cache=CACHE_NUMBA, nogil=True)
+def _add_segment(out, a, b, x, y, heading, rvx, rvy, max_range):
+    """
+    Mark the closest point of segment ab within each sector it spans
+
+    :param rvx, rvy: Segment's velocity relative to the ego
+    """
+    num_sectors = out.shape[1]
+    num_range_bins = out.shape[2]
+    sector_width = 2 * pi / num_sectors
+
+    # Ego frame, x ahead and y to the left
+    c, s = math.cos(heading), math.sin(heading)
+    p0x = (a[0] - x) * c + (a[1] - y) * s
+    p0y = -(a[0] - x) * s + (a[1] - y) * c
+    p1x = (b[0] - x) * c + (b[1] - y) * s
+    p1y = -(b[0] - x) * s + (b[1] - y) * c
+    vx = rvx * c + rvy * s
+    vy = -rvx * s + rvy * c
+
+    a0 = math.atan2(p0y, p0x)
+    a1 = math.atan2(p1y, p1x)
+    span = (a1 - a0 + pi) % (2 * pi) - pi
+    if span < 0:
+        # Go counterclockwise from p0 to p1
+        p0x, p0y, p1x, p1y = p1x, p1y, p0x, p0y
+        a0, a1 = a1, a0
+    dx, dy = p1x - p0x, p1y - p0y
+    length_sq = dx * dx + dy * dy
+    if length_sq == 0:
+        closest_t = 0.
+    else:
+        closest_t = min(max(-(p0x * dx + p0y * dy) / length_sq, 0.), 1.)
+
+    s0 = _get_sector(a0, sector_width, num_sectors)
+    s1 = _get_sector(a1, sector_width, num_sectors)
+    num_spanned = (s1 - s0) % num_sectors + 1
+    for q in range(num_spanned):
+        sector = (s0 + q) % num_sectors
+        lo = 0.
+        hi = 1.
+        if q > 0:
+            lo = _get_ray_t(_get_sector_start(sector, sector_width),
+                            p0x, p0y, dx, dy, 0.)
+        if q < num_spanned - 1:
+            hi = _get_ray_t(_get_sector_start(sector + 1, sector_width),
+                            p0x, p0y, dx, dy, 1.)
+        t = min(max(closest_t, lo), hi)
+        px, py = p0x + t * dx, p0y + t * dy
+        dist = math.hypot(px, py)
+        if dist >= max_range:
+            continue
+        range_bin = int(dist / max_range * num_range_bins)
+        if dist < out[OCCUPANCY_DISTANCE, sector, range_bin]:
+            out[OCCUPANCY_DISTANCE, sector, range_bin] = dist
+            if dist > 0:
+                out[OCCUPANCY_CLOSING_SPEED, sector, range_bin] = \
+                    -(vx * px + vy * py) / dist
+
+
+@njit(cache=CACHE_NUMBA, nogil=True)
+def _get_sector(angle, sector_width, num_sectors):
+    return int((angle + pi + sector_width / 2) / sector_width) % num_sectors
+
+
+@njit(cache=CACHE_NUMBA, nogil=True)
+def _get_sector_start(sector, sector_width):
+    """:return: Clockwise edge of sector, radians from ahead"""
+    return -pi - sector_width / 2 + sector * sector_width
+
+
+@njit(cache=CACHE_NUMBA, nogil=True)
+def _get_ray_t(angle, p0x, p0y, dx, dy, default):
+    """:return: Where along p0 + t * d the ray at angle crosses, in [0, 1]"""
+    ux, uy = math.cos(angle), math.sin(angle)
+    denominator = ux * dy - uy * dx
+    if denominator == 0:
+        return default
+    return min(max(-(ux * p0y - uy * p0x) / denominator, 0.), 1.)
+
+
+def test_get_polar_occupancy():
+    from deepdrive_zero.physics.collision_detection import get_rect
+    from deepdrive_zero.physics.neighbors import build_grid
+    # Ego facing up at the origin, one car 10m ahead closing at 5 m/s and
+    # one 100m to the right, out of range
+    positions = np.array([[0., 0.], [0., 10.], [100., 0.]])
+    angles = np.zeros(3)
+    velocities = np.array([[0., 5.], [0., 0.], [0., 0.]])
+    rects = np.array([get_rect(p[0], p[1], 0., 2., 4.)[0]
+                      for p in positions])
+    # Wall 5m to the left
+    segments = np.array([[[-5., -1.], [-5., 1.]]])
+    num_sectors, num_range_bins, max_range = 8, 4, 40.
+    occupancy = get_polar_occupancy(
+        np.array([0, 1]), positions, angles, velocities, rects,
+        build_grid(positions), segments, num_sectors, num_range_bins,
+        max_range)
+    assert occupancy.shape == (2, NUM_OCCUPANCY_CHANNELS, num_sectors,
+                               num_range_bins)
+
+    ours = occupancy[0]
+    ahead = num_sectors // 2
+    left = num_sectors * 3 // 4
+    occupied = ours[OCCUPANCY_DISTANCE] < max_range
+    assert occupied.sum() == 3  # Car ahead spans two range bins
+    assert np.isclose(ours[OCCUPANCY_DISTANCE, ahead, 1], 12)
+    assert np.isclose(ours[OCCUPANCY_DISTANCE, ahead, 0], 8)
+    assert np.isclose(ours[OCCUPANCY_CLOSING_SPEED, ahead, 0], 5)
+    assert np.isclose(ours[OCCUPANCY_DISTANCE, left, 0], 5)
+    assert np.isclose(ours[OCCUPANCY_CLOSING_SPEED, left, 0], 0)
+
+    # The car ahead sees us behind, with the wall too far left to matter
+    theirs = occupancy[1]
+    assert np.isclose(theirs[OCCUPANCY_DISTANCE, 0, 0], 8)
+    assert np.isclose(theirs[OCCUPANCY_CLOSING_SPEED, 0, 0], 5)
@@ -0,0 +1,300 @@
+"""
+Raster
+
+Small ego-centered top-down images for CNN policies, without a display:
+channels of drivable area, lane lines, route, ego and other vehicles, drawn
+as uint8 (255 where present) with the ego in the middle facing up.
+
+The map's drivable area and lane lines don't change, so they're rendered
+once per map type and resolution into a world-aligned image that each ego
+samples from. Only what moves or changes per episode, i.e. vehicles, routes
+and static obstacles, is drawn per step. Egos, including egos from different
+envs on the same map type, are rasterized in one parallel kernel call.
+"""
+import math
+from functools import lru_cache
+from math import pi
+
+import numpy as np
+from numba import njit, prange
+
+from deepdrive_zero.constants import CACHE_NUMBA, SCREEN_WIDTH, \
+    SCREEN_HEIGHT, PX_PER_M
+from deepdrive_zero.map_gen import get_intersection
+
+# Channels
+RASTER_DRIVABLE = 0  # Static obstacles are cut out of this
+RASTER_LANES = 1
+RASTER_ROUTE = 2
+RASTER_EGO = 3
+RASTER_VEHICLES = 4  # Other vehicles
+NUM_RASTER_CHANNELS = 5
+NUM_STATIC_RASTER_CHANNELS = 2  # Drivable and lanes, in that order
+
+RASTER_ON = 255
+
+
+@lru_cache()
+def get_static_layers(is_intersection_map, m_per_px):
+    """
+    Drivable area and lane lines over the whole screen, computed once per
+    process and shared (read-only) by all envs.
+
+    :return: (NUM_STATIC_RASTER_CHANNELS, width, height) uint8 indexed by
+        x then y, with pixel (0, 0) at the world origin
+    """
+    width = int(math.ceil(SCREEN_WIDTH / PX_PER_M / m_per_px))
+    height = int(math.ceil(SCREEN_HEIGHT / PX_PER_M / m_per_px))
+    ret = np.zeros((NUM_STATIC_RASTER_CHANNELS, width, height),
+                   dtype=np.uint8)
+    if is_intersection_map:
+        lines, _lane_width = get_intersection()
+        left_vert, _, right_vert, top_horiz, _, bottom_horiz = lines
+
+        def to_px(m):
+            return int(round(m / m_per_px))
+
+        drivable = ret[RASTER_DRIVABLE]
+        drivable[to_px(left_vert[0, 0]):to_px(right_vert[0, 0]),
+                 to_px(left_vert[0, 1]):to_px(left_vert[1, 1])] = RASTER_ON
+        drivable[to_px(bottom_horiz[0, 0]):to_px(bottom_horiz[1, 0]),
+                 to_px(bottom_horiz[0, 1]):to_px(top_horiz[0, 1])] = RASTER_ON
+        for line in lines:
+            _draw_line(ret[RASTER_LANES], line[0, 0] / m_per_px,
+                       line[0, 1] / m_per_px, line[1, 0] / m_per_px,
+                       line[1, 1] / m_per_px, RASTER_ON)
+    else:
+        # No roads, just the screen
+        ret[RASTER_DRIVABLE] = RASTER_ON
+    ret.flags.writeable = False
+    return ret
+
+
+def rasterize_envs(env_egos, size, m_per_px):
+    """
+    Rasterize for agents across envs in one kernel call
+
+    :param env_egos: (env, route_indices) pairs, with all envs on the same
+        map type
+    :return: (total egos, NUM_RASTER_CHANNELS, size, size) uint8, egos in
+        the order given, see rasterize
+    """
+    f64 = np.float64
+    map_types = set(env.is_intersection_map for env, _ in env_egos)
+    if len(map_types) != 1:
+        raise ValueError('Envs must all be on the same map type to share '
+                         'static raster layers')
+    egos, positions, angles, rects = [], [], [], []
+    vehicle_ranges, route_points, route_ranges = [], [], []
+    segments, segment_ranges = [], []
+    for env, route_indices in env_egos:
+        agents = env.all_agents
+        vehicle_start = len(positions)
+        vehicle_range = (vehicle_start, vehicle_start + len(agents))
+        segment_range = (len(segments), len(segments))
+        if env.add_static_obstacle:
+            segments += [a.static_obstacle_points for a in agents]
+            segment_range = (segment_range[0], len(segments))
+        positions += [(a.x, a.y) for a in agents]
+        angles += [a.angle for a in agents]
+        rects += [a.ego_rect for a in agents]
+        for route_index in route_indices:
+            egos.append(vehicle_start + route_index)
+            vehicle_ranges.append(vehicle_range)
+            segment_ranges.append(segment_range)
+            waypoints = agents[route_index].map.waypoints
+            route_ranges.append((len(route_points),
+                                 len(route_points) + len(waypoints)))
+            route_points += list(waypoints)
+    i64 = np.int64
+    return rasterize(
+        get_static_layers(map_types.pop(), float(m_per_px)),
+        np.array(egos, dtype=i64),
+        np.array(positions, dtype=f64).reshape(-1, 2),
+        np.array(angles, dtype=f64),
+        np.array(rects, dtype=f64).reshape(-1, 4, 2),
+        np.array(vehicle_ranges, dtype=i64).reshape(-1, 2),
+        np.array(route_points, dtype=f64).reshape(-1, 2),
+        np.array(route_ranges, dtype=i64).reshape(-1, 2),
+        np.array(segments, dtype=f64).reshape(-1, 2, 2),
+        np.array(segment_ranges, dtype=i64).reshape(-1, 2),
+        size, float(m_per_px))
+
+
+@njit(cache=CACHE_NUMBA, nogil=True, parallel=True)
+def rasterize(static_layers, egos, positions, angles, rects,
+              vehicle_ranges, route_points, route_ranges, segments,
+              segment_ranges, size, m_per_px):
+    """
+    :param static_layers: get_static_layers(..., m_per_px)
+    :param egos: (E,) indices into positions of the vehicles to rasterize for
+    :param positions: (N, 2) vehicle centers
+    :param angles: (N,) Agent.angle, i.e. 0 is facing up
+    :param rects: (N, 4, 2) corners, i.e. Agent.ego_rect
+    :param vehicle_ranges: (E, 2) start and end into positions of the
+        vehicles each ego can see, i.e. those in its env
+    :param route_points: (P, 2) waypoints of every ego's route, concatenated
+    :param route_ranges: (E, 2) start and end of each ego's route_points
+    :param segments: (M, 2, 2) static obstacle end points
+    :param segment_ranges: (E, 2) start and end of each ego's segments
+    :param size: Output width and height in pixels
+    :return: (E, NUM_RASTER_CHANNELS, size, size) uint8 where row 0 is ahead
+        and column 0 is left
+    """
+    num_egos = len(egos)
+    ret = np.zeros((num_egos, NUM_RASTER_CHANNELS, size, size),
+                   dtype=np.uint8)
+    static_width = static_layers.shape[1]
+    static_height = static_layers.shape[2]
+    half = size / 2
+    for e in prange(num_egos):
+        out = ret[e]
+        i = egos[e]
+        x, y = positions[i, 0], positions[i, 1]
+        heading = angles[i] + pi / 2
+        hx, hy = math.cos(heading), math.sin(heading)
+
+        # Static layers, nearest neighbor
+        for row in range(size):
+            ahead = (half - row - 0.5) * m_per_px
+            for col in range(size):
+                right = (col + 0.5 - half) * m_per_px
+                sx = int(math.floor((x + ahead * hx + right * hy) / m_per_px))
+                sy = int(math.floor((y + ahead * hy - right * hx) / m_per_px))
+                if 0 <= sx < static_width and 0 <= sy < static_height:
+                    for c in range(NUM_STATIC_RASTER_CHANNELS):
+                        out[c, row, col] = static_layers[c, sx, sy]
+
+        for m in range(segment_ranges[e, 0], segment_ranges[e, 1]):
+            c0, r0 = _to_pixel(segments[m, 0], x, y, hx, hy, half, m_per_px)
+            c1, r1 = _to_pixel(segments[m, 1], x, y, hx, hy, half, m_per_px)
+            _draw_line(out[RASTER_DRIVABLE].T, c0, r0, c1, r1, 0)
+
+        for p in range(route_ranges[e, 0], route_ranges[e, 1] - 1):
+            c0, r0 = _to_pixel(route_points[p], x, y, hx, hy, half, m_per_px)
+            c1, r1 = _to_pixel(route_points[p + 1], x, y, hx, hy, half,
+                               m_per_px)
+            _draw_line(out[RASTER_ROUTE].T, c0, r0, c1, r1, RASTER_ON)
+
+        for j in range(vehicle_ranges[e, 0], vehicle_ranges[e, 1]):
+            channel = RASTER_EGO if j == i else RASTER_VEHICLES
+            corners = np.empty((4, 2))
+            for k in range(4):
+                corners[k, 0], corners[k, 1] = _to_pixel(
+                    rects[j, k], x, y, hx, hy, half, m_per_px)
+            _fill_quad(out[channel], corners)
+    return ret
+
+
+@njit(cache=CACHE_NUMBA, nogil=True)
+def _to_pixel(point, x, y, hx, hy, half, m_per_px):
+    """:return: Continuous (column, row) of a world point in an ego raster"""
+    dx, dy = point[0] - x, point[1] - y
+    ahead = dx * hx + dy * hy
+    right = dx * hy - dy * hx
+    return half + right / m_per_px, half - ahead / m_per_px
+
+
+@njit(cache=CACHE_NUMBA, nogil=True)
+def _draw_line(image, x0, y0, x1, y1, value):
+    """Set image[x, y] along (x0, y0) -> (x1, y1), in continuous pixels"""
+    width, height = image.shape
+    num_samples = int(math.ceil(2 * math.hypot(x1 - x0, y1 - y0))) + 1
+    for s in range(num_samples + 1):
+        t = s / num_samples
+        px = int(math.floor(x0 + t * (x1 - x0)))
+        py = int(math.floor(y0 + t * (y1 - y0)))
+        if 0 <= px < width and 0 <= py < height:
+            image[px, py] = value
+
+
+@njit(cache=CACHE_NUMBA, nogil=True)
+def _fill_quad(image, corners):
+    """
+    Set image[row, col] at pixel centers inside a convex quad
+
+    :param corners: (4, 2) continuous (column, row) in order around the quad
+    """
+    size_rows, size_cols = image.shape
+    col0 = max(0, int(math.floor(corners[:, 0].min())))
+    col1 = min(size_cols - 1, int(math.ceil(corners[:, 0].max())))
+    row0 = max(0, int(math.floor(corners[:, 1].min())))
+    row1 = min(size_rows - 1, int(math.ceil(corners[:, 1].max())))
+    for row in range(row0, row1 + 1):
+        for col in range(col0, col1 + 1):
+            cx, cy = col + 0.5, row + 0.5
+            has_pos = False
+            has_neg = False
+            for k in range(4):
+                ax, ay = corners[k, 0], corners[k, 1]
+                bx, by = corners[(k + 1) % 4, 0], corners[(k + 1) % 4, 1]
+                cross = (bx - ax) * (cy - ay) - (by - ay) * (cx - ax)
+                if cross > 0:
+                    has_pos = True
+                elif cross < 0:
+                    has_neg = True
+            if not (has_pos and has_neg):
+                image[row, col] = RASTER_ON
+
+
+def test_rasterize():
+    from deepdrive_zero.physics.collision_detection import get_rect
+    # Ego facing right at (20, 20) with a car 10m ahead, a route straight
+    # ahead and an obstacle 5m behind
+    m_per_px = 0.5
+    size = 40
+    positions = np.array([[20., 20.], [30., 20.]])
+    angles = np.array([-pi / 2, -pi / 2])
+    rects = np.array([get_rect(p[0], p[1], a, 2., 4.)[0]
+                      for p, a in zip(positions, angles)])
+    route_points = np.array([[20., 20.], [60., 20.]])
+    segments = np.array([[[15., 18.], [15., 22.]]])
+    static_layers = get_static_layers(False, m_per_px)
+    raster = rasterize(
+        static_layers, np.array([0]), positions, angles, rects,
+        np.array([[0, 2]]), route_points, np.array([[0, 2]]), segments,
+        np.array([[0, 1]]), size, m_per_px)
+    assert raster.shape == (1, NUM_RASTER_CHANNELS, size, size)
+    assert raster.dtype == np.uint8
+    raster = raster[0]
+    middle = size // 2
+
+    def pixels(channel):
+        rows, cols = np.nonzero(raster[channel])
+        return rows, cols
+
+    # Ego is 4m long, i.e. 8px tall facing up, in the middle
+    rows, cols = pixels(RASTER_EGO)
+    assert rows.min() == middle - 4 and rows.max() == middle + 3
+    assert cols.min() == middle - 2 and cols.max() == middle + 1
+
+    # Car 10m ahead is 20px up
+    rows, cols = pixels(RASTER_VEHICLES)
+    assert rows.min() == middle - 24 + 4 and rows.max() == middle - 20 + 3
+    assert cols.min() == middle - 2 and cols.max() == middle + 1
+
+    # Route goes straight up from the middle
+    rows, cols = pixels(RASTER_ROUTE)
+    assert set(cols) <= {middle - 1, middle}
+    assert rows.min() == 0 and rows.max() == middle
+
+    # Obstacle cut out of the drivable area 10px below
+    drivable = raster[RASTER_DRIVABLE]
+    assert not drivable[middle + 10, middle - 4:middle + 4].any()
+    assert (drivable[middle + 10, :middle - 5] == RASTER_ON).all()
+    assert not raster[RASTER_LANES].any()
+
+
+def test_static_layers():
+    m_per_px = 0.25
+    static_layers = get_static_layers(True, m_per_px)
+    assert get_static_layers(True, m_per_px) is static_layers
+    lines, lane_width = get_intersection()
+    mid_vert = lines[1]
+    x = mid_vert[0, 0]
+    px = int(x / m_per_px)
+    py = int(lines[4][0, 1] / m_per_px) + 20
+    assert static_layers[RASTER_LANES, px, py] == RASTER_ON
+    assert static_layers[RASTER_DRIVABLE, px, py] == RASTER_ON
+    # Off the roads
+    assert not static_layers[:, 0, 0].any()
@@ -5,14 +5,52 @@ import sys
 from deepdrive_zero.logs import log
 import deepdrive_zero.physics.collision_detection
 import deepdrive_zero.physics.bike_model
+import deepdrive_zero.physics.conflict_zones
+import deepdrive_zero.physics.arc_length
+import deepdrive_zero.physics.integrators
+import deepdrive_zero.physics.neighbors
+import deepdrive_zero.physics.pairwise_geometry
+import deepdrive_zero.physics.physics_step
+import deepdrive_zero.physics.pose_frame
+import deepdrive_zero.physics.steering_table
 import deepdrive_zero.envs.env
+import deepdrive_zero.experience_buffer
+import deepdrive_zero.map_gen
+import deepdrive_zero.map_store
+import deepdrive_zero.normalization
+import deepdrive_zero.observation_schema
+import deepdrive_zero.reward
+import deepdrive_zero.scenario_bank
+import deepdrive_zero.sensors.lidar
+import deepdrive_zero.sensors.polar_occupancy
+import deepdrive_zero.sensors.raster
 import deepdrive_zero.utils
+import deepdrive_zero.vehicles
 
 MODULES_TO_TEST = [
     deepdrive_zero.physics.collision_detection,
     deepdrive_zero.physics.bike_model,
+    deepdrive_zero.physics.conflict_zones,
+    deepdrive_zero.physics.arc_length,
+    deepdrive_zero.physics.integrators,
+    deepdrive_zero.physics.neighbors,
+    deepdrive_zero.physics.pairwise_geometry,
+    deepdrive_zero.physics.physics_step,
+    deepdrive_zero.physics.pose_frame,
+    deepdrive_zero.physics.steering_table,
     deepdrive_zero.envs.env,
+    deepdrive_zero.experience_buffer,
+    deepdrive_zero.map_gen,
+    deepdrive_zero.map_store,
+    deepdrive_zero.normalization,
+    deepdrive_zero.observation_schema,
+    deepdrive_zero.reward,
+    deepdrive_zero.scenario_bank,
+    deepdrive_zero.sensors.lidar,
+    deepdrive_zero.sensors.polar_occupancy,
+    deepdrive_zero.sensors.raster,
     deepdrive_zero.utils,
+    deepdrive_zero.vehicles,
 ]
 
 
@@ -16,33 +16,6 @@ def flatten_points(points):
     return [coord for point in points for coord in point]
 
 
-def get_angles_ahead(ego_angle, closest_map_index, map_points,
-                     seconds_ahead, speed, route_length, total_points,
-                     heading, ego_front):
-    # TODO: Profile / numba
-    num_indices = len(seconds_ahead)
-    points_per_meter = total_points / route_length
-    points_per_second = speed * points_per_meter
-    seconds_per_index = 0.5
-    points_per_index = points_per_second * seconds_per_index
-    points_per_index = max(1, int(round(points_per_index)))
-    min_first_point_dist = 2
-    first_index = closest_map_index + points_per_meter * min_first_point_dist
-    first_index = int(round(first_index))
-    first_index = min(first_index, len(map_points) - 1)
-    last_index = closest_map_index + points_per_index * num_indices
-    last_index = min(last_index, len(map_points))
-    points = map_points[int(first_index):last_index:points_per_index]
-    points = list(points)
-
-    while len(points) < num_indices:
-        # Append last point where we're at the end
-        points.append(points[-1])
-
-    angles = [get_angle(heading, p - ego_front) for p in points]
-    return angles
-
-
 @njit(cache=CACHE_NUMBA, nogil=True)
 def get_angle(vector1, vector2):
     """ Returns the angle in radians between given vectors"""
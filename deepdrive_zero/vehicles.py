@@ -0,0 +1,112 @@
+from math import log
+
+import numpy as np
+
+from deepdrive_zero.constants import USE_VOYAGE, VOYAGE_VAN_LENGTH, \
+    VOYAGE_VAN_WIDTH, VOYAGE_VAN_MAX_ACCEL, TESLA_LENGTH, TESLA_WIDTH, \
+    TESLA_MAX_ACCEL, MAX_BRAKE_G, G_ACCEL, STEERING_RANGE
+from deepdrive_zero.physics.bike_model import TUNED_FPS, ROTATIONAL_FRICTION, \
+    LONGITUDINAL_FRICTION, BRAKE_FRICTION, get_vehicle_model, \
+    NUM_VEHICLE_PARAMS, VP_CG_TO_FRONT_AXLE, VP_CG_TO_REAR_AXLE, VP_SLIP, \
+    VP_ROTATIONAL_FRICTION, VP_LONGITUDINAL_FRICTION, VP_BRAKE_FRICTION, \
+    VP_ROTATIONAL_FRICTION_RATE, VP_LONGITUDINAL_FRICTION_RATE, \
+    VP_BRAKE_FRICTION_RATE, VP_WIDTH, VP_LENGTH, VP_MAX_ACCEL, VP_MAX_BRAKE, \
+    VP_STEERING_RANGE
+
+# All units in meters, seconds and radians. Axle distances are from the center
+# of gravity and default to get_vehicle_model(width, front_bias). Friction is
+# the ratio kept per step at TUNED_FPS.
+VEHICLES = dict(
+    voyage_van=dict(
+        width=VOYAGE_VAN_WIDTH,
+        length=VOYAGE_VAN_LENGTH,
+        front_bias=.05,
+        max_accel=VOYAGE_VAN_MAX_ACCEL,
+        max_brake=MAX_BRAKE_G * G_ACCEL,
+        steering_range=STEERING_RANGE,
+        rotational_friction=ROTATIONAL_FRICTION,
+        longitudinal_friction=LONGITUDINAL_FRICTION,
+        brake_friction=BRAKE_FRICTION,
+    ),
+    tesla=dict(
+        width=TESLA_WIDTH,
+        length=TESLA_LENGTH,
+        front_bias=0,
+        max_accel=TESLA_MAX_ACCEL,
+        max_brake=MAX_BRAKE_G * G_ACCEL,
+        steering_range=STEERING_RANGE,
+        rotational_friction=ROTATIONAL_FRICTION,
+        longitudinal_friction=LONGITUDINAL_FRICTION,
+        brake_friction=BRAKE_FRICTION,
+    ),
+)
+DEFAULT_VEHICLE = 'voyage_van' if USE_VOYAGE else 'tesla'
+
+
+def get_vehicle_params(name=DEFAULT_VEHICLE) -> np.array:
+    """
+    :return: NUM_VEHICLE_PARAMS row for the physics kernels, see VP_* in
+        bike_model.py, with derived constants precomputed
+    """
+    if name not in VEHICLES:
+        raise ValueError(f'Unknown vehicle {name}, expected one of '
+                         f'{list(VEHICLES)}')
+    spec = VEHICLES[name]
+    if 'cg_to_front_axle' in spec:
+        front, rear = spec['cg_to_front_axle'], spec['cg_to_rear_axle']
+    else:
+        front, rear = get_vehicle_model(spec['width'], spec['front_bias'])
+    ret = np.zeros(NUM_VEHICLE_PARAMS)
+    ret[VP_CG_TO_FRONT_AXLE] = front
+    ret[VP_CG_TO_REAR_AXLE] = rear
+    ret[VP_SLIP] = front / (front + rear)
+    ret[VP_ROTATIONAL_FRICTION] = spec['rotational_friction']
+    ret[VP_LONGITUDINAL_FRICTION] = spec['longitudinal_friction']
+    ret[VP_BRAKE_FRICTION] = spec['brake_friction']
+    ret[VP_ROTATIONAL_FRICTION_RATE] = \
+        log(spec['rotational_friction']) / TUNED_FPS
+    ret[VP_LONGITUDINAL_FRICTION_RATE] = \
+        log(spec['longitudinal_friction']) / TUNED_FPS
+    ret[VP_BRAKE_FRICTION_RATE] = log(spec['brake_friction']) / TUNED_FPS
+    ret[VP_WIDTH] = spec['width']
+    ret[VP_LENGTH] = spec['length']
+    ret[VP_MAX_ACCEL] = spec['max_accel']
+    ret[VP_MAX_BRAKE] = spec['max_brake']
+    ret[VP_STEERING_RANGE] = spec['steering_range']
+    return ret
+
+
+def compile_fleet(vehicles, num_routes) -> np.array:
+    """
+    :param vehicles: Vehicle name for every route, one name for all routes,
+        or None for DEFAULT_VEHICLE
+    :return: (num_routes, NUM_VEHICLE_PARAMS) parameters indexed by
+        Agent.route_index
+    """
+    if vehicles is None:
+        vehicles = DEFAULT_VEHICLE
+    if isinstance(vehicles, str):
+        vehicles = [vehicles] * num_routes
+    if len(vehicles) != num_routes:
+        raise ValueError(f'Got {len(vehicles)} vehicles for {num_routes} '
+                         f'routes')
+    params = {name: get_vehicle_params(name) for name in set(vehicles)}
+    return np.array([params[name] for name in vehicles])
+
+
+def test_vehicle_params():
+    from deepdrive_zero.constants import VEHICLE_WIDTH, VEHICLE_LENGTH, \
+        MAX_METERS_PER_SEC_SQ
+    params = get_vehicle_params()
+    front, rear = get_vehicle_model(VEHICLE_WIDTH)
+    assert params[VP_CG_TO_FRONT_AXLE] == front
+    assert params[VP_SLIP] == front / (front + rear)
+    assert params[VP_WIDTH] == VEHICLE_WIDTH
+    assert params[VP_LENGTH] == VEHICLE_LENGTH
+    assert params[VP_MAX_ACCEL] == MAX_METERS_PER_SEC_SQ
+
+    fleet = compile_fleet(['voyage_van', 'tesla', 'voyage_van'], num_routes=3)
+    assert fleet.shape == (3, NUM_VEHICLE_PARAMS)
+    assert fleet[1, VP_LENGTH] == TESLA_LENGTH
+    assert fleet[1, VP_WIDTH] == TESLA_WIDTH
+    assert np.array_equal(fleet[0], fleet[2])